@@ -14,7 +14,7 @@ import numpy as np
 from sklearn.model_selection import RandomizedSearchCV
 import xgboost as xgb
 from sklearn.model_selection import GridSearchCV
-import joblib
+from XGBoost_registry import save_model
 
 class XGBfitter(object):
     
@@ -187,7 +187,7 @@ class XGBfitter(object):
             
             ## save model
             os.chdir("./Fitted Models/"+self.site) # change to relevant model folder
-            joblib.dump(xgb_grid.best_estimator_, fn+"_XGB.json") # save best model
+            save_model(xgb_grid.best_estimator_, ".", fn, X_train, y_train) # save best model in native format with metadata
             os.chdir("../..") # change back to data folder
 
         ## write to excel file
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 12:08:30 2026
+
+registry of fitted XGB models
+models are stored as native XGBoost UBJSON (<site>_<target>_XGB.ubj) next to a metadata record
+    (<site>_<target>_XGB_meta.json) with the feature order, hyperparameters, a hash of the training data, and the XGBoost
+    version; loaded models are kept in a process-wide LRU cache so each model is deserialized once per run
+models pickled by older versions of XGBfitter (<site>_<target>_XGB.json, written with joblib) are converted on first load
+
+@author: emei3
+"""
+
+## imports
+import os
+import json
+import hashlib
+import functools
+from datetime import datetime
+import pandas as pd
+import xgboost as xgb
+import joblib
+
+# number of models kept in memory by load_model
+model_cache_size = 16
+
+def model_paths(model_dir, name):
+    """
+    returns the paths of the native model, its metadata, and the legacy pickled model of name (e.g., site_target)
+    """
+    base = os.path.join(os.path.abspath(model_dir), name+'_XGB')
+    return base+'.ubj', base+'_meta.json', base+'.json'
+
+def hash_training_data(X_train, y_train):
+    """
+    returns a sha256 hash of the training features and targets (values, column names, and index)
+    """
+    sha = hashlib.sha256()
+    for data in [X_train, y_train]:
+        data = pd.DataFrame(data)
+        sha.update(','.join(str(column) for column in data.columns).encode())
+        sha.update(pd.util.hash_pandas_object(data, index=True).to_numpy().tobytes())
+    return sha.hexdigest()
+
+def save_model(regressor, model_dir, name, X_train=None, y_train=None):
+    """
+    saves a fitted model in native UBJSON with its metadata
+
+    Parameters
+    ----------
+    regressor : XGBoost model
+        fitted XGBRegressor.
+    model_dir : string
+        folder of the fitted models (e.g., Fitted Models/<site>).
+    name : string
+        name of the model, e.g., site_target.
+    X_train : dataframe, optional
+        training features; hashed into the metadata. The default is None (not recorded).
+    y_train : dataframe, optional
+        training targets; hashed into the metadata. The default is None (not recorded).
+
+    Returns
+    -------
+    metadata : dict
+        metadata written next to the model.
+
+    """
+    path_model, path_meta, _ = model_paths(model_dir, name)
+    regressor.save_model(path_model)
+    # only keep hyperparameters that can be written to json
+    hyperparameters = {key: value for key, value in regressor.get_params().items()
+                       if isinstance(value, (type(None), bool, int, float, str))}
+    feature_names = getattr(regressor, 'feature_names_in_', None)
+    metadata = {'name': name,
+                'feature_names': None if feature_names is None else [str(feature) for feature in feature_names],
+                'hyperparameters': hyperparameters,
+                'training_data_hash': None if X_train is None else hash_training_data(X_train, y_train),
+                'xgboost_version': xgb.__version__,
+                'saved': datetime.now().isoformat(timespec='seconds')}
+    with open(path_meta, 'w') as f:
+        json.dump(metadata, f, indent=1)
+    _load_cached.cache_clear() # a model may have been replaced
+    return metadata
+
+def convert_legacy_model(model_dir, name):
+    """
+    converts a model pickled with joblib to native UBJSON plus metadata; the training data hash is not recorded
+    """
+    _, _, path_legacy = model_paths(model_dir, name)
+    print('converting pickled model '+path_legacy+' to native XGBoost format')
+    regressor = joblib.load(path_legacy)
+    return save_model(regressor, model_dir, name)
+
+def load_metadata(model_dir, name):
+    """
+    returns the metadata record of a saved model
+    """
+    _, path_meta, _ = model_paths(model_dir, name)
+    with open(path_meta) as f:
+        return json.load(f)
+
+@functools.lru_cache(maxsize=model_cache_size)
+def _load_cached(path_model, modified_time):
+    """
+    deserializes a native model; keyed on the modification time so a refitted model is reloaded
+    """
+    regressor = xgb.XGBRegressor()
+    regressor.load_model(path_model)
+    return regressor
+
+def load_model(model_dir, name, feature_names=None):
+    """
+    loads a fitted model through the process-wide cache. The returned model is shared by every caller in this process,
+    so it should only be used for prediction
+
+    Parameters
+    ----------
+    model_dir : string
+        folder of the fitted models (e.g., Fitted Models/<site>).
+    name : string
+        name of the model, e.g., site_target.
+    feature_names : list, optional
+        feature names in the order they will be passed to the model; checked against the metadata. The default is None.
+
+    Returns
+    -------
+    regressor : XGBoost model
+        fitted XGBRegressor.
+
+    """
+    path_model, path_meta, path_legacy = model_paths(model_dir, name)
+    if not os.path.exists(path_model) and os.path.exists(path_legacy):
+        convert_legacy_model(model_dir, name)
+    if feature_names is not None and os.path.exists(path_meta):
+        metadata = load_metadata(model_dir, name)
+        if metadata['feature_names'] is not None and metadata['feature_names'] != list(feature_names):
+            raise ValueError('features do not match the order '+name+' was fit with: '+str(metadata['feature_names']))
+    return _load_cached(path_model, os.path.getmtime(path_model))
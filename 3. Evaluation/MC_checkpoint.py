@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 12:05:31 2026
+
+checkpoints for long Monte Carlo propagation runs
+each finished chunk of simulations is saved under a run directory along with a manifest of the seed, a fingerprint of
+    the run's inputs, and the completed ranges, so a restarted run with the same seed and inputs skips finished chunks
+    and regenerates the rest with the same random numbers; any other run refuses to resume
+
+@author: emei3
+"""
+
+## imports
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from MC_random import master_seed, record_seed, seed_to_json
+
+def _hash_into(digest, value):
+    """
+    feeds one input into a running hash, tagged by type so different inputs never hash the same
+    """
+    if hasattr(value, 'fingerprint'): # ensembles and shared arrays hash what defines them
+        digest.update(b'F'+value.fingerprint().encode())
+    elif isinstance(value, np.random.SeedSequence):
+        _hash_into(digest, ('SeedSequence', str(value.entropy), [int(key) for key in value.spawn_key]))
+    elif isinstance(value, dict):
+        _hash_into(digest, sorted(value.items()))
+    elif isinstance(value, (list, tuple)):
+        digest.update(b'L'+str(len(value)).encode())
+        for item in value:
+            _hash_into(digest, item)
+    elif isinstance(value, np.ndarray) or hasattr(value, 'to_numpy'): # arrays, series, and dataframes by value
+        array = np.ascontiguousarray(value if isinstance(value, np.ndarray) else value.to_numpy())
+        if array.dtype == object:
+            _hash_into(digest, array.tolist())
+        else:
+            digest.update(b'A'+str(array.dtype).encode()+str(array.shape).encode())
+            digest.update(array.view(np.uint8).ravel() if array.size > 0 else b'')
+    else:
+        digest.update(b'S'+repr(value).encode())
+
+def hash_inputs(*inputs):
+    """
+    returns a hex fingerprint of the inputs of a run (e.g., sampler, feature names, perturbation sigmas, observed
+    features, and emissions ensembles or impacts); arrays are hashed by value, and objects with a fingerprint method
+    (MC_ensemble.VirtualEnsemble, MC_output.EnsembleStore) by what defines them
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    _hash_into(digest, inputs)
+    return digest.hexdigest()
+
+class Checkpoint(object):
+
+    def __init__(self, run_dir):
+        """
+        checkpoint of one Monte Carlo run (e.g., one site and target) stored in run_dir
+
+        Parameters
+        ----------
+        run_dir : string
+            directory of this run; created if it does not exist.
+
+        """
+        self.run_dir = os.path.abspath(run_dir)
+        self.manifest_path = os.path.join(self.run_dir, 'manifest.json')
+        self.manifest = None
+
+    def start(self, n_days, n_sims, n_sims_chunk, seed_seq, fingerprint=None):
+        """
+        starts a new run or resumes a previous one. A resumed run must have the same size, chunking, seed, and
+        fingerprint of inputs, so chunks of different runs are never mixed in one output
+
+        Parameters
+        ----------
+        n_days : int
+            number of days in each simulation.
+        n_sims : int
+            total number of simulations.
+        n_sims_chunk : int
+            number of simulations per chunk.
+        seed_seq : numpy SeedSequence
+            seed of this run.
+        fingerprint : string, optional
+            hash_inputs of everything else the simulations depend on (sampler, features, sigmas, ensembles or impacts).
+            The default is None.
+
+        Returns
+        -------
+        seed_seq : numpy SeedSequence
+            seed of the run (the same as given).
+
+        """
+        os.makedirs(self.run_dir, exist_ok=True)
+        run = {'n_days': n_days,
+               'n_sims': n_sims,
+               'n_sims_chunk': n_sims_chunk,
+               'entropy': str(seed_seq.entropy), # may be too large for a json int
+               'spawn_key': [int(key) for key in seed_seq.spawn_key],
+               'fingerprint': fingerprint}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+            for key, value in run.items():
+                if self.manifest.get(key) != value:
+                    if key in ['entropy', 'spawn_key']:
+                        raise ValueError('checkpoint in '+self.run_dir+' was run with a different seed; rerun with its seed '
+                                         'or delete it to start over')
+                    if key == 'fingerprint':
+                        raise ValueError('checkpoint in '+self.run_dir+' was run with different inputs (sampler, features, '
+                                         'or emissions); delete it to start over')
+                    raise ValueError('checkpoint in '+self.run_dir+' has '+key+'='+str(self.manifest.get(key))+', not '
+                                     +str(value)+'; delete it to start over')
+            print('resuming '+self.run_dir+' with '+str(len(self.manifest['completed']))+' chunks completed')
+        else:
+            self.manifest = dict(run, completed=[])
+            self._write_manifest()
+        return seed_seq
+
+    def _write_manifest(self):
+        """
+        writes the manifest atomically so a crash never leaves it half written
+        """
+        temp_path = self.manifest_path+'.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(temp_path, self.manifest_path)
+
+    def _chunk_path(self, start, stop):
+        return os.path.join(self.run_dir, 'sims_'+str(start)+'-'+str(stop)+'.npy')
+
+    def is_complete(self, start, stop):
+        """
+        returns whether simulations start through stop-1 were already saved
+        """
+        return [start, stop] in self.manifest['completed']
+
+    def write_chunk(self, start, stop, y_chunk):
+        """
+        saves the (n_days, stop-start) predictions of a chunk; safe to call from worker processes.
+        The chunk only counts as complete once mark_complete is called
+        """
+        temp_path = self._chunk_path(start, stop)+'.tmp.npy'
+        np.save(temp_path, y_chunk)
+        os.replace(temp_path, self._chunk_path(start, stop))
+
+    def mark_complete(self, start, stop):
+        """
+        records a saved chunk in the manifest; only call from the process that called start
+        """
+        self.manifest['completed'].append([start, stop])
+        self._write_manifest()
+
+    def save_chunk(self, start, stop, y_chunk):
+        """
+        saves the predictions of a chunk and records it as complete
+        """
+        self.write_chunk(start, stop, y_chunk)
+        self.mark_complete(start, stop)
+
+    def load_chunk(self, start, stop):
+        """
+        returns the saved (n_days, stop-start) predictions of a completed chunk
+        """
+        return np.load(self._chunk_path(start, stop))
+
+    def clear(self):
+        """
+        deletes the run directory once the run's output is safely written
+        """
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+        self.manifest = None
+
+def get_checkpoint(rel_path_checkpoints, name):
+    """
+    returns the checkpoint of run name under the directory rel_path_checkpoints (relative to this code's directory),
+    or None if rel_path_checkpoints is None (checkpoints turned off)
+    """
+    if rel_path_checkpoints is None:
+        return None
+    return Checkpoint(os.path.join(os.path.dirname(os.path.abspath(__file__)), rel_path_checkpoints, name))
+
+def resume_seed(seed, rel_path_checkpoints, fn):
+    """
+    returns the master seed of a run that checkpoints under rel_path_checkpoints. The seed is kept there in file fn, and
+    while any checkpoint drawn from it is left a rerun resumes with it instead of drawing a new seed
+
+    Parameters
+    ----------
+    seed : int, numpy SeedSequence, string, or None
+        seed given to the run (see MC_random.master_seed); None resumes with the kept seed or draws a new one.
+    rel_path_checkpoints : string or None
+        directory of the checkpoints, relative to this code's directory; None (checkpoints turned off) returns
+        master_seed(seed).
+    fn : string
+        file name of the kept seed (e.g., 'seed_e1_2006-2019.json'); must be unique to the script and years.
+
+    Returns
+    -------
+    seed_seq : numpy SeedSequence
+
+    """
+    if rel_path_checkpoints is None:
+        return master_seed(seed)
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), rel_path_checkpoints)
+    seed_path = os.path.join(root, fn)
+    if os.path.exists(seed_path):
+        kept = master_seed(seed_path)
+        # checkpoints drawn from the kept seed; every stream has its entropy and begins with its spawn key
+        entropy, spawn_key = str(kept.entropy), [int(key) for key in kept.spawn_key]
+        pending = False
+        for name in os.listdir(root):
+            manifest_path = os.path.join(root, name, 'manifest.json')
+            if os.path.isfile(manifest_path):
+                with open(manifest_path) as f:
+                    manifest = json.load(f)
+                pending |= (manifest.get('entropy') == entropy
+                            and manifest.get('spawn_key', [])[:len(spawn_key)] == spawn_key)
+        if pending:
+            if seed is not None and seed_to_json(master_seed(seed)) != seed_to_json(kept):
+                raise ValueError('checkpoints in '+root+' were run with the seed in '+fn+', not the seed given; rerun '
+                                 'with seed=None or delete the checkpoints to start over')
+            print('resuming with the seed in '+seed_path)
+            return kept
+    seed_seq = master_seed(seed)
+    os.makedirs(root, exist_ok=True)
+    record_seed(seed_seq, seed_path)
+    return seed_seq
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 12:40:23 2026
+
+virtual Monte Carlo emissions ensembles
+the counterfactual emissions ensembles of c4 and d3 are fully defined by a few parameters per day, a few constants, and
+    their random numbers, so instead of 5000 columns of draws only those and the seed are saved; any block of days and
+    simulations is regenerated on demand with bit-identical values
+the random numbers of each tile of n_days_block days and n_sims_block simulations come from their own stream, so a slice
+    only generates the tiles it touches and gets the same values however it is read
+virtual ensembles index like the (n_days, n_sims) array of an ensemble file, so take_aligned, insert_aligned, and
+    summarize read them directly
+
+@author: emei3
+"""
+
+## imports
+import os
+import json
+import numpy as np
+import pandas as pd
+from MC_propagation import chunk_seed
+from MC_random import seed_to_json, seed_from_json
+from MC_output import EnsembleStore, store_fn
+from MC_sampling import standard_normals
+from MC_checkpoint import hash_inputs
+
+def draw_noise(rng, out, sampler='random'):
+    """
+    fills the float32 (n_days, n_simulations) array out with standard normals; the 'random' sampler draws them in
+    place in one call
+    """
+    if sampler == 'random':
+        rng.standard_normal(dtype=np.float32, out=out)
+    else:
+        out[:] = standard_normals(rng, out.shape[1], out.shape[0], 1, sampler)[:, :, 0].T
+
+def monte_carlo_regression_prediction(x, slope, intercept, se_slope, n_simulations=5000, rng=None, out=None,
+                                      sampler='random'):
+    """
+    Uses a Monte Carlo method to predict a series of y values for a given set of x values using an regression.
+    Assumes normal distribution around regression. All simulations are drawn in one call into a float32 block
+    (days by simulations, the layout of the ensemble files) and clipped in place
+
+    Parameters:
+    x (array-like): The x values for which to predict y values.
+    slope (float): The slope of the regression line.
+    intercept (float): The intercept of the regression line.
+    se_slope (float): The standard error of the slope of the regression line.
+    n_simulations (int): The number of simulations to run. Default is 5000.
+    rng (numpy Generator): Random number generator. Default is None (new unseeded generator).
+    out (ndarray): Optional preallocated float32 array of shape (len(x), n_simulations) to fill.
+    sampler (string): Sampler of the noise (see MC_sampling). Default is 'random'.
+
+    Returns:
+    y_mc (ndarray): A float32 array of shape (len(x), n_simulations) containing the predicted y values for each x value
+    and each simulation.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    x = np.asarray(x, dtype=float)
+    if out is None:
+        out = np.empty((len(x), n_simulations), dtype=np.float32)
+
+    draw_noise(rng, out, sampler) # noise ~ N(slope, se_slope)
+    out *= np.float32(se_slope)
+    out += (slope * x + intercept + slope).astype(np.float32)[:, None]
+    # ensure emissions can't go below 0
+    np.maximum(out, 0, out=out)
+    return out
+
+def monte_carlo_prediction(x, ER_means, cov, n_simulations=5000, rng=None, out=None, sampler='random'):
+    """
+    Uses a Monte Carlo method to predict a series of y values for a given set of x values
+    x here is demand and y is the emissions mass. All simulations are drawn in one call into a float32 block
+    (days by simulations) and clipped in place
+
+    Parameters:
+    x (array-like): The x values for which to predict y values.
+    ER_means (array-like): Mean ERs matched to day of year parallel to demands in x.
+    cov (float): Mean CoV of all averaged ERs from base years.
+    n_simulations (int): The number of simulations to run. Default is 5000.
+    rng (numpy Generator): Random number generator. Default is None (new unseeded generator).
+    out (ndarray): Optional preallocated float32 array of shape (len(x), n_simulations) to fill.
+    sampler (string): Sampler of the ERs (see MC_sampling). Default is 'random'.
+
+    Returns:
+    y_mc (ndarray): A float32 array of shape (len(x), n_simulations) containing the predicted y values for each x value
+    and each simulation.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    x = np.asarray(x, dtype=float)
+    ER_means = np.asarray(ER_means, dtype=float)
+    if out is None:
+        out = np.empty((len(x), n_simulations), dtype=np.float32)
+
+    draw_noise(rng, out, sampler) # ER ~ N(ER_means, ER_means*cov)
+    out *= (ER_means*cov).astype(np.float32)[:, None]
+    out += ER_means.astype(np.float32)[:, None]
+    out *= x.astype(np.float32)[:, None]
+    # ensure emissions can't go below 0
+    np.maximum(out, 0, out=out)
+    return out
+
+# generator of each kind of virtual ensemble
+generators = {'regression': monte_carlo_regression_prediction, # c4
+              'emission_rate': monte_carlo_prediction} # d3
+
+class VirtualEnsemble(object):
+
+    def __init__(self, kind, dates, n_sims, daily, constants, seed, n_days_block=365, n_sims_block=50,
+                 sampler='random'):
+        """
+        ensemble regenerated from its parameters; indexes like an (n_days, n_sims) float32 array
+
+        Parameters
+        ----------
+        kind : string
+            generator of the ensemble; a key of generators.
+        dates : array-like
+            date of each day.
+        n_sims : int
+            number of simulations.
+        daily : dict
+            generator argument to its value on each day (e.g., {'x': demand, 'ER_means': ER}).
+        constants : dict
+            generator argument to its scalar value (e.g., {'cov': CoV}).
+        seed : numpy SeedSequence
+            stream of the ensemble (e.g., from MC_random.stream_seed); tile (i, j) is drawn from
+            chunk_seed(chunk_seed(seed, i), j).
+        n_days_block : int, optional
+            days per tile. The default is 365.
+        n_sims_block : int, optional
+            simulations per tile. The default is 50.
+        sampler : string, optional
+            sampler of each tile's random numbers (see MC_sampling). The default is 'random'.
+
+        """
+        if kind not in generators:
+            raise ValueError('unknown ensemble kind '+str(kind))
+        self.kind = kind
+        self.index = pd.DatetimeIndex(pd.to_datetime(dates), name='Date')
+        self.n_sims = n_sims
+        self.daily = {name: np.asarray(values, dtype=float) for name, values in daily.items()}
+        for name, values in self.daily.items():
+            if len(values) != len(self.index):
+                raise ValueError(name+' has '+str(len(values))+' days, not '+str(len(self.index)))
+        self.constants = {name: float(value) for name, value in constants.items()}
+        self.seed = seed
+        self.n_days_block = n_days_block
+        self.n_sims_block = n_sims_block
+        self.sampler = sampler
+        self.shape = (len(self.index), n_sims)
+        self.columns = pd.Index(['column_' + str(i) for i in range(0, n_sims)])
+
+    def tile(self, day_block, sim_block):
+        """
+        generates the simulations of one tile of days and simulations
+        """
+        d0, s0 = day_block*self.n_days_block, sim_block*self.n_sims_block
+        d1, s1 = min(d0 + self.n_days_block, self.shape[0]), min(s0 + self.n_sims_block, self.n_sims)
+        rng = np.random.default_rng(chunk_seed(chunk_seed(self.seed, day_block), sim_block))
+        daily = {name: values[d0:d1] for name, values in self.daily.items()}
+        return generators[self.kind](**daily, **self.constants, n_simulations=s1-s0, rng=rng, sampler=self.sampler)
+
+    def __getitem__(self, key):
+        """
+        returns the simulations of any rows (int, slice, or integer array, as numpy) and columns of the ensemble
+        """
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        days = np.arange(self.shape[0])[rows]
+        sims = np.arange(self.shape[1])[cols]
+        out = np.empty((np.size(days), np.size(sims)), dtype=np.float32)
+        days_flat, sims_flat = np.atleast_1d(days), np.atleast_1d(sims)
+        if out.size > 0:
+            sim_blocks = np.unique(sims_flat // self.n_sims_block)
+            # column of each simulation in tiles of sim_blocks laid side by side (only the last block can be short)
+            positions = (np.searchsorted(sim_blocks, sims_flat // self.n_sims_block)*self.n_sims_block +
+                         sims_flat % self.n_sims_block)
+            for day_block in np.unique(days_flat // self.n_days_block):
+                strip = np.concatenate([self.tile(day_block, sim_block) for sim_block in sim_blocks], axis=1)
+                selected = np.flatnonzero(days_flat // self.n_days_block == day_block)
+                out[selected] = strip[days_flat[selected] - day_block*self.n_days_block][:, positions]
+        if np.ndim(days) == 0 and np.ndim(sims) == 0:
+            return out[0, 0]
+        if np.ndim(days) == 0:
+            return out[0]
+        if np.ndim(sims) == 0:
+            return out[:, 0]
+        return out
+
+    def to_numpy(self):
+        """
+        returns every simulation of every day
+        """
+        return self[:, :]
+
+    def fingerprint(self):
+        """
+        returns a hash of the parameters and seed, which define every simulation, for MC_checkpoint.hash_inputs
+        """
+        return hash_inputs(self.kind, self.index.asi8, self.n_sims, self.daily, self.constants, self.seed,
+                           self.n_days_block, self.n_sims_block, self.sampler)
+
+    def save(self, fn):
+        """
+        writes the parameters and seed of the ensemble to a json file
+        """
+        with open(fn, 'w') as f:
+            json.dump({'kind': self.kind,
+                       'dates': [str(date.date()) for date in self.index],
+                       'n_sims': self.n_sims,
+                       'daily': {name: values.tolist() for name, values in self.daily.items()},
+                       'constants': self.constants,
+                       'seed': seed_to_json(self.seed),
+                       'n_days_block': self.n_days_block,
+                       'n_sims_block': self.n_sims_block,
+                       'sampler': self.sampler}, f)
+
+    @classmethod
+    def load(cls, fn):
+        """
+        reads an ensemble written by save
+        """
+        with open(fn) as f:
+            saved = json.load(f)
+        return cls(saved['kind'], saved['dates'], saved['n_sims'], saved['daily'], saved['constants'],
+                   seed_from_json(saved['seed']),
+                   saved['n_days_block'], saved['n_sims_block'], saved.get('sampler', 'random'))
+
+def virtual_fn(fn):
+    """
+    returns the file name of the virtual form of an ensemble file (e.g., so2_SOCO_2006-2019.ensemble.json)
+    """
+    return os.path.splitext(fn)[0]+'.ensemble.json'
+
+def read_ensemble(fn):
+    """
+    reads an ensemble saved as a parquet file (returns a dataframe), as a virtual ensemble next to where the parquet
+    would be (returns a VirtualEnsemble), or as a tensor store (returns an MC_output.EnsembleStore memory map); all have
+    the Date index and the column names of the simulations
+
+    Parameters
+    ----------
+    fn : string
+        file name of the parquet (e.g., so2_SOCO_2006-2019.parquet).
+
+    Returns
+    -------
+    ensemble : dataframe, VirtualEnsemble, or EnsembleStore
+
+    """
+    saved = [name for name in [fn, virtual_fn(fn), store_fn(fn)] if os.path.exists(name)]
+    if len(saved) > 1:
+        raise ValueError(' and '.join(saved)+' all exist; delete the stale ones')
+    if os.path.exists(virtual_fn(fn)):
+        return VirtualEnsemble.load(virtual_fn(fn))
+    if os.path.exists(store_fn(fn)):
+        return EnsembleStore(store_fn(fn))
+    return pd.read_parquet(fn)
+
+def ensemble_values(ensemble):
+    """
+    returns the simulations of an ensemble indexable as an (n_days, n_sims) array: the values of a dataframe with
+    columns in simulation order, or the VirtualEnsemble or EnsembleStore itself
+    """
+    if isinstance(ensemble, (VirtualEnsemble, EnsembleStore)):
+        return ensemble
+    return ensemble[['column_' + str(i) for i in range(0, len(ensemble.columns))]].to_numpy()
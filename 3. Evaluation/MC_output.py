@@ -0,0 +1,481 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 12:07:13 2026
+
+streaming writer for Monte Carlo ensembles
+ensembles are written in the same layout as before (Date index, one 'column_i' per simulation) but one block of days at a
+    time, each block as its own parquet row group, so the full (n_days, n_sims) ensemble never has to be in memory
+ensembles can also be written to a tensor store: a (n_days, n_sims) float32 .npy file that is opened as a memory map,
+    plus a json sidecar with the dates and metadata; opening it reads only the sidecar and slicing days or simulations
+    gives views of the file without decoding anything
+tensor stores can optionally be encoded compactly, as float16 or as int16 quantized with a scale and offset per day; the
+    error of every value is checked against a maximum absolute and relative error as it is written, and the bounds and
+    the largest errors are recorded in the sidecar metadata; missing values (NaN) are kept exactly
+
+@author: emei3
+"""
+
+## imports
+import os
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from MC_checkpoint import hash_inputs
+
+def ensemble_schema(dates, n_sims):
+    """
+    returns the parquet schema of an ensemble with n_sims simulations on dates; includes the pandas metadata so
+    pd.read_parquet restores the Date index
+    """
+    empty = pd.DataFrame(np.zeros((0, n_sims)), index=pd.DatetimeIndex(dates[:0], name='Date'),
+                         columns=['column_' + str(i) for i in range(0, n_sims)])
+    return pa.Schema.from_pandas(empty)
+
+class EnsembleWriter(object):
+
+    def __init__(self, fn, dates, n_sims, n_days_chunk=365):
+        """
+        writes an ensemble to fn block by block. Either append blocks of days (all simulations) with write_days, or
+        write chunks of simulations (all days) with write_sims, which spools them to a memory map on disk and converts
+        them to row groups on close. The file only appears under fn once close succeeds
+
+        Parameters
+        ----------
+        fn : string
+            file name of the output parquet.
+        dates : array-like
+            date of each row of the ensemble.
+        n_sims : int
+            number of simulations (columns).
+        n_days_chunk : int, optional
+            number of days per row group when converting spooled simulations. The default is 365.
+
+        """
+        self.fn = fn
+        self.dates = pd.DatetimeIndex(pd.to_datetime(dates))
+        self.n_sims = n_sims
+        self.n_days_chunk = n_days_chunk
+        self.schema = ensemble_schema(self.dates, n_sims)
+        self.temp_fn = fn+'.tmp'
+        self.writer = pq.ParquetWriter(self.temp_fn, self.schema)
+        self.n_days_written = 0
+        self.spool_fn = fn+'.spool.npy'
+        self.sims = None # memory map of spooled simulations
+
+    def write_days(self, values):
+        """
+        appends the next values.shape[0] days of every simulation as a row group
+
+        Parameters
+        ----------
+        values : ndarray
+            (n_days_block, n_sims) array of simulations.
+
+        Returns
+        -------
+        None.
+
+        """
+        start = self.n_days_written
+        stop = start + values.shape[0]
+        if stop > len(self.dates) or values.shape[1] != self.n_sims:
+            raise ValueError('block of shape '+str(values.shape)+' does not fit ensemble of '+str(len(self.dates))+
+                             ' days and '+str(self.n_sims)+' simulations after '+str(start)+' days')
+        arrays = [pa.array(values[:, i], type=pa.float64()) for i in range(0, self.n_sims)]
+        arrays.append(pa.array(self.dates[start:stop], type=self.schema.field('Date').type))
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+        self.n_days_written = stop
+
+    def spool(self):
+        """
+        returns the (n_days, n_sims) memory map that simulations are spooled to; can be filled directly
+        (e.g., as the out argument of propagate_batched)
+        """
+        if self.sims is None:
+            self.sims = np.lib.format.open_memmap(self.spool_fn, mode='w+', dtype=np.float64,
+                                                  shape=(len(self.dates), self.n_sims))
+        return self.sims
+
+    def write_sims(self, start, stop, values):
+        """
+        writes simulations start through stop-1 of every day
+
+        Parameters
+        ----------
+        start : int
+            first simulation.
+        stop : int
+            one past the last simulation.
+        values : ndarray
+            (n_days, stop-start) array of simulations.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.spool()[:, start:stop] = values
+
+    def close(self):
+        """
+        converts any spooled simulations to row groups, finishes the file, and moves it to fn
+        """
+        if self.sims is not None:
+            for start in range(0, len(self.dates), self.n_days_chunk):
+                self.write_days(self.sims[start:start+self.n_days_chunk])
+            self.sims = None
+            os.remove(self.spool_fn)
+        self.writer.close()
+        if self.n_days_written != len(self.dates):
+            os.remove(self.temp_fn)
+            raise ValueError('only '+str(self.n_days_written)+' of '+str(len(self.dates))+' days were written to '+self.fn)
+        os.replace(self.temp_fn, self.fn)
+
+    def abort(self):
+        """
+        discards a partially written ensemble
+        """
+        self.sims = None
+        self.writer.close()
+        for fn in [self.temp_fn, self.spool_fn]:
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+# dtype of the values of each tensor store encoding (None stores float32)
+encoding_dtypes = {None: np.float32, 'float16': np.float16, 'int16': np.int16}
+# int16 code of a missing value (NaN); the other 65535 codes are levels between the minimum and maximum of each day
+nan_code = -32768
+
+def encode_block(values, encoding):
+    """
+    encodes a (n_days_block, n_sims) block of simulations
+
+    Parameters
+    ----------
+    values : ndarray
+        (n_days_block, n_sims) array of simulations.
+    encoding : string or None
+        None (float32), 'float16', or 'int16' (quantized to 65535 levels between the minimum and maximum of each day,
+        ignoring NaN, which is stored as nan_code).
+
+    Returns
+    -------
+    codes : ndarray
+        encoded block.
+    scale : ndarray or None
+        size of one int16 level on each day (None unless int16).
+    offset : ndarray or None
+        value of the lowest int16 level on each day (None unless int16).
+
+    """
+    if encoding not in encoding_dtypes:
+        raise ValueError('unknown encoding '+str(encoding))
+    if encoding != 'int16':
+        with np.errstate(over='ignore'): # values out of float16 range become inf and fail the error check
+            return values.astype(encoding_dtypes[encoding]), None, None
+    values = np.asarray(values, dtype=float)
+    missing = np.isnan(values)
+    # minimum and maximum of each day ignoring NaN; days of only NaN get a scale and offset of 0
+    offset = np.min(np.where(missing, np.inf, values), axis=1, initial=np.inf)
+    top = np.max(np.where(missing, -np.inf, values), axis=1, initial=-np.inf)
+    empty = missing.all(axis=1)
+    offset[empty], top[empty] = 0., 0.
+    scale = (top - offset)/65534
+    levels = np.divide(values - offset[:, None], scale[:, None], out=np.zeros_like(values),
+                       where=(scale[:, None] > 0) & ~missing)
+    codes = (np.rint(levels) + nan_code + 1).astype(np.int16)
+    codes[missing] = nan_code
+    return codes, scale, offset
+
+def decode_block(codes, scale=None, offset=None):
+    """
+    decodes a block of encode_block; scale and offset are those of the rows of codes (or a single row's)
+    """
+    if scale is None:
+        return codes.astype(np.float32)
+    scale, offset = np.asarray(scale), np.asarray(offset)
+    shape = np.shape(scale) + (1,)*(np.ndim(codes) - np.ndim(scale)) # broadcast each day's scale along its simulations
+    decoded = (offset.reshape(shape) + (codes.astype(float) - nan_code - 1)*scale.reshape(shape)).astype(np.float32)
+    decoded[codes == nan_code] = np.nan
+    return decoded
+
+def encoding_error(values, decoded):
+    """
+    returns the largest absolute error and the largest error relative to a nonzero value of a decoded block; NaN
+    decoded as NaN has no error
+    """
+    values = np.asarray(values, dtype=float)
+    error = np.abs(decoded - values)
+    error[np.isnan(values) & np.isnan(decoded)] = 0.
+    nonzero = (values != 0) & ~np.isnan(values)
+    max_rel = float(np.max(error[nonzero]/np.abs(values[nonzero]))) if nonzero.any() else 0.
+    return float(np.max(error)) if error.size > 0 else 0., max_rel
+
+def store_fn(fn):
+    """
+    returns the file name of the tensor store form of an ensemble file (e.g., so2_SOCO_2006-2019.npy); its sidecar is
+    the same name plus .json
+    """
+    return os.path.splitext(fn)[0]+'.npy'
+
+class TensorWriter(object):
+
+    def __init__(self, fn, dates, n_sims, n_days_chunk=365, metadata=None, encoding=None, max_abs_error=None,
+                 max_rel_error=None):
+        """
+        writes an ensemble to a tensor store; same methods as EnsembleWriter. Blocks of days (write_days) or chunks of
+        simulations (write_sims, or filling spool directly) go straight into the memory map, and the store only appears
+        under fn once close succeeds. Encoded stores spool simulations to a float32 memory map and encode them block by
+        block on close, since the scale of each day is only known once all its simulations are written
+
+        Parameters
+        ----------
+        fn : string
+            file name of the store (.npy).
+        dates : array-like
+            date of each row of the ensemble.
+        n_sims : int
+            number of simulations (columns).
+        n_days_chunk : int, optional
+            number of days encoded at a time when converting spooled simulations. The default is 365.
+        metadata : dict, optional
+            json-safe information saved in the sidecar (e.g., seed or generator). The default is None.
+        encoding : string, optional
+            None (float32), 'float16', or 'int16' (per-day scale and offset); see encode_block. The default is None.
+        max_abs_error : float, optional
+            largest absolute error allowed by the encoding. The default is None (no absolute bound).
+        max_rel_error : float, optional
+            largest error allowed by the encoding relative to each value; a value passes if its error is within
+            max_abs_error + max_rel_error*|value| (as np.isclose). The default is None (no relative bound).
+
+        """
+        if encoding not in encoding_dtypes:
+            raise ValueError('unknown encoding '+str(encoding))
+        self.fn = fn
+        self.dates = pd.DatetimeIndex(pd.to_datetime(dates))
+        self.n_sims = n_sims
+        self.n_days_chunk = n_days_chunk
+        self.metadata = dict(metadata or {})
+        self.encoding = encoding
+        self.max_abs_error = max_abs_error
+        self.max_rel_error = max_rel_error
+        self.errors = (0., 0.) # largest absolute and relative error written so far
+        self.scale = np.zeros(len(self.dates)) # int16 scale and offset of each day
+        self.offset = np.zeros(len(self.dates))
+        self.temp_fn = os.path.splitext(fn)[0]+'.tmp.npy'
+        self.store = np.lib.format.open_memmap(self.temp_fn, mode='w+', dtype=encoding_dtypes[encoding],
+                                               shape=(len(self.dates), n_sims))
+        self.n_days_written = 0
+        self.spool_fn = os.path.splitext(fn)[0]+'.spool.npy'
+        self.sims = self.store if encoding is None else None # memory map that simulations are spooled to
+        self.spooled = False
+
+    def write_days(self, values):
+        """
+        appends the next values.shape[0] days of every simulation
+        """
+        start = self.n_days_written
+        stop = start + values.shape[0]
+        if stop > len(self.dates) or values.shape[1] != self.n_sims:
+            raise ValueError('block of shape '+str(values.shape)+' does not fit ensemble of '+str(len(self.dates))+
+                             ' days and '+str(self.n_sims)+' simulations after '+str(start)+' days')
+        if self.encoding is None:
+            self.store[start:stop] = values
+        else: # encode and check the error before anything is stored
+            codes, scale, offset = encode_block(values, self.encoding)
+            decoded = decode_block(codes, scale, offset)
+            tolerance = (self.max_abs_error or 0.) + (self.max_rel_error or 0.)*np.abs(np.asarray(values, dtype=float))
+            # NaN must decode as NaN (as np.isclose with equal_nan)
+            within = np.all((np.abs(decoded - values) <= tolerance) | (np.isnan(values) & np.isnan(decoded)), axis=1)
+            if (self.max_abs_error is not None or self.max_rel_error is not None) and not within.all():
+                day = start + np.flatnonzero(~within)[0]
+                raise ValueError(self.encoding+' encoding of '+self.fn+' exceeds the maximum error (absolute '+
+                                 str(self.max_abs_error)+', relative '+str(self.max_rel_error)+') on '+
+                                 str(self.dates[day].date()))
+            errors = encoding_error(values, decoded)
+            self.errors = (max(self.errors[0], errors[0]), max(self.errors[1], errors[1]))
+            self.store[start:stop] = codes
+            if scale is not None:
+                self.scale[start:stop], self.offset[start:stop] = scale, offset
+        self.n_days_written = stop
+
+    def spool(self):
+        """
+        returns the (n_days, n_sims) float32 memory map that simulations are spooled to (the store itself unless it is
+        encoded); can be filled directly
+        """
+        if self.sims is None:
+            self.sims = np.lib.format.open_memmap(self.spool_fn, mode='w+', dtype=np.float32,
+                                                  shape=(len(self.dates), self.n_sims))
+        self.spooled = True
+        return self.sims
+
+    def write_sims(self, start, stop, values):
+        """
+        writes simulations start through stop-1 of every day
+        """
+        self.spool()[:, start:stop] = values
+
+    def close(self):
+        """
+        finishes the store and its sidecar and moves them to fn
+        """
+        if self.spooled and self.encoding is None: # every day was filled through the memory map
+            self.n_days_written = len(self.dates)
+        elif self.spooled: # encode spooled simulations
+            try:
+                for start in range(0, len(self.dates), self.n_days_chunk):
+                    self.write_days(self.sims[start:start+self.n_days_chunk])
+            except ValueError:
+                self.abort()
+                raise
+            self.sims = None
+            os.remove(self.spool_fn)
+        self.store.flush()
+        self.sims = self.store = None
+        if self.n_days_written != len(self.dates):
+            os.remove(self.temp_fn)
+            raise ValueError('only '+str(self.n_days_written)+' of '+str(len(self.dates))+' days were written to '+self.fn)
+        sidecar = {'dates': [str(date.date()) for date in self.dates], 'n_sims': self.n_sims, 'metadata': self.metadata}
+        if self.encoding is not None: # bounds and largest errors of the encoding
+            sidecar['metadata'] = dict(self.metadata, encoding={'name': self.encoding,
+                                                                'max_abs_error': self.max_abs_error,
+                                                                'max_rel_error': self.max_rel_error,
+                                                                'abs_error': self.errors[0],
+                                                                'rel_error': self.errors[1]})
+        if self.encoding == 'int16':
+            sidecar['scale'], sidecar['offset'] = self.scale.tolist(), self.offset.tolist()
+        with open(self.temp_fn+'.json', 'w') as f:
+            json.dump(sidecar, f)
+        os.replace(self.temp_fn, self.fn)
+        os.replace(self.temp_fn+'.json', self.fn+'.json')
+
+    def abort(self):
+        """
+        discards a partially written store
+        """
+        self.sims = self.store = None
+        for fn in [self.temp_fn, self.temp_fn+'.json', self.spool_fn]:
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+class EnsembleStore(object):
+
+    def __init__(self, fn):
+        """
+        read-only tensor store opened as a memory map; indexes like the (n_days, n_sims) array of the ensemble (slices
+        are views of the file, or float32 copies decoded from an encoded store) and has the Date index and simulation
+        column names of an ensemble dataframe. Pickles as its file name, so worker processes open the same file
+
+        Parameters
+        ----------
+        fn : string
+            file name of the store (.npy).
+
+        """
+        self.fn = os.path.abspath(fn)
+        with open(self.fn+'.json') as f:
+            sidecar = json.load(f)
+        self.values = np.load(self.fn, mmap_mode='r')
+        self.index = pd.DatetimeIndex(pd.to_datetime(sidecar['dates']), name='Date')
+        self.columns = pd.Index(['column_' + str(i) for i in range(0, sidecar['n_sims'])])
+        self.metadata = sidecar['metadata']
+        self.encoding = self.metadata['encoding']['name'] if 'encoding' in self.metadata else None
+        self.scale = np.asarray(sidecar['scale']) if self.encoding == 'int16' else None
+        self.offset = np.asarray(sidecar['offset']) if self.encoding == 'int16' else None
+        self.shape = self.values.shape
+        if self.shape != (len(self.index), len(self.columns)):
+            raise ValueError(fn+' has shape '+str(self.shape)+' but its sidecar has '+str(len(self.index))+' days and '+
+                             str(len(self.columns))+' simulations')
+
+    def __getitem__(self, key):
+        if self.encoding is None:
+            return self.values[key]
+        if self.encoding == 'float16':
+            return decode_block(self.values[key])
+        days = np.arange(self.shape[0])[key[0] if isinstance(key, tuple) else key]
+        return decode_block(self.values[key], self.scale[days], self.offset[days])
+
+    def fingerprint(self):
+        """
+        returns a hash of the stored values and their dates and scales, for MC_checkpoint.hash_inputs
+        """
+        return hash_inputs(self.values, self.index.asi8, self.scale, self.offset)
+
+    def to_numpy(self):
+        """
+        returns every simulation of every day (the memory map itself unless the store is encoded)
+        """
+        return self.values if self.encoding is None else self[:, :]
+
+    def __getstate__(self):
+        return {'fn': self.fn}
+
+    def __setstate__(self, state):
+        self.__init__(state['fn'])
+
+def open_writer(fn, dates, n_sims, ensemble_format='parquet', n_days_chunk=365, metadata=None, encoding=None,
+                max_abs_error=None, max_rel_error=None):
+    """
+    returns an EnsembleWriter of fn ('parquet') or a TensorWriter of store_fn(fn) ('tensor'); only tensor stores can be
+    encoded (see TensorWriter)
+    """
+    if ensemble_format == 'parquet':
+        if encoding is not None:
+            raise ValueError('encoding '+str(encoding)+' needs ensemble_format tensor')
+        return EnsembleWriter(fn, dates, n_sims, n_days_chunk)
+    if ensemble_format == 'tensor':
+        return TensorWriter(store_fn(fn), dates, n_sims, n_days_chunk, metadata, encoding, max_abs_error,
+                            max_rel_error)
+    raise ValueError('unknown ensemble format '+str(ensemble_format))
+
+def write_ensemble(values, dates, fn, n_days_chunk=365, ensemble_format='parquet', encoding=None, max_abs_error=None,
+                   max_rel_error=None):
+    """
+    writes a (n_days, n_sims) array already in memory (or memory mapped) as an ensemble, one row group per n_days_chunk days,
+    without building a dataframe of the whole ensemble (or to the tensor store of fn)
+
+    Parameters
+    ----------
+    values : ndarray
+        (n_days, n_sims) array of simulations.
+    dates : array-like
+        date of each row of values.
+    fn : string
+        file name of the output parquet.
+    n_days_chunk : int, optional
+        number of days per row group. The default is 365.
+    ensemble_format : string, optional
+        'parquet' or 'tensor' (written to store_fn(fn)). The default is 'parquet'.
+    encoding, max_abs_error, max_rel_error : optional
+        compact encoding of a tensor store and its error bounds; see TensorWriter. The defaults are None.
+
+    Returns
+    -------
+    None.
+
+    """
+    with open_writer(fn, dates, values.shape[1], ensemble_format, n_days_chunk, encoding=encoding,
+                     max_abs_error=max_abs_error, max_rel_error=max_rel_error) as writer:
+        for start in range(0, values.shape[0], n_days_chunk):
+            writer.write_days(values[start:start+n_days_chunk])
@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 12:02:31 2026
+
+runs Monte Carlo propagation of emissions to air pollutants across a process pool
+work is sharded by (site, target, simulation chunk); feature matrices, emissions ensembles, and outputs live in shared
+    memory so workers attach to them instead of receiving pickled copies
+only a few jobs run at once and each job's output is allocated when it starts and freed once it is written, so shared
+    memory holds a bounded number of (n_days, n_sims) outputs however many jobs there are
+
+@author: emei3
+"""
+
+## imports
+import os
+import sys
+import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from MC_propagation import predict_stacked, chunk_seed, insert_aligned, perturb_lognormal
+from XGBoost_inference import PrunedPredictor
+from XGBoost_compiled import compile_predictor
+from MC_summary import QuantileSketch
+from MC_sampling import draw_normal
+from MC_checkpoint import hash_inputs
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../2. Models'))
+from XGBoost_registry import load_model
+
+class SharedArray(object):
+
+    def __init__(self, array=None, shape=None, dtype=np.float64):
+        """
+        numpy array stored in multiprocessing shared memory. Copies array in if given, otherwise allocates zeros
+        of shape and dtype. Pickles as the name of the memory block, so workers attach to it without copying
+
+        """
+        if array is not None:
+            array = np.ascontiguousarray(array)
+            shape, dtype = array.shape, array.dtype
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(self.shape))*self.dtype.itemsize, 1))
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+        if array is not None:
+            self.array[:] = array
+        else:
+            self.array[:] = 0
+
+    def __getstate__(self):
+        return {'name': self.shm.name, 'shape': self.shape, 'dtype': self.dtype}
+
+    def __setstate__(self, state):
+        self.shape = state['shape']
+        self.dtype = state['dtype']
+        self.shm = shared_memory.SharedMemory(name=state['name'])
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    def close(self):
+        """
+        detaches a worker from the shared memory without freeing it
+        """
+        self.array = None
+        self.shm.close()
+
+    def unlink(self):
+        """
+        frees the shared memory; only call from the process that created it, once workers are done
+        """
+        self.array = None
+        self.shm.close()
+        self.shm.unlink()
+
+class PropagationJob(object):
+
+    def __init__(self, name, model_dir, model_name, feature_names, X_base, n_sims, perturbed_cols, perturbed_sigmas,
+                 replacements=None, impacts=None, use_pruned_trees=True, use_compiled_model=False, checkpoint=None,
+                 sketch_size=None, seed=None, convergence=None, sampler='random'):
+        """
+        everything a worker needs to run simulations of one site and target
+
+        Parameters
+        ----------
+        name : string
+            label of the job (e.g., site_target).
+        model_dir : string
+            absolute path of the folder of the fitted model.
+        model_name : string
+            name of the fitted model in the registry (e.g., site_target).
+        feature_names : list
+            feature names in the order the model was fit with.
+        X_base : ndarray
+            (n_days, n_features) observed features; copied into shared memory.
+        n_sims : int
+            number of simulations.
+        perturbed_cols : ndarray
+            positions of perturbed features (from resolve_perturbed_columns).
+        perturbed_sigmas : ndarray
+            log normal sigma of each perturbed feature (from resolve_perturbed_columns).
+        replacements : list, optional
+            (feature name, SharedArray of ensemble values or MC_ensemble.VirtualEnsemble, row index from align_dates) for
+            every feature replaced by Monte Carlo emissions. The default is None.
+        impacts : list, optional
+            (feature name, impact median, impact std, row index from align_dates) for every feature that has a gaussian
+            impact added to it. The default is None.
+        use_pruned_trees : bool, optional
+            whether to only evaluate trees that split on varying features. The default is True.
+        use_compiled_model : bool, optional
+            whether to predict with a native library built by XGBoost_compiled (falls back to xgboost if it cannot be
+            built or does not match). The default is False.
+        checkpoint : MC_checkpoint.Checkpoint, optional
+            saves each finished chunk and skips chunks finished by an earlier run. The default is None.
+        sketch_size : int, optional
+            only keep a per-day MC_summary.QuantileSketch with this k instead of the full output; each chunk is
+            sketched in its worker and merged in order of simulations. The default is None (full output, allocated in
+            shared memory by run_parallel when the job starts).
+        seed : numpy SeedSequence, optional
+            seed of this job's stream (e.g., from MC_random.stream_seed); every chunk gets an independent stream spawned
+            from it. The default is None (spawned from run_parallel's seed by the job's position).
+        convergence : MC_summary.ConvergenceCheck, optional
+            stops the job early once its simulations have converged; checked in the main process after each chunk, in
+            order of simulations, so it stops where a serial run would. n_sims_done is then the number of simulations
+            kept. The default is None (all n_sims simulations).
+        sampler : string, optional
+            sampler of the impact and perturbation draws of each chunk (see MC_sampling). The default is 'random'.
+
+        """
+        self.name = name
+        self.model_dir = model_dir
+        self.model_name = model_name
+        self.feature_names = list(feature_names)
+        self.X_base = SharedArray(np.asarray(X_base, dtype=np.float64))
+        self.n_sims = n_sims
+        self.perturbed_cols = perturbed_cols
+        self.perturbed_sigmas = perturbed_sigmas
+        self.replacements = [(self.feature_names.index(feature), values, row_index)
+                             for feature, values, row_index in (replacements or [])]
+        self.impacts = [(self.feature_names.index(feature), np.asarray(median), np.asarray(std), row_index)
+                        for feature, median, std, row_index in (impacts or [])]
+        self.use_pruned_trees = use_pruned_trees
+        self.use_compiled_model = use_compiled_model
+        self.checkpoint = checkpoint
+        self.seed = seed
+        self.convergence = convergence
+        self.sampler = sampler
+        self.n_sims_done = n_sims # simulations in the output (fewer if convergence stopped the job)
+        self.output = None # SharedArray of the full output while the job runs
+        self.sketch = None
+        if sketch_size is not None: # summary only
+            self.sketch = QuantileSketch(self.X_base.shape[0], sketch_size)
+
+    def open_output(self):
+        """
+        allocates the full output in shared memory when the job starts (summary-only jobs have none)
+        """
+        if self.sketch is None and self.output is None:
+            self.output = SharedArray(shape=(self.X_base.shape[0], self.n_sims)) # pre-allocate pollutant concentration
+
+    def free_output(self):
+        """
+        frees the full output once it has been written
+        """
+        if self.output is not None:
+            self.output.unlink()
+            self.output = None
+
+    def fingerprint(self):
+        """
+        returns the MC_checkpoint.hash_inputs of everything the job's simulations depend on besides its seed; the same as
+        a serial run given the same inputs
+        """
+        replacements = [(col, values.array if isinstance(values, SharedArray) else values, row_index)
+                        for col, values, row_index in self.replacements]
+        return hash_inputs(self.sampler, self.feature_names, self.perturbed_cols, self.perturbed_sigmas, self.X_base.array,
+                           replacements, self.impacts)
+
+    def varying_features(self):
+        """
+        returns the features that change between simulations
+        """
+        cols = [col for col, _, _ in self.replacements] + [col for col, _, _, _ in self.impacts] + list(self.perturbed_cols)
+        return [self.feature_names[col] for col in cols]
+
+    def fill_chunk(self, start, stop, X_chunk, rng):
+        """
+        fills X_chunk with the features of simulations start through stop-1, drawing random numbers from rng
+
+        Returns
+        -------
+        None.
+
+        """
+        X_base = self.X_base.array
+        X_chunk[:] = X_base # start every monte carlo run from observed features
+        # replace observed emissions with monte carlo simulated
+        for col, values, row_index in self.replacements:
+            insert_aligned(X_chunk, col, values.array if isinstance(values, SharedArray) else values, row_index, start, stop)
+        # add gaussian impacts to observed emissions
+        for col, median, std, row_index in self.impacts:
+            impact_mc = draw_normal(rng, median, std, stop-start, self.sampler)
+            X_chunk[:, :, col] = X_base[:, col] + impact_mc[:, row_index]
+        # perturb mobile and other emissions
+        perturb_lognormal(X_chunk, X_base, self.perturbed_cols, self.perturbed_sigmas, rng, sampler=self.sampler)
+
+    def unlink(self):
+        """
+        frees the shared memory owned by this job (not the ensembles, which may be shared between jobs)
+        """
+        self.X_base.unlink()
+        self.free_output()
+
+# state of each worker process
+_worker = dict()
+
+def _init_worker(jobs, nthread):
+    """
+    stores the jobs in the worker; models are pinned to nthread threads when they are loaded
+    """
+    for job in jobs: # outputs come with each task; do not keep ones allocated before this worker started mapped
+        if job.output is not None:
+            job.output.close()
+            job.output = None
+    _worker['jobs'] = jobs
+    _worker['nthread'] = nthread
+    _worker['predictors'] = dict() # models are loaded once per worker
+
+def _get_predictor(job_id):
+    """
+    loads the model of job_id the first time this worker needs it
+    """
+    if job_id not in _worker['predictors']:
+        job = _worker['jobs'][job_id]
+        regressor = load_model(job.model_dir, job.model_name)
+        regressor.set_params(n_jobs=_worker['nthread'])
+        predictor = regressor
+        if job.use_pruned_trees:
+            predictor = PrunedPredictor(regressor, job.feature_names, job.varying_features(), job.X_base.array,
+                                        nthread=_worker['nthread'])
+        if job.use_compiled_model:
+            predictor = compile_predictor(predictor, job.feature_names, job.X_base.array, nthread=_worker['nthread'])
+        _worker['predictors'][job_id] = predictor
+    return _worker['predictors'][job_id]
+
+def _run_task(job_id, start, stop, seed, output):
+    """
+    runs simulations start through stop-1 of one job and writes them into its shared output (allocated after the
+    workers started, so passed with each task), or returns a sketch of them for summary-only jobs
+    """
+    job = _worker['jobs'][job_id]
+    predictor = _get_predictor(job_id)
+    rng = np.random.default_rng(seed)
+    n_days = job.X_base.shape[0]
+    X_chunk = np.empty((stop-start, n_days, len(job.feature_names)), dtype=np.float32)
+    job.fill_chunk(start, stop, X_chunk, rng)
+    y_chunk = predict_stacked(predictor, X_chunk, job.feature_names, n_days)
+    if job.checkpoint is not None:
+        job.checkpoint.write_chunk(start, stop, y_chunk)
+    if job.sketch is None:
+        output.array[:, start:stop] = y_chunk
+        output.close() # the main process frees it once the job is written
+        return None
+    sketch = QuantileSketch(n_days, job.sketch.k, job.sketch.quantiles)
+    sketch.update(y_chunk)
+    return sketch
+
+def run_parallel(jobs, n_workers=None, n_sims_chunk=250, nthread=1, seed=None, n_jobs_open=2, on_finish=None):
+    """
+    runs every job's simulations across a process pool and fills each job's output (or sketch). Jobs start in order,
+    at most n_jobs_open at a time, and each job's output is only allocated when it starts
+
+    Parameters
+    ----------
+    jobs : list
+        PropagationJob for each site and target.
+    n_workers : int, optional
+        number of worker processes. The default is None (number of cores divided by nthread).
+    n_sims_chunk : int, optional
+        number of simulations per task. The default is 250.
+    nthread : int, optional
+        xgboost threads per worker; n_workers*nthread should not exceed the number of cores. The default is 1.
+    seed : int or numpy SeedSequence, optional
+        master seed; job j without a seed of its own gets the same seed as the j-th serial propagate_batched call given
+        chunk_seed(seed, j), and every chunk an independent stream spawned from its job's seed. The default is None (random).
+    n_jobs_open : int, optional
+        number of jobs run at once, i.e., of full outputs in shared memory; raise it if jobs have fewer chunks than
+        there are workers. The default is 2.
+    on_finish : function, optional
+        called as on_finish(job) in the main process as soon as all of a job's chunks are done, e.g., to write its
+        output; the job's output is freed right after. The default is None (outputs are kept until job.unlink).
+
+    Returns
+    -------
+    None.
+
+    """
+    if n_workers is None:
+        n_workers = max(os.cpu_count() // nthread, 1)
+    seed_seq = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    
+    # finished chunks waiting for the chunks before them; sketches are merged and convergence is checked in order of
+    # simulations so results do not depend on which worker finishes first
+    pending = [dict() for job in jobs]
+    next_start = [0]*len(jobs)
+    stopped = [False]*len(jobs) # jobs stopped early by their convergence
+    def merge_pending(job_id):
+        job = jobs[job_id]
+        while next_start[job_id] in pending[job_id] and not stopped[job_id]:
+            start, chunk = next_start[job_id], pending[job_id].pop(next_start[job_id])
+            if isinstance(chunk, QuantileSketch):
+                job.sketch.merge(chunk)
+            elif job.sketch is not None:
+                job.sketch.update(chunk)
+            next_start[job_id] = min(start + n_sims_chunk, job.n_sims)
+            if job.convergence is not None and job.convergence(job.output.array if job.sketch is None else job.sketch,
+                                                               next_start[job_id]):
+                job.n_sims_done = next_start[job_id]
+                stopped[job_id] = True
+    
+    def open_job(job_id):
+        """
+        allocates a job's output and splits it into chunks of simulations, skipping chunks finished by an earlier run
+        """
+        job = jobs[job_id]
+        job.open_output()
+        job_seed = chunk_seed(seed_seq, job_id) if job.seed is None else job.seed
+        if job.checkpoint is not None:
+            job_seed = job.checkpoint.start(job.X_base.shape[0], job.n_sims, n_sims_chunk, job_seed,
+                                            job.fingerprint()) # raises if the seed or inputs changed
+        tasks = []
+        for chunk_index, start in enumerate(range(0, job.n_sims, n_sims_chunk)):
+            stop = min(start + n_sims_chunk, job.n_sims)
+            if job.checkpoint is not None and job.checkpoint.is_complete(start, stop):
+                if job.sketch is None:
+                    job.output.array[:, start:stop] = job.checkpoint.load_chunk(start, stop)
+                    pending[job_id][start] = None
+                else:
+                    pending[job_id][start] = job.checkpoint.load_chunk(start, stop)
+                merge_pending(job_id)
+                continue
+            if not stopped[job_id]:
+                tasks.append((job_id, start, stop, chunk_seed(job_seed, chunk_index), job.output))
+        return tasks
+    
+    def finish_job(job_id):
+        """
+        hands a job whose chunks are all done to on_finish and frees its output
+        """
+        if on_finish is not None:
+            on_finish(jobs[job_id])
+            jobs[job_id].free_output()
+    
+    ## run chunks of at most n_jobs_open jobs at a time
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(jobs, nthread)) as pool:
+        running = dict() # future to its task
+        n_running = [0]*len(jobs) # chunks of each job submitted and not yet done
+        next_job = 0
+        n_open = 0
+        while next_job < len(jobs) or len(running) > 0:
+            while next_job < len(jobs) and n_open < n_jobs_open:
+                for task in open_job(next_job):
+                    running[pool.submit(_run_task, *task)] = task
+                    n_running[next_job] += 1
+                if n_running[next_job] == 0: # every chunk was checkpointed
+                    finish_job(next_job)
+                else:
+                    n_open += 1
+                next_job += 1
+            if len(running) == 0:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job_id, start, stop, _, _ = running.pop(future)
+                n_running[job_id] -= 1
+                if not future.cancelled(): # cancelled chunks belong to a job that had already converged
+                    sketch = future.result() # raise any error from the workers
+                    if jobs[job_id].checkpoint is not None: # only the main process writes manifests
+                        jobs[job_id].checkpoint.mark_complete(start, stop)
+                    if not stopped[job_id]:
+                        pending[job_id][start] = sketch
+                        merge_pending(job_id)
+                        if stopped[job_id]: # drop the job's chunks that have not started
+                            for other, task in running.items():
+                                if task[0] == job_id:
+                                    other.cancel()
+                if n_running[job_id] == 0: # all chunks of the job are done
+                    finish_job(job_id)
+                    n_open -= 1
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 11:52:55 2026
+
+shared functions to push Monte Carlo feature sets through fitted ML models
+simulations are stacked into one (n_days x n_sims_chunk, n_features) matrix so the model is called once per chunk
+    instead of once per simulation
+
+@author: emei3
+"""
+
+import numpy as np
+import pandas as pd
+from MC_sampling import standard_normals
+
+# sigmas of the log normal distributions used to perturb mobile and other emissions (Hanna et al. 2001)
+perturbation_sigmas = {'mobile': 0.347, 'other': 0.203}
+
+def predict_stacked(regressor, X_stacked, feature_names, n_days):
+    """
+    runs a single prediction over a stacked feature matrix and reshapes the output so that each column is one simulation
+
+    Parameters
+    ----------
+    regressor : XGBoost model
+        fitted model.
+    X_stacked : ndarray
+        (n_sims_chunk, n_days, n_features) or (n_sims_chunk*n_days, n_features) array; simulations are stacked
+        one after another (all days of simulation 0, then all days of simulation 1, etc.).
+    feature_names : list
+        feature names in the order the model was fit with.
+    n_days : int
+        number of days in each simulation.
+
+    Returns
+    -------
+    y : ndarray
+        (n_days, n_sims_chunk) array of predictions.
+
+    """
+    X_stacked = X_stacked.reshape(-1, len(feature_names))
+    X_stacked = pd.DataFrame(X_stacked, columns=feature_names, copy=False) # keep feature names so xgboost can validate them
+    y = regressor.predict(X_stacked)
+    return y.reshape(-1, n_days).T
+
+def chunk_seed(seed_seq, index):
+    """
+    returns the seed of one job or chunk of simulations under seed_seq; it only depends on seed_seq and index, so
+    chunks get the same random numbers however they are scheduled (serial, parallel, or resumed)
+    """
+    return np.random.SeedSequence(seed_seq.entropy, spawn_key=tuple(seed_seq.spawn_key) + (index,))
+
+def propagate_batched(regressor, fill_chunk, n_days, feature_names, n_sims, n_sims_chunk=250, seed=None, checkpoint=None,
+                      out=None, converged=None, fingerprint=None):
+    """
+    pushes n_sims Monte Carlo simulations through regressor in chunks of n_sims_chunk simulations per predict call, or
+    fewer if converged stops the run early
+
+    Parameters
+    ----------
+    regressor : XGBoost model
+        fitted model, or any predictor with the same predict method (e.g., XGBoost_inference.PrunedPredictor).
+    fill_chunk : function
+        called as fill_chunk(start, stop, X_chunk, rng); must fill the float32 array X_chunk of shape
+        (stop-start, n_days, n_features) with the features of simulations start through stop-1, drawing any random
+        numbers from the numpy Generator rng.
+    n_days : int
+        number of days in each simulation.
+    feature_names : list
+        feature names in the order the model was fit with.
+    n_sims : int
+        total number of simulations.
+    n_sims_chunk : int, optional
+        number of simulations stacked into each predict call. The default is 250.
+    seed : int or numpy SeedSequence, optional
+        seed of this run; each chunk gets an independent stream spawned from it. The default is None (random).
+    checkpoint : MC_checkpoint.Checkpoint, optional
+        saves each finished chunk and skips chunks finished by an earlier run with the same seed and fingerprint. The
+        default is None.
+    out : ndarray or object, optional
+        (n_days, n_sims) array to write predictions into, e.g., a memory map from MC_output.EnsembleWriter.spool so the
+        ensemble is never fully in memory, or an object whose write_sims(start, stop, values) receives each chunk instead
+        (e.g., MC_summary.QuantileSketch for summary-only runs). The default is None (allocated in memory).
+    converged : function, optional
+        called as converged(y_mc, stop) after each chunk, with the first stop simulations done; returns True to stop
+        (e.g., MC_summary.ConvergenceCheck). The default is None (all n_sims simulations).
+    fingerprint : string, optional
+        MC_checkpoint.hash_inputs of the inputs fill_chunk draws from, which a checkpoint must match to be resumed. The
+        default is None.
+
+    Returns
+    -------
+    y_mc : ndarray or object
+        (n_days, n_sims) array of predictions (out if given); only the simulations run if converged stopped early.
+
+    """
+    seed_seq = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    if checkpoint is not None:
+        seed_seq = checkpoint.start(n_days, n_sims, n_sims_chunk, seed_seq, fingerprint) # raises if inputs changed
+    
+    y_mc = np.zeros((n_days, n_sims)) if out is None else out # pre-allocate pollutant concentration
+    write_sims = None if isinstance(y_mc, np.ndarray) else y_mc.write_sims # chunks go to out instead of an array
+    X_buffer = np.empty((min(n_sims_chunk, n_sims), n_days, len(feature_names)), dtype=np.float32) # reused for every chunk
+    for chunk_index, start in enumerate(range(0, n_sims, n_sims_chunk)):
+        stop = min(start + n_sims_chunk, n_sims)
+        if checkpoint is not None and checkpoint.is_complete(start, stop): # finished by an earlier run
+            y_chunk = checkpoint.load_chunk(start, stop)
+        else:
+            X_chunk = X_buffer[:stop-start]
+            fill_chunk(start, stop, X_chunk, np.random.default_rng(chunk_seed(seed_seq, chunk_index)))
+            y_chunk = predict_stacked(regressor, X_chunk, feature_names, n_days)
+            if checkpoint is not None:
+                checkpoint.save_chunk(start, stop, y_chunk)
+        if write_sims is None:
+            y_mc[:, start:stop] = y_chunk
+        else:
+            write_sims(start, stop, y_chunk)
+        if converged is not None and converged(y_mc, stop): # precise enough
+            return y_mc[:, :stop] if write_sims is None else y_mc
+    return y_mc
+
+def align_dates(feature_dates, ensemble_dates):
+    """
+    finds, for each row of the feature dataset, the row of an ensemble (or impact) dataframe with the same date
+    meant to be run once per site so simulations can be inserted by indexing instead of merging on Date
+
+    Parameters
+    ----------
+    feature_dates : array-like
+        Date column of the feature dataset.
+    ensemble_dates : array-like
+        Date index (or column) of the ensemble dataframe; must be unique.
+
+    Returns
+    -------
+    row_index : ndarray
+        integer row of the ensemble for each feature row; -1 where the date is not in the ensemble.
+
+    """
+    ensemble_dates = pd.DatetimeIndex(pd.to_datetime(ensemble_dates))
+    return ensemble_dates.get_indexer(pd.to_datetime(feature_dates))
+
+def take_aligned(ensemble_values, row_index, start=0, stop=None):
+    """
+    returns simulations start through stop-1 of an ensemble lined up with the feature dates
+    days missing from the ensemble are set to nan, the same as a left merge on Date
+
+    Parameters
+    ----------
+    ensemble_values : ndarray
+        (n_ensemble_days, n_sims) array of simulated emissions.
+    row_index : ndarray
+        output of align_dates for this feature dataset and ensemble.
+    start : int, optional
+        first simulation to take. The default is 0.
+    stop : int, optional
+        one past the last simulation to take. The default is None (all simulations).
+
+    Returns
+    -------
+    values : ndarray
+        (n_days, stop-start) array.
+
+    """
+    values = ensemble_values[row_index, start:stop]
+    values[row_index < 0, :] = np.nan # days not in ensemble
+    return values
+
+def insert_aligned(X_chunk, feature_col, ensemble_values, row_index, start, stop):
+    """
+    writes simulations start through stop-1 of an ensemble into one feature column of a stacked chunk
+
+    Parameters
+    ----------
+    X_chunk : ndarray
+        (stop-start, n_days, n_features) array to insert into.
+    feature_col : int
+        position of the feature to replace.
+    ensemble_values : ndarray
+        (n_ensemble_days, n_sims) array of simulated emissions.
+    row_index : ndarray
+        output of align_dates for this feature dataset and ensemble.
+    start : int
+        first simulation to insert.
+    stop : int
+        one past the last simulation to insert.
+
+    Returns
+    -------
+    None.
+
+    """
+    X_chunk[:, :, feature_col] = take_aligned(ensemble_values, row_index, start, stop).T
+
+def resolve_perturbed_columns(feature_names, sigmas=perturbation_sigmas):
+    """
+    finds the feature columns that are perturbed and the log normal sigma of each; run once per model
+    a column that matches more than one group is perturbed by all of them, i.e., with the root sum of squares of their sigmas
+
+    Parameters
+    ----------
+    feature_names : list
+        feature names in the order the model was fit with.
+    sigmas : dict, optional
+        log normal sigma for each substring to match in feature names. The default is perturbation_sigmas.
+
+    Returns
+    -------
+    perturbed_cols : ndarray
+        positions of the perturbed features.
+    perturbed_sigmas : ndarray
+        log normal sigma of each perturbed feature, parallel to perturbed_cols.
+
+    """
+    perturbed_cols = []
+    perturbed_sigmas = []
+    for col, feature in enumerate(feature_names):
+        variance = sum(sigma**2 for group, sigma in sigmas.items() if group in feature)
+        if variance > 0:
+            perturbed_cols.append(col)
+            perturbed_sigmas.append(np.sqrt(variance))
+    return np.array(perturbed_cols, dtype=int), np.array(perturbed_sigmas)
+
+def draw_lognormal_factors(n_sims_chunk, n_days, perturbed_sigmas, rng=np.random, sampler='random'):
+    """
+    draws the (n_sims_chunk, n_days, n_cols) log normal factors (median 1) that perturb_lognormal scales the observed
+    values by; drawn once per chunk they can be shared by several scenarios (common random numbers). Any sampler
+    but 'random' (see MC_sampling) needs a numpy Generator
+    """
+    if sampler == 'random':
+        return rng.lognormal(mean=0.0, sigma=perturbed_sigmas, size=(n_sims_chunk, n_days, len(perturbed_sigmas)))
+    return np.exp(perturbed_sigmas*standard_normals(rng, n_sims_chunk, n_days, len(perturbed_sigmas), sampler))
+
+def perturb_lognormal(X_chunk, base_values, perturbed_cols, perturbed_sigmas, rng=np.random, factors=None,
+                      sampler='random'):
+    """
+    randomly redistributes the perturbed columns of every simulation in X_chunk, in place, with log normal distributions
+    about the observed values. All (n_sims_chunk, n_days, n_cols) factors are drawn in one call
+
+    Parameters
+    ----------
+    X_chunk : ndarray
+        (n_sims_chunk, n_days, n_features) array to perturb.
+    base_values : ndarray
+        (n_days, n_features) observed features that the distributions are centered on (median).
+    perturbed_cols : ndarray
+        positions of the perturbed features (from resolve_perturbed_columns).
+    perturbed_sigmas : ndarray
+        log normal sigma of each perturbed feature (from resolve_perturbed_columns).
+    rng : numpy Generator or RandomState, optional
+        source of random numbers. The default is the global numpy random state.
+    factors : ndarray, optional
+        factors from draw_lognormal_factors to use instead of drawing new ones; left unchanged. The default is None.
+    sampler : string, optional
+        sampler of the factors (see MC_sampling). The default is 'random'.
+
+    Returns
+    -------
+    None.
+
+    """
+    if len(perturbed_cols) == 0:
+        return
+    if factors is not None: # shared factors
+        X_chunk[:, :, perturbed_cols] = factors * base_values[:, perturbed_cols]
+        return
+    n_sims_chunk, n_days = X_chunk.shape[:2]
+    # lognormal(mean=log(x), sigma) is x*lognormal(mean=0, sigma)
+    factors = draw_lognormal_factors(n_sims_chunk, n_days, perturbed_sigmas, rng, sampler)
+    factors *= base_values[:, perturbed_cols]
+    X_chunk[:, :, perturbed_cols] = factors
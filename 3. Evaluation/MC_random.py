@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 12:37:23 2026
+
+named random number streams for every Monte Carlo stage (c4, d3, e1, e8, e9, e10)
+every stream is spawned from one master seed by its key (stage, region, species, site, target) and, within a stream, by
+    chunk, so any chunk can be regenerated on any worker, in any order, with bit-identical random numbers; adding or
+    removing sites, targets, or regions does not change the random numbers of the others
+the master seed of each run is recorded so the run can be reproduced
+
+@author: emei3
+"""
+
+## imports
+import os
+import hashlib
+import json
+import numpy as np
+from MC_propagation import chunk_seed
+
+# levels of a stream key, in order
+key_levels = ['stage', 'region', 'species', 'site', 'target']
+
+def seed_to_json(seed_seq):
+    """
+    returns a SeedSequence as a json-safe dict; entropy is kept as strings since it may be too large for a json int
+    """
+    entropy = seed_seq.entropy
+    entropy = str(entropy) if np.ndim(entropy) == 0 else [str(value) for value in entropy]
+    return {'entropy': entropy, 'spawn_key': [int(value) for value in seed_seq.spawn_key]}
+
+def seed_from_json(saved):
+    """
+    returns the SeedSequence of a dict from seed_to_json
+    """
+    entropy = saved['entropy']
+    entropy = int(entropy) if isinstance(entropy, str) else [int(value) for value in entropy]
+    return np.random.SeedSequence(entropy, spawn_key=tuple(saved['spawn_key']))
+
+def master_seed(seed=None):
+    """
+    returns the master SeedSequence of a run
+
+    Parameters
+    ----------
+    seed : int, numpy SeedSequence, or string, optional
+        seed, or file name of a seed recorded by record_seed. The default is None (new random seed).
+
+    Returns
+    -------
+    seed_seq : numpy SeedSequence
+
+    """
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    if isinstance(seed, str): # recorded seed of an earlier run
+        with open(seed) as f:
+            return seed_from_json(json.load(f))
+    return np.random.SeedSequence(seed)
+
+def record_seed(seed_seq, fn):
+    """
+    writes the master seed of a run to a json file that master_seed can read back; written atomically so a crash
+    never leaves it half written
+    """
+    temp_fn = fn+'.tmp'
+    with open(temp_fn, 'w') as f:
+        json.dump(seed_to_json(seed_seq), f)
+    os.replace(temp_fn, fn)
+
+def key_words(value):
+    """
+    returns a key level as four 32-bit words (a hash of its name), so keys of any length never collide by concatenation
+    """
+    digest = hashlib.blake2b(('' if value is None else str(value)).encode(), digest_size=16).digest()
+    return tuple(int.from_bytes(digest[i:i+4], 'little') for i in range(0, 16, 4))
+
+def stream_seed(seed_seq, stage, region=None, species=None, site=None, target=None, chunk=None):
+    """
+    returns the seed of one named stream under the master seed
+
+    Parameters
+    ----------
+    seed_seq : numpy SeedSequence
+        master seed.
+    stage : string
+        script or step drawing the numbers (e.g., 'c4', 'e8 CAIR').
+    region : string, optional
+        region (e.g., 'SOCO'). The default is None.
+    species : string, optional
+        emitted species (e.g., 'so2'). The default is None.
+    site : string, optional
+        monitoring site. The default is None.
+    target : string, optional
+        modeled pollutant. The default is None.
+    chunk : int, optional
+        chunk of the stream (see MC_propagation.chunk_seed); None gives the stream itself, whose chunks
+        propagate_batched and run_parallel spawn. The default is None.
+
+    Returns
+    -------
+    seed : numpy SeedSequence
+
+    """
+    spawn_key = tuple(seed_seq.spawn_key)
+    for value in [stage, region, species, site, target]:
+        spawn_key += key_words(value)
+    seed = np.random.SeedSequence(seed_seq.entropy, spawn_key=spawn_key)
+    return seed if chunk is None else chunk_seed(seed, chunk)
+
+def stream_rng(seed_seq, stage, region=None, species=None, site=None, target=None, chunk=None):
+    """
+    returns a numpy Generator of one named stream (and chunk) under the master seed; see stream_seed
+    """
+    return np.random.default_rng(stream_seed(seed_seq, stage, region, species, site, target, chunk))
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 12:51:31 2026
+
+variance-reduction samplers for the normal and lognormal draws of the Monte Carlo stages (c4, d3, e1, e8, e9, e10)
+every chunk of simulations (or tile of a virtual ensemble) is its own randomized sample, so chunks stay independent,
+    can be drawn in any order or on any worker, and the spread of their means gives the effective sample size
+samplers:
+    'random': independent draws, the same numbers as the plain numpy calls
+    'antithetic': the second half of each chunk mirrors the first (z and -z)
+    'lhs': Latin hypercube; each day and input is stratified into as many equal-probability bins as simulations
+    'sobol': scrambled Sobol points over the inputs of each day, digitally shifted and shuffled independently on each
+        day; balanced when the number of simulations per chunk is a power of 2
+
+@author: emei3
+"""
+
+## imports
+import warnings
+import numpy as np
+from scipy.special import ndtri
+from scipy.stats import qmc
+
+# samplers of standard_normals
+samplers = ['random', 'antithetic', 'lhs', 'sobol']
+# bits of the Sobol points
+sobol_bits = 30
+
+def stratified_uniforms(rng, n_sims, n_days, n_dims, sampler):
+    """
+    returns (n_sims, n_days, n_dims) uniforms in (0, 1), stratified over simulations by the 'lhs' or 'sobol' sampler;
+    days are independent of each other
+    """
+    shape = (n_sims, n_days, n_dims)
+    if sampler == 'lhs': # one random permutation of the bins per day and input, jittered within each bin
+        bins = np.argsort(rng.random(shape), axis=0)
+        return (bins + rng.random(shape))/n_sims
+    if sampler == 'sobol':
+        with warnings.catch_warnings(): # scipy warns when n_sims is not a power of 2
+            warnings.simplefilter('ignore', UserWarning)
+            points = qmc.Sobol(n_dims, scramble=True, bits=sobol_bits, seed=rng).random(n_sims)
+        points = np.rint(points*2**sobol_bits).astype(np.uint32)
+        # a random digital shift (xor) per day and input keeps the points a scrambled net
+        shifts = rng.integers(0, 2**sobol_bits, size=(n_days, n_dims), dtype=np.uint32)
+        points = ((points[:, None, :] ^ shifts[None]) + rng.random(shape))/2**sobol_bits
+        # shuffle simulations independently on each day so days are not coupled through the point order
+        order = np.argsort(rng.random((n_sims, n_days)), axis=0)
+        return np.take_along_axis(points, order[:, :, None], axis=0)
+    raise ValueError('unknown sampler '+str(sampler))
+
+def standard_normals(rng, n_sims, n_days, n_dims=1, sampler='random'):
+    """
+    draws (n_sims, n_days, n_dims) standard normals for one chunk of simulations
+
+    Parameters
+    ----------
+    rng : numpy Generator
+        random numbers of the chunk.
+    n_sims : int
+        number of simulations of the chunk.
+    n_days : int
+        number of days.
+    n_dims : int, optional
+        number of inputs drawn on each day (e.g., perturbed features); the 'sobol' sampler stratifies them jointly.
+        The default is 1.
+    sampler : string, optional
+        one of samplers. The default is 'random'.
+
+    Returns
+    -------
+    z : ndarray
+        (n_sims, n_days, n_dims) standard normals.
+
+    """
+    if sampler == 'random':
+        return rng.standard_normal((n_sims, n_days, n_dims))
+    if sampler == 'antithetic': # an odd chunk keeps one unpaired draw
+        half = rng.standard_normal(((n_sims + 1)//2, n_days, n_dims))
+        return np.concatenate([half, -half[:n_sims//2]], axis=0)
+    return ndtri(stratified_uniforms(rng, n_sims, n_days, n_dims, sampler))
+
+def draw_normal(rng, loc, scale, n_sims, sampler='random'):
+    """
+    draws (n_sims, n_days) normals with a mean and standard deviation per day; the 'random' sampler is
+    rng.normal(loc, scale, size=(n_sims, n_days))
+    """
+    if sampler == 'random':
+        return rng.normal(loc=loc, scale=scale, size=(n_sims, len(loc)))
+    return np.asarray(loc) + np.asarray(scale)*standard_normals(rng, n_sims, len(loc), 1, sampler)[:, :, 0]
+
+def effective_sample_size(y_mc, n_sims_chunk):
+    """
+    estimates the effective sample size of each day's mean: the number of independent simulations whose mean would vary
+    as little as the mean of y_mc does, judged from the spread of the means of its chunks (each an independent sample)
+
+    Parameters
+    ----------
+    y_mc : ndarray
+        (n_days, n_sims) array of simulations, drawn in chunks of n_sims_chunk simulations.
+    n_sims_chunk : int
+        number of simulations per chunk; only whole chunks are used and at least two are needed.
+
+    Returns
+    -------
+    ess : ndarray
+        (n_days,) effective sample size; nan on days without spread.
+
+    """
+    n_chunks = y_mc.shape[1] // n_sims_chunk
+    if n_chunks < 2:
+        return np.full(y_mc.shape[0], np.nan)
+    y = np.asarray(y_mc[:, :n_chunks*n_sims_chunk], dtype=float)
+    chunk_means = y.reshape(y.shape[0], n_chunks, n_sims_chunk).mean(axis=2)
+    with np.errstate(divide='ignore', invalid='ignore'): # variance of the mean of one chunk if draws were independent
+        return np.where(y.var(axis=1, ddof=1) > 0,
+                        y.shape[1]*y.var(axis=1, ddof=1)/n_sims_chunk/chunk_means.var(axis=1, ddof=1), np.nan)
+
+def sampling_report(y_mc, n_sims_chunk, sampler):
+    """
+    returns the sampler and the median effective sample size over days as a json-safe dict, e.g., for the attrs of the
+    output
+    """
+    ess = effective_sample_size(y_mc, n_sims_chunk)
+    finite = np.isfinite(ess)
+    median_ess = float(np.median(ess[finite])) if finite.any() else np.nan
+    return {'sampler': sampler, 'n_sims': int(y_mc.shape[1]), 'effective_sample_size': median_ess,
+            'ess_per_sim': median_ess/y_mc.shape[1]}
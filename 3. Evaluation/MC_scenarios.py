@@ -0,0 +1,537 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 12:22:38 2026
+
+scenario engine for Monte Carlo propagation of emissions to air pollutants
+a scenario changes the observed EGU emissions in one of three ways: replaces them with a Monte Carlo ensemble (short-run
+    counterfactual, e1), adds a gaussian impact to them (CAIR and other, e8), or leaves them as observed (modeled actual,
+    e9); mobile and other emissions are perturbed in every scenario
+all scenarios of a site and target are stacked into the same predict calls, so features and models are loaded once;
+    sites of a region that share emissions ensembles can be run together, sharing the region's random draws and
+    dispatching every site's predictions at once
+
+@author: emei3
+"""
+
+## imports
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from MC_propagation import (chunk_seed, align_dates, insert_aligned, resolve_perturbed_columns, draw_lognormal_factors,
+                            perturb_lognormal)
+from XGBoost_inference import PrunedPredictor, remap_features
+from XGBoost_compiled import compile_predictor
+from MC_ensemble import ensemble_values
+from MC_sampling import draw_normal
+
+class Scenario(object):
+
+    def __init__(self, name, kind='none', emissions=None, perturb_mobile_other=True):
+        """
+        definition of one scenario of EGU emissions
+
+        Parameters
+        ----------
+        name : string
+            label of the scenario (e.g., 'actual', 'CAIR', 'other', 'cf').
+        kind : string, optional
+            'none' keeps observed EGU emissions, 'replacement' replaces them with a Monte Carlo ensemble, and 'impact'
+            adds a gaussian impact to them. The default is 'none'.
+        emissions : dict, optional
+            species ('so2' or 'nox') to its emissions. For 'replacement', an ensemble dataframe indexed by Date with
+            columns column_0, column_1, ... (or an MC_ensemble.VirtualEnsemble); for 'impact', a dataframe with Date, median, and std columns.
+            The default is None.
+        perturb_mobile_other : bool, optional
+            whether to perturb mobile and other emissions. The default is True.
+
+        """
+        if kind not in ['none', 'replacement', 'impact']:
+            raise ValueError('scenario kind must be none, replacement, or impact, not '+str(kind))
+        if kind != 'none' and not emissions:
+            raise ValueError(kind+' scenario '+name+' needs emissions')
+        self.name = name
+        self.kind = kind
+        self.emissions = emissions or dict()
+        self.perturb_mobile_other = perturb_mobile_other
+        if kind == 'replacement': # monte carlo runs as arrays with columns in simulation order
+            self.values = {species: ensemble_values(ensemble) for species, ensemble in self.emissions.items()}
+
+    def n_sims(self):
+        """
+        returns the number of simulations available (None if unlimited)
+        """
+        if self.kind != 'replacement':
+            return None
+        return min(values.shape[1] for values in self.values.values())
+
+    def align(self, dates, species_features):
+        """
+        lines the scenario's emissions up with the feature dates of one site; run once per site
+
+        Parameters
+        ----------
+        dates : array-like
+            Date column of the site's feature data.
+        species_features : dict
+            species to the name of its EGU feature at this site (e.g., {'so2': 'SO2EGU', 'nox': 'NOxEGU'}).
+
+        Returns
+        -------
+        changes : list
+            (feature name, emissions, row index) for each changed species; emissions are the ensemble values for
+            'replacement' and (median, std) arrays for 'impact'.
+
+        """
+        changes = []
+        for species, emissions in self.emissions.items():
+            if self.kind == 'replacement':
+                row_index = align_dates(dates, emissions.index)
+                changes.append((species_features[species], self.values[species], row_index))
+            else:
+                row_index = align_dates(dates, emissions['Date'])
+                if (row_index < 0).any():
+                    raise ValueError(species+' impact of '+self.name+' does not cover every date in the features')
+                changes.append((species_features[species],
+                                (emissions['median'].to_numpy(), emissions['std'].to_numpy()), row_index))
+        return changes
+
+    def changes_model(self, feature_names, changes):
+        """
+        returns whether the scenario changes any feature of a model beyond the mobile and other perturbations
+        """
+        return any(feature in feature_names for feature, _, _ in changes)
+
+    def active_days(self, feature_names, changes):
+        """
+        returns whether each day's features can differ from the observed EGU emissions; for impacts, False on days
+        where the impact of every species in the model is exactly zero (e.g., days padded by pad_impact_dataframe)
+        """
+        if self.kind != 'impact':
+            return None
+        n_days = len(changes[0][2])
+        active = np.zeros(n_days, dtype=bool)
+        for feature, (median, std), row_index in changes:
+            if feature in feature_names:
+                active |= (median[row_index] != 0) | (std[row_index] != 0)
+        return active
+
+def fill_scenario(X_block, X_base, X_base_values, kind, changes, feature_names, start, stop, impacts_mc,
+                  perturbed_cols, factors=None):
+    """
+    fills X_block with the features of simulations start through stop-1 of one scenario at one site
+
+    Parameters
+    ----------
+    X_block : ndarray
+        (stop-start, n_days, n_features) float32 array to fill.
+    X_base : ndarray
+        (n_days, n_features) observed features.
+    X_base_values : ndarray
+        X_base as float32.
+    kind : string
+        kind of the scenario.
+    changes : list
+        output of Scenario.align for this site.
+    feature_names : list
+        feature names in the order the model was fit with.
+    start : int
+        first simulation.
+    stop : int
+        one past the last simulation.
+    impacts_mc : list
+        (stop-start, n_impact_days) simulated impacts parallel to changes; None for replacements and unused features.
+    perturbed_cols : ndarray
+        positions of perturbed features.
+    factors : ndarray, optional
+        (stop-start, n_days, len(perturbed_cols)) log normal factors of the perturbed features. The default is None
+        (not perturbed).
+
+    Returns
+    -------
+    None.
+
+    """
+    X_block[:] = X_base_values # start every monte carlo run from observed features
+    for (feature, emissions, row_index), impact_mc in zip(changes, impacts_mc):
+        if feature not in feature_names:
+            continue
+        col = feature_names.index(feature)
+        if kind == 'replacement': # replace the observed EGU emissions with the monte carlo simulated
+            insert_aligned(X_block, col, emissions, row_index, start, stop)
+        else: # add the monte carlo simulated impact to the observed
+            X_block[:, :, col] = X_base[:, col] + impact_mc[:, row_index]
+    # perturb mobile and other emissions
+    # use log normal distributions with sigmas from Hanna et al. 2001
+    if factors is not None:
+        perturb_lognormal(X_block, X_base, perturbed_cols, None, factors=factors)
+
+def predict_rows(predictor, X_rows, feature_names, days):
+    """
+    predicts stacked rows of any days of any simulations; days is the day (row of X_base) of each row
+    """
+    X_rows = pd.DataFrame(X_rows, columns=feature_names, copy=False) # keep feature names so xgboost can validate them
+    if isinstance(predictor, PrunedPredictor): # invariant trees are summed per day
+        return predictor.predict(X_rows, days=days)
+    return predictor.predict(X_rows)
+
+class SiteModel(object):
+
+    def __init__(self, name, X_base, feature_names, dates, scenarios, site_changes, use_pruned_trees=True,
+                 use_compiled_model=False, common_random_numbers=False):
+        """
+        one site's features, prepared to push chunks of simulations of several scenarios through the models of one or
+        more targets (added with add_target). Each chunk of every scenario is filled once on the site's feature block
+        and every target's model reads that block directly
+
+        Parameters
+        ----------
+        name : string
+            label of the site (e.g., 'Bronx').
+        X_base : ndarray
+            (n_days, n_features) observed features; must include the features of every target's model (e.g., the union
+            of featuresNeeded of all targets).
+        feature_names : list
+            names of the columns of X_base.
+        dates : array-like
+            date of each row of X_base.
+        scenarios : list
+            Scenario of the region.
+        site_changes : list
+            Scenario.align output of each scenario for this site, parallel to scenarios.
+        use_pruned_trees : bool, optional
+            only evaluate trees that split on features that vary between simulations for every simulation.
+            The default is True.
+        use_compiled_model : bool, optional
+            predict with a native library built by XGBoost_compiled. The default is False.
+        common_random_numbers : bool, optional
+            copy zero-impact days from the observed ('none') scenario instead of predicting them; only valid if the
+            perturbations are shared between scenarios. The default is False.
+
+        """
+        self.name = name
+        self.feature_names = list(feature_names)
+        self.X_base = np.asarray(X_base, dtype=float)
+        self.X_base_values = self.X_base.astype(np.float32)
+        self.n_days = self.X_base.shape[0]
+        self.dates = pd.DatetimeIndex(pd.to_datetime(dates))
+        self.scenarios = scenarios
+        self.site_changes = site_changes
+        self.use_pruned_trees = use_pruned_trees
+        self.use_compiled_model = use_compiled_model
+        self.common_random_numbers = common_random_numbers
+        self.targets = [] # model and plan of each target
+        self.scenario_indexes = [] # scenarios run for any target
+        self.X_buffer = None # reused for every chunk
+        self.X_gather = None # rows of targets that do not read the whole block
+
+        ## mobile and other emissions columns to perturb
+        self.perturbed_cols, self.perturbed_sigmas = resolve_perturbed_columns(self.feature_names)
+        self.perturbed_features = [self.feature_names[col] for col in self.perturbed_cols]
+
+    def add_target(self, target, regressor, feature_names, scenario_indexes=None):
+        """
+        adds the model of one target; it reads its features from the site's feature block without copying them
+
+        Parameters
+        ----------
+        target : string
+            name of the target (e.g., 'pm25').
+        regressor : XGBoost model
+            fitted model.
+        feature_names : list
+            feature names in the order the model was fit with.
+        scenario_indexes : list, optional
+            positions in scenarios to run for this target. The default is None (all).
+
+        Returns
+        -------
+        None.
+
+        """
+        scenarios = self.scenarios
+        feature_names = list(feature_names)
+        scenario_indexes = list(range(0, len(scenarios))) if scenario_indexes is None else sorted(scenario_indexes)
+
+        ## days each scenario is predicted on; with shared perturbations, zero-impact days equal the observed scenario
+        scenario_days = [np.arange(self.n_days)]*len(scenarios)
+        skipped_days = [None]*len(scenarios)
+        baselines = [None]*len(scenarios) # observed scenario that skipped days are copied from
+        if self.common_random_numbers:
+            for s in scenario_indexes:
+                active = scenarios[s].active_days(feature_names, self.site_changes[s])
+                baseline = [b for b in scenario_indexes if scenarios[b].kind == 'none'
+                            and scenarios[b].perturb_mobile_other == scenarios[s].perturb_mobile_other]
+                if active is not None and len(baseline) > 0 and not active.all():
+                    scenario_days[s] = np.flatnonzero(active)
+                    skipped_days[s] = np.flatnonzero(~active)
+                    baselines[s] = baseline[0]
+
+        ## model that reads the site's feature block
+        predictor = regressor
+        if feature_names != self.feature_names:
+            predictor = remap_features(regressor, feature_names, self.feature_names)
+        # split trees on whether they use features that change between monte carlo runs in any scenario
+        if self.use_pruned_trees:
+            varying_features = {feature for s in scenario_indexes for feature, _, _ in self.site_changes[s]
+                                if feature in feature_names}
+            if any(scenarios[s].perturb_mobile_other for s in scenario_indexes):
+                varying_features |= set(self.perturbed_features)
+            predictor = PrunedPredictor(predictor, self.feature_names, sorted(varying_features), self.X_base)
+        if self.use_compiled_model:
+            predictor = compile_predictor(predictor, self.feature_names, self.X_base)
+
+        self.targets.append({'name': target, 'feature_names': feature_names, 'predictor': predictor,
+                             'scenario_indexes': scenario_indexes, 'scenario_days': scenario_days,
+                             'skipped_days': skipped_days, 'baselines': baselines})
+        self.scenario_indexes = sorted(set(self.scenario_indexes) | set(scenario_indexes))
+        self.X_buffer = None
+
+    def uses_change(self, s, c):
+        """
+        returns whether any target runs scenario s and change c of it is a feature of that target's model
+        """
+        return any(s in target['scenario_indexes'] and self.site_changes[s][c][0] in target['feature_names']
+                   for target in self.targets)
+
+    def predict_chunk(self, scenarios, start, stop, impacts_mc, factors, outputs):
+        """
+        predicts simulations start through stop-1 of every scenario of every target at this site, one predict call per
+        target
+
+        Parameters
+        ----------
+        scenarios : list
+            Scenario of the region.
+        start : int
+            first simulation.
+        stop : int
+            one past the last simulation.
+        impacts_mc : list
+            simulated impacts of each scenario, each parallel to its changes (see fill_scenario).
+        factors : list
+            log normal factors of each scenario at this site; None for scenarios that are not perturbed.
+        outputs : dict
+            target name to scenario name to the (n_days, n_sims) array to write predictions into.
+
+        Returns
+        -------
+        None.
+
+        """
+        n_features = len(self.feature_names)
+        if self.X_buffer is None or self.X_buffer.shape[1] < stop-start:
+            self.X_buffer = np.empty((len(self.scenario_indexes), stop-start, self.n_days, n_features), dtype=np.float32)
+        X_chunk = self.X_buffer[:, :stop-start]
+        for i, s in enumerate(self.scenario_indexes):
+            fill_scenario(X_chunk[i], self.X_base, self.X_base_values, scenarios[s].kind, self.site_changes[s],
+                          self.feature_names, start, stop, impacts_mc[s], self.perturbed_cols, factors[s])
+
+        X_block = self.X_buffer.reshape(-1, n_features)
+        for t, target in enumerate(self.targets):
+            scenario_days = target['scenario_days']
+            n_rows = [(stop-start)*len(scenario_days[s]) for s in target['scenario_indexes']]
+            row_stops = np.cumsum([0] + n_rows)
+            days = np.concatenate([np.tile(scenario_days[s], stop-start) for s in target['scenario_indexes']])
+
+            # rows of the target's scenarios and days one after another; the whole block of a full chunk is read as is,
+            # the last target packs its rows towards the front of the block, and other targets gather them
+            if target['scenario_indexes'] == self.scenario_indexes and row_stops[-1] == X_block.shape[0]:
+                X_rows = X_block
+            else:
+                in_place = t == len(self.targets)-1
+                if not in_place and (self.X_gather is None or self.X_gather.shape[0] < row_stops[-1]):
+                    self.X_gather = np.empty((row_stops[-1], n_features), dtype=np.float32)
+                X_rows = X_block if in_place else self.X_gather
+                for j, s in enumerate(target['scenario_indexes']):
+                    i = self.scenario_indexes.index(s)
+                    if len(scenario_days[s]) < self.n_days:
+                        X_rows[row_stops[j]:row_stops[j+1]] = X_chunk[i][:, scenario_days[s]].reshape(n_rows[j], -1)
+                    elif not in_place or row_stops[j] != i*self.X_buffer.shape[1]*self.n_days:
+                        X_rows[row_stops[j]:row_stops[j+1]] = X_chunk[i].reshape(n_rows[j], -1)
+            y = predict_rows(target['predictor'], X_rows[:row_stops[-1]], self.feature_names, days)
+
+            target_outputs = outputs[target['name']]
+            for j, s in enumerate(target['scenario_indexes']):
+                target_outputs[scenarios[s].name][scenario_days[s], start:stop] = \
+                    y[row_stops[j]:row_stops[j+1]].reshape(stop-start, -1).T
+            for s in target['scenario_indexes']: # days with no impact
+                if target['baselines'][s] is not None:
+                    target_outputs[scenarios[s].name][target['skipped_days'][s], start:stop] = \
+                        target_outputs[scenarios[target['baselines'][s]].name][target['skipped_days'][s], start:stop]
+
+def propagate_region(site_models, scenarios, n_sims, n_sims_chunk=100, seed=None, common_random_numbers=False,
+                     n_threads=None, outputs=None, sampler='random'):
+    """
+    pushes n_sims simulations of every scenario through the models of every site of a region. Each chunk's random
+    numbers are drawn once for the region: impacts are shared by all sites, and with common_random_numbers the mobile and
+    other perturbations are shared by all sites and scenarios (by date and feature name). All sites' predictions of a
+    chunk are then dispatched together
+
+    Parameters
+    ----------
+    site_models : list
+        SiteModel of each site with its targets added; must be built with the same scenarios and common_random_numbers.
+    scenarios : list
+        Scenario of the region.
+    n_sims : int
+        number of simulations of each scenario.
+    n_sims_chunk : int, optional
+        number of simulations of each scenario per predict call. The default is 100.
+    seed : int or numpy SeedSequence, optional
+        seed of this run; each chunk gets an independent stream spawned from it. The default is None (random).
+    common_random_numbers : bool, optional
+        draw the mobile and other perturbations once per simulation and share them between scenarios and sites.
+        The default is False.
+    n_threads : int, optional
+        number of sites predicted at the same time. The default is None (all sites).
+    outputs : dict, optional
+        site name to target name to scenario name to an (n_days, n_sims) array to write predictions into.
+        The default is None (allocated).
+    sampler : string, optional
+        sampler of the impact and perturbation draws of each chunk (see MC_sampling). The default is 'random'.
+
+    Returns
+    -------
+    outputs : dict
+        site name to target name to scenario name to (n_days, n_sims) predictions.
+
+    """
+    seed_seq = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    if outputs is None: # pre-allocate pollutant concentration
+        outputs = {site.name: {target['name']: {scenarios[s].name: np.zeros((site.n_days, n_sims))
+                                                for s in target['scenario_indexes']} for target in site.targets}
+                   for site in site_models}
+    for s, scenario in enumerate(scenarios):
+        if any(s in site.scenario_indexes for site in site_models) and scenario.n_sims() is not None \
+                and scenario.n_sims() < n_sims:
+            raise ValueError('scenario '+scenario.name+' only has '+str(scenario.n_sims())+' simulations')
+
+    ## dates and perturbed features of the region; shared factors are indexed into each site's days and features
+    if all(site.dates.equals(site_models[0].dates) for site in site_models):
+        region_dates = site_models[0].dates
+    else:
+        region_dates = site_models[0].dates
+        for site in site_models[1:]:
+            region_dates = region_dates.union(site.dates)
+    region_features = []
+    region_sigmas = []
+    for site in site_models:
+        for feature, sigma in zip(site.perturbed_features, site.perturbed_sigmas):
+            if feature not in region_features:
+                region_features.append(feature)
+                region_sigmas.append(sigma)
+    site_days = [None if site.dates.equals(region_dates) else align_dates(site.dates, region_dates)
+                 for site in site_models]
+    site_features = [None if site.perturbed_features == region_features
+                     else np.array([region_features.index(feature) for feature in site.perturbed_features], dtype=int)
+                     for site in site_models]
+
+    ## simulations of emissions impacts that at least one site uses
+    impact_changes = [[c for c in range(0, len(scenario.emissions))
+                       if scenario.kind == 'impact' and any(site.uses_change(s, c) for site in site_models)]
+                      for s, scenario in enumerate(scenarios)]
+
+    pool = None
+    n_threads = len(site_models) if n_threads is None else n_threads
+    if n_threads > 1 and len(site_models) > 1:
+        pool = ThreadPoolExecutor(max_workers=n_threads)
+    try:
+        for chunk_index, start in enumerate(range(0, n_sims, n_sims_chunk)):
+            stop = min(start + n_sims_chunk, n_sims)
+            rng = np.random.default_rng(chunk_seed(seed_seq, chunk_index))
+
+            ## random draws of the region
+            region_factors = None
+            if common_random_numbers and len(region_features) > 0: # one draw per simulation shared by every scenario
+                region_factors = draw_lognormal_factors(stop-start, len(region_dates), np.array(region_sigmas), rng,
+                                                        sampler)
+            impacts_mc = []
+            for s, scenario in enumerate(scenarios):
+                impacts_mc.append([None]*len(scenario.emissions))
+                for c in impact_changes[s]:
+                    median, std = site_models[0].site_changes[s][c][1]
+                    impacts_mc[s][c] = draw_normal(rng, median, std, stop-start, sampler)
+            factors = []
+            for i, site in enumerate(site_models):
+                factors.append([None]*len(scenarios))
+                if len(site.perturbed_cols) == 0:
+                    continue
+                if region_factors is not None:
+                    site_factors = region_factors
+                    if site_days[i] is not None:
+                        site_factors = site_factors[:, site_days[i]]
+                    if site_features[i] is not None:
+                        site_factors = site_factors[:, :, site_features[i]]
+                for s in site.scenario_indexes:
+                    if not scenarios[s].perturb_mobile_other:
+                        continue
+                    if region_factors is not None:
+                        factors[i][s] = site_factors
+                    else: # independent draws for each site and scenario
+                        factors[i][s] = draw_lognormal_factors(stop-start, site.n_days, site.perturbed_sigmas, rng,
+                                                               sampler)
+
+            ## predict every site
+            if pool is None:
+                for i, site in enumerate(site_models):
+                    site.predict_chunk(scenarios, start, stop, impacts_mc, factors[i], outputs[site.name])
+            else:
+                futures = [pool.submit(site.predict_chunk, scenarios, start, stop, impacts_mc, factors[i],
+                                       outputs[site.name]) for i, site in enumerate(site_models)]
+                for future in futures:
+                    future.result()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return outputs
+
+def propagate_scenarios(regressor, feature_names, X_base, scenarios, site_changes, n_sims, n_sims_chunk=100,
+                        seed=None, use_pruned_trees=True, use_compiled_model=False, common_random_numbers=False,
+                        outputs=None):
+    """
+    pushes n_sims simulations of every scenario through one model; each predict call stacks n_sims_chunk simulations
+    of every scenario
+
+    Parameters
+    ----------
+    regressor : XGBoost model
+        fitted model.
+    feature_names : list
+        feature names in the order the model was fit with.
+    X_base : ndarray
+        (n_days, n_features) observed features.
+    scenarios : list
+        Scenario of each output.
+    site_changes : list
+        Scenario.align output of each scenario for this site, parallel to scenarios.
+    n_sims : int
+        number of simulations of each scenario.
+    n_sims_chunk : int, optional
+        number of simulations of each scenario per predict call. The default is 100.
+    seed : int or numpy SeedSequence, optional
+        seed of this run; each chunk gets an independent stream spawned from it. The default is None (random).
+    use_pruned_trees : bool, optional
+        only evaluate trees that split on features that vary between simulations for every simulation.
+        The default is True.
+    use_compiled_model : bool, optional
+        predict with a native library built by XGBoost_compiled. The default is False.
+    common_random_numbers : bool, optional
+        draw the mobile and other perturbations once per simulation and share them between scenarios, so scenario
+        differences only come from EGU emissions. Days where an impact scenario's impact is exactly zero are then
+        copied from the observed ('none') scenario instead of predicted. The default is False.
+    outputs : dict, optional
+        scenario name to an (n_days, n_sims) array to write predictions into. The default is None (allocated).
+
+    Returns
+    -------
+    outputs : dict
+        scenario name to (n_days, n_sims) predictions.
+
+    """
+    n_days = np.shape(X_base)[0]
+    site = SiteModel('site', X_base, feature_names, np.arange(n_days), scenarios, site_changes,
+                     use_pruned_trees=use_pruned_trees, use_compiled_model=use_compiled_model,
+                     common_random_numbers=common_random_numbers)
+    site.add_target('target', regressor, feature_names)
+    return propagate_region([site], scenarios, n_sims, n_sims_chunk, seed, common_random_numbers,
+                            outputs=None if outputs is None else {'site': {'target': outputs}})['site']['target']
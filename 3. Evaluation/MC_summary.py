@@ -0,0 +1,596 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 12:30:55 2026
+
+summaries of Monte Carlo ensembles: median and lower and upper bounds of the 95 CI per day, week, month, or ozone season,
+    streamed chunk by chunk (WindowSketch) or from a whole ensemble, and the convergence of those quantiles for adaptive runs
+works on the raw (n_days, n_sims) float array; the order statistics of the median and both bounds come from one
+    partition of each row (or each window's pooled simulations), and windows of the same length are summarized together
+    by reshaping, instead of one pandas reduction per statistic and per window
+
+@author: emei3
+"""
+
+## imports
+import warnings
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+# quantile of each summary column
+summary_quantiles = {'median': 0.5, 'lower_bound': 0.025, 'upper_bound': 0.975}
+# pandas resample rule of each calendar window
+window_rules = {'weekly': 'W', 'monthly': 'ME'}
+# months of the ozone season
+ozone_season_months = [5, 6, 7, 8, 9]
+# number of values partitioned at once; bounds the memory of the copies
+block_size = 2**24
+
+def lerp(a, b, t):
+    """
+    linear interpolation between order statistics, written the same way as numpy's quantile so results match pandas
+    """
+    diff_b_a = b - a
+    return np.where(t >= 0.5, b - diff_b_a*(1 - t), a + diff_b_a*t)
+
+def row_quantiles(values, quantiles=summary_quantiles):
+    """
+    calculates quantiles of every row, ignoring nans (same as pandas quantile and median with axis=1)
+
+    Parameters
+    ----------
+    values : ndarray
+        (n_rows, n_values) array; can be a memory map.
+    quantiles : dict, optional
+        column name to quantile. The default is summary_quantiles.
+
+    Returns
+    -------
+    summary : dict
+        column name to (n_rows,) array.
+
+    """
+    n_rows, n_values = values.shape
+    summary = {name: np.full(n_rows, np.nan) for name in quantiles}
+    if n_values == 0:
+        return summary
+    # order statistics of every quantile
+    positions = {name: (n_values - 1)*q for name, q in quantiles.items()}
+    kth = sorted({k for h in positions.values() for k in [int(np.floor(h)), min(int(np.floor(h)) + 1, n_values - 1)]})
+
+    n_rows_block = max(1, block_size // n_values)
+    for start in range(0, n_rows, n_rows_block):
+        block = np.asarray(values[start:start+n_rows_block], dtype=float)
+        nan_rows = np.isnan(block).any(axis=1)
+        full = ~nan_rows
+        if full.any(): # one partition per row gives every order statistic
+            ordered = np.partition(block[full], kth, axis=1)
+            for name, h in positions.items():
+                lo = int(np.floor(h))
+                a = ordered[:, lo]
+                b = ordered[:, min(lo + 1, n_values - 1)]
+                if quantiles[name] == 0.5 and n_values % 2 == 0: # median is the mean of the middle values
+                    summary[name][start:start+len(block)][full] = (a + b)/2
+                else:
+                    summary[name][start:start+len(block)][full] = lerp(a, b, h - lo)
+        if nan_rows.any(): # rows with missing simulations (rare)
+            with warnings.catch_warnings(): # all nan rows stay nan
+                warnings.simplefilter('ignore', RuntimeWarning)
+                for name, q in quantiles.items():
+                    summary[name][start:start+len(block)][nan_rows] = np.nanquantile(block[nan_rows], q, axis=1)
+    return summary
+
+def window_quantiles(values, sizes, quantiles=summary_quantiles):
+    """
+    calculates quantiles of all simulations of all days of consecutive windows of rows
+
+    Parameters
+    ----------
+    values : ndarray
+        (n_days, n_sims) array in date order.
+    sizes : ndarray
+        number of consecutive rows in each window (can be 0).
+    quantiles : dict, optional
+        column name to quantile. The default is summary_quantiles.
+
+    Returns
+    -------
+    summary : dict
+        column name to (n_windows,) array.
+
+    """
+    sizes = np.asarray(sizes, dtype=int)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    summary = {name: np.full(len(sizes), np.nan) for name in quantiles}
+    for size in np.unique(sizes[sizes > 0]): # windows of the same length are stacked and summarized together
+        windows = np.flatnonzero(sizes == size)
+        rows = starts[windows][:, None] + np.arange(size) # (n_windows, size) rows of each window
+        n_windows_block = max(1, block_size // (size*values.shape[1]))
+        for start in range(0, len(windows), n_windows_block):
+            pooled = np.asarray(values[rows[start:start+n_windows_block].ravel()], dtype=float)
+            block = row_quantiles(pooled.reshape(-1, size*values.shape[1]), quantiles)
+            for name in quantiles:
+                summary[name][windows[start:start+n_windows_block]] = block[name]
+    return summary
+
+def summarize(values, dates, windows=('daily',), quantiles=summary_quantiles):
+    """
+    summarizes an ensemble over one or more windows
+
+    Parameters
+    ----------
+    values : ndarray
+        (n_days, n_sims) array of simulations; can be a memory map.
+    dates : array-like
+        date of each row of values.
+    windows : list, optional
+        any of 'daily', 'weekly' (weeks ending Sunday, as resample('W')), 'monthly', and 'ozone_season' (May through
+        September of each year). The default is ('daily',).
+    quantiles : dict, optional
+        column name to quantile. The default is summary_quantiles.
+
+    Returns
+    -------
+    summaries : dict
+        window to a dataframe of the quantiles indexed by date (daily), window end (weekly, monthly), or year (ozone_season).
+
+    """
+    dates = pd.DatetimeIndex(pd.to_datetime(dates))
+    order = None
+    if not dates.is_monotonic_increasing: # windows are consecutive rows
+        order = np.argsort(dates, kind='stable')
+    summaries = dict()
+    for window in windows:
+        if window == 'daily':
+            index = dates.rename('Date')
+            summary = row_quantiles(values, quantiles)
+        else:
+            sorted_dates = dates if order is None else dates[order]
+            sorted_values = values if order is None else values[order]
+            if window in window_rules:
+                sizes = pd.Series(0, index=sorted_dates).resample(window_rules[window]).size()
+                index = sizes.index.rename('Date')
+                summary = window_quantiles(sorted_values, sizes.to_numpy(), quantiles)
+            elif window == 'ozone_season':
+                in_season = np.isin(sorted_dates.month, ozone_season_months)
+                years = sorted_dates.year[in_season]
+                sizes = pd.Series(years).value_counts().sort_index()
+                index = pd.Index(sizes.index, name='year')
+                summary = window_quantiles(sorted_values[in_season], sizes.to_numpy(), quantiles)
+            else:
+                raise ValueError('unknown window '+str(window))
+        summaries[window] = pd.DataFrame(summary, index=index)
+    return summaries
+
+def bin_daily(df):
+    """
+    median and lower and upper bounds of the 95 CI of each row of an ensemble dataframe
+    """
+    return summarize(df.to_numpy(), df.index)['daily'].set_axis(df.index)
+
+def bin_weekly(df):
+    """
+    median and lower and upper bounds of the 95 CI of all simulations of each week (ending Sunday) of an ensemble dataframe
+    """
+    return summarize(df.to_numpy(), df.index, ['weekly'])['weekly'].rename_axis(df.index.name)
+
+def window_labels(dates, window):
+    """
+    returns the label and number of rows of each non-empty window of date-ordered rows (labels as in summarize)
+    """
+    if window in window_rules:
+        sizes = pd.Series(0, index=dates).resample(window_rules[window]).size()
+        sizes = sizes[sizes > 0]
+        return sizes.index, sizes.to_numpy()
+    if window == 'ozone_season':
+        sizes = pd.Series(dates.year).value_counts(sort=False).sort_index()
+        return sizes.index, sizes.to_numpy()
+    raise ValueError('unknown window '+str(window))
+
+def summarize_parquet(fn, windows=('daily',), quantiles=summary_quantiles, n_days_block=None):
+    """
+    summarizes an ensemble parquet (Date index, one column per simulation) without reading it whole: blocks of days are
+    read with pyarrow, daily quantiles are taken block by block, and the days of a window that continues past the end of a
+    block are carried into the next block, so every window is still summarized over all of its simulations and results
+    equal summarize on the full ensemble
+
+    Parameters
+    ----------
+    fn : string
+        file name of the ensemble; rows must be in date order (as written by e1 and MC_output).
+    windows : list, optional
+        any of 'daily', 'weekly', 'monthly', and 'ozone_season' (see summarize). The default is ('daily',).
+    quantiles : dict, optional
+        column name to quantile. The default is summary_quantiles.
+    n_days_block : int, optional
+        number of days read at once. The default is None (block_size values).
+
+    Returns
+    -------
+    summaries : dict
+        window to a dataframe of the quantiles, same as summarize.
+
+    """
+    parquet = pq.ParquetFile(fn)
+    if 'Date' not in parquet.schema_arrow.names:
+        raise ValueError(fn+' has no Date column')
+    sim_columns = [name for name in parquet.schema_arrow.names if name != 'Date']
+    if n_days_block is None:
+        n_days_block = max(1, block_size // max(len(sim_columns), 1))
+
+    pending = {window: (np.empty((0, len(sim_columns))), pd.DatetimeIndex([])) for window in windows if window != 'daily'}
+    parts = {window: [] for window in windows} # (index, summary) of each finished block of windows
+    first_date, last_date = None, None
+    for batch in parquet.iter_batches(batch_size=n_days_block, columns=['Date'] + sim_columns):
+        dates = pd.DatetimeIndex(batch.column('Date').to_pandas())
+        if len(dates) == 0:
+            continue
+        if not dates.is_monotonic_increasing or (last_date is not None and dates[0] < last_date):
+            raise ValueError(fn+' is not in date order; summarize it in memory instead')
+        first_date = dates[0] if first_date is None else first_date
+        last_date = dates[-1]
+        values = np.empty((len(dates), len(sim_columns)))
+        for j in range(0, len(sim_columns)):
+            values[:, j] = batch.column(j + 1).to_numpy(zero_copy_only=False)
+
+        for window in windows:
+            if window == 'daily':
+                parts[window].append((dates.rename('Date'), row_quantiles(values, quantiles)))
+                continue
+            # days of the last window may continue into the next block
+            pending_values, pending_dates = pending[window]
+            window_values = np.concatenate([pending_values, values])
+            window_dates = pending_dates.append(dates)
+            if window == 'ozone_season': # only days of the ozone season count
+                in_season = np.isin(window_dates.month, ozone_season_months)
+                window_values, window_dates = window_values[in_season], window_dates[in_season]
+            if len(window_dates) == 0:
+                pending[window] = (window_values, window_dates)
+                continue
+            labels, sizes = window_labels(window_dates, window)
+            n_finished = len(window_dates) - sizes[-1]
+            if n_finished > 0:
+                parts[window].append((labels[:-1], window_quantiles(window_values[:n_finished], sizes[:-1], quantiles)))
+            pending[window] = (window_values[n_finished:], window_dates[n_finished:])
+
+    summaries = dict()
+    for window in windows:
+        if window != 'daily' and len(pending[window][1]) > 0: # last window
+            labels, sizes = window_labels(pending[window][1], window)
+            parts[window].append((labels, window_quantiles(pending[window][0], sizes, quantiles)))
+        if len(parts[window]) > 0:
+            index = parts[window][0][0].append([part[0] for part in parts[window][1:]])
+            summary = {name: np.concatenate([part[1][name] for part in parts[window]]) for name in quantiles}
+        else:
+            index = pd.DatetimeIndex([])
+            summary = {name: np.empty(0) for name in quantiles}
+        summary = pd.DataFrame(summary, index=index)
+        if window in window_rules: # weeks or months without days are nan, as in summarize
+            summary.index = summary.index.rename('Date')
+            if first_date is not None:
+                full_index = pd.Series(0, index=pd.DatetimeIndex([first_date, last_date])).resample(window_rules[window]).size().index
+                summary = summary.reindex(full_index.rename('Date'))
+        elif window == 'ozone_season':
+            summary.index = pd.Index(summary.index, name='year')
+        summaries[window] = summary
+    return summaries
+
+class QuantileSketch(object):
+
+    def __init__(self, n_days, k=512, quantiles=summary_quantiles):
+        """
+        mergeable per-day quantile sketch of an ensemble, so summary-only runs never hold the (n_days, n_sims) matrix.
+        Chunks of simulations are folded in with write_sims and sketches of different chunks (e.g., from worker
+        processes) are combined with merge. The sketch is exact until a day has more than k simulations; after that it
+        keeps up to k values per level of a compactor hierarchy (each level's values weigh twice the level below), with
+        a rank error of roughly log2(n_sims/k)/k of n_sims
+
+        Parameters
+        ----------
+        n_days : int
+            number of days (rows).
+        k : int, optional
+            values kept per level; memory is about n_days*k*log2(n_sims/k) floats. The default is 512.
+        quantiles : dict, optional
+            column name to quantile. The default is summary_quantiles.
+
+        """
+        self.n_days = n_days
+        self.k = k
+        self.quantiles = quantiles
+        self.levels = [np.empty((n_days, 0))] # values of each level; level i weighs 2**i
+        self.compactions = [0] # number of compactions of each level; alternates the kept half
+        self.count = 0 # number of simulations folded in
+
+    def is_exact(self):
+        """
+        returns whether no values have been compacted, i.e., finalize gives exact quantiles
+        """
+        return len(self.levels) == 1
+
+    def write_sims(self, start, stop, values):
+        """
+        folds in simulations start through stop-1 of every day; same signature as MC_output.EnsembleWriter.write_sims so
+        it can be the out of propagate_batched
+        """
+        self.update(values)
+
+    def update(self, values):
+        """
+        folds in an (n_days, n_sims_chunk) block of simulations
+        """
+        values = np.asarray(values, dtype=float)
+        if values.shape[0] != self.n_days:
+            raise ValueError('block has '+str(values.shape[0])+' days, not '+str(self.n_days))
+        self.levels[0] = np.concatenate([self.levels[0], values], axis=1)
+        self.count += values.shape[1]
+        self._compact()
+
+    def merge(self, other):
+        """
+        folds another sketch of the same days into this one
+        """
+        if other.n_days != self.n_days or other.k != self.k:
+            raise ValueError('sketches of '+str(other.n_days)+' days and k '+str(other.k)+' cannot be merged into '+
+                             str(self.n_days)+' days and k '+str(self.k))
+        for level, values in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty((self.n_days, 0)))
+                self.compactions.append(0)
+            self.levels[level] = np.concatenate([self.levels[level], values], axis=1)
+        self.count += other.count
+        self._compact()
+
+    def _compact(self):
+        """
+        halves every level with more than k values: sorts each day and promotes every other value to the next level
+        """
+        level = 0
+        while level < len(self.levels):
+            values = self.levels[level]
+            if values.shape[1] > self.k:
+                n_pairs = values.shape[1] // 2
+                values = np.sort(values, axis=1) # nans last
+                offset = self.compactions[level] % 2 # alternate which half is kept so errors cancel
+                self.compactions[level] += 1
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty((self.n_days, 0)))
+                    self.compactions.append(0)
+                self.levels[level+1] = np.concatenate([self.levels[level+1], values[:, offset:2*n_pairs:2]], axis=1)
+                self.levels[level] = values[:, 2*n_pairs:] # odd value stays
+            level += 1
+
+    def finalize(self, dates=None, quantiles=None):
+        """
+        returns the median and lower and upper bounds of each day, like bin_daily
+
+        Parameters
+        ----------
+        dates : array-like, optional
+            date of each day, used as the index. The default is None (0 to n_days-1).
+        quantiles : dict, optional
+            column name to quantile. The default is None (the quantiles of the sketch).
+
+        Returns
+        -------
+        summary : dataframe
+            quantiles of each day.
+
+        """
+        quantiles = self.quantiles if quantiles is None else quantiles
+        index = pd.RangeIndex(self.n_days) if dates is None else pd.DatetimeIndex(pd.to_datetime(dates)).rename('Date')
+        if self.is_exact(): # every simulation is still kept
+            return pd.DataFrame(row_quantiles(self.levels[0], quantiles), index=index)
+
+        ## weighted quantiles of the kept values, ignoring nans
+        values = np.concatenate(self.levels, axis=1)
+        weights = np.concatenate([np.full(level.shape[1], 2.0**i) for i, level in enumerate(self.levels)])
+        order = np.argsort(values, axis=1)
+        values = np.take_along_axis(values, order, axis=1)
+        weights = np.where(np.isnan(values), 0, weights[order])
+        cum_weights = np.cumsum(weights, axis=1) # value j covers ranks cum_weights[j]-weights[j] to cum_weights[j]-1
+        total = cum_weights[:, -1]
+        summary = dict()
+        with np.errstate(invalid='ignore'):
+            for name, q in quantiles.items():
+                h = (total - 1)*q
+                lo = np.floor(h)
+                rank_values = []
+                for rank in [lo, np.minimum(lo + 1, total - 1)]:
+                    j = np.minimum((cum_weights <= rank[:, None]).sum(axis=1), values.shape[1] - 1)
+                    rank_values.append(values[np.arange(self.n_days), j])
+                summary[name] = np.where(total > 0, lerp(rank_values[0], rank_values[1], h - lo), np.nan)
+        return pd.DataFrame(summary, index=index)
+
+class WindowSketch(object):
+
+    def __init__(self, dates, windows=('daily',), k=None, quantiles=summary_quantiles, writer=None):
+        """
+        streaming summary of an ensemble over one or more windows, so chunks of simulations go straight from the
+        predictions to the binned outputs without the ensemble ever being written. Windows of the same length are pooled
+        into one QuantileSketch whose rows are the windows' days times simulations, so with k None the summaries equal
+        summarize on the full ensemble
+
+        Parameters
+        ----------
+        dates : array-like
+            date of each row of the chunks.
+        windows : list, optional
+            any of 'daily', 'weekly', 'monthly', and 'ozone_season' (see summarize). The default is ('daily',).
+        k : int, optional
+            values kept per level of each sketch (see QuantileSketch). The default is None (every simulation is kept and
+            summaries are exact).
+        quantiles : dict, optional
+            column name to quantile. The default is summary_quantiles.
+        writer : object, optional
+            writer whose write_sims also receives every chunk (e.g., from MC_output.open_writer) to keep the raw
+            ensemble too. The default is None (only summaries).
+
+        """
+        dates = pd.DatetimeIndex(pd.to_datetime(dates))
+        self.n_days = len(dates)
+        self.writer = writer
+        self.k = k
+        self.quantiles = quantiles
+        order = np.argsort(dates, kind='stable') # windows are consecutive days
+        sorted_dates = dates[order]
+        self.index = dict() # window to the label of each of its windows
+        self.groups = dict() # window to (positions, rows, sketch) of each window length
+        for window in windows:
+            if window == 'daily':
+                index = dates.rename('Date')
+                rows = np.arange(self.n_days)
+                sizes = np.ones(self.n_days, dtype=int)
+            elif window in window_rules:
+                sizes = pd.Series(0, index=sorted_dates).resample(window_rules[window]).size()
+                index = sizes.index.rename('Date')
+                rows, sizes = order, sizes.to_numpy()
+            elif window == 'ozone_season':
+                in_season = np.isin(sorted_dates.month, ozone_season_months)
+                sizes = pd.Series(sorted_dates.year[in_season]).value_counts().sort_index()
+                index = pd.Index(sizes.index, name='year')
+                rows, sizes = order[in_season], sizes.to_numpy()
+            else:
+                raise ValueError('unknown window '+str(window))
+            starts = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(int)
+            self.index[window] = index
+            self.groups[window] = []
+            for size in np.unique(sizes[sizes > 0]):
+                positions = np.flatnonzero(sizes == size)
+                window_rows = rows[starts[positions][:, None] + np.arange(size)] # (n_windows, size) rows of each window
+                sketch = QuantileSketch(len(positions), np.inf if k is None else k, quantiles)
+                self.groups[window].append((positions, window_rows, sketch))
+        self.count = 0 # number of simulations folded in
+
+    def is_exact(self):
+        """
+        returns whether no values have been compacted, i.e., finalize gives exact quantiles
+        """
+        return all(sketch.is_exact() for groups in self.groups.values() for _, _, sketch in groups)
+
+    def write_sims(self, start, stop, values):
+        """
+        folds in simulations start through stop-1 of every day; same signature as MC_output.EnsembleWriter.write_sims so
+        it can be the out of propagate_batched
+        """
+        if self.writer is not None:
+            self.writer.write_sims(start, stop, values)
+        self.update(values)
+
+    def update(self, values):
+        """
+        folds an (n_days, n_sims_chunk) block of simulations into every window
+        """
+        values = np.asarray(values, dtype=float)
+        if values.shape[0] != self.n_days:
+            raise ValueError('block has '+str(values.shape[0])+' days, not '+str(self.n_days))
+        for groups in self.groups.values():
+            for _, rows, sketch in groups: # pool the days of each window
+                sketch.update(values[rows].reshape(len(rows), -1))
+        self.count += values.shape[1]
+
+    def finalize(self):
+        """
+        returns the summaries of every window, like summarize
+
+        Returns
+        -------
+        summaries : dict
+            window to a dataframe of the quantiles; windows without days are nan.
+
+        """
+        summaries = dict()
+        for window, index in self.index.items():
+            summary = {name: np.full(len(index), np.nan) for name in self.quantiles}
+            for positions, _, sketch in self.groups[window]:
+                block = sketch.finalize()
+                for name in self.quantiles:
+                    summary[name][positions] = block[name].to_numpy()
+            summaries[window] = pd.DataFrame(summary, index=index)
+        return summaries
+
+class ConvergenceCheck(object):
+
+    def __init__(self, tolerance=0.02, n_sims_min=500, day_fraction=0.99, quantiles=summary_quantiles, z=1.96):
+        """
+        stopping rule of adaptive Monte Carlo runs, called after each chunk of simulations (the converged argument of
+        MC_propagation.propagate_batched, or the convergence of an MC_parallel.PropagationJob). The standard error of
+        each quantile of each day is estimated without assuming a distribution, from the confidence interval of its
+        order statistic: the quantiles at q -/+ z*sqrt(q*(1-q)/n_sims), divided by 2z. A day has converged once every
+        standard error is within tolerance times the width of the day's interval (largest minus smallest quantile), and
+        the run once day_fraction of the days have
+
+        Parameters
+        ----------
+        tolerance : float, optional
+            largest standard error of a quantile relative to the width of the day's interval. The default is 0.02.
+        n_sims_min : int, optional
+            number of simulations before convergence is first checked. The default is 500.
+        day_fraction : float, optional
+            fraction of days that must have converged; 1 for every day. The default is 0.99.
+        quantiles : dict, optional
+            column name to quantile. The default is summary_quantiles.
+        z : float, optional
+            normal quantile of the confidence intervals. The default is 1.96.
+
+        """
+        self.tolerance = tolerance
+        self.n_sims_min = n_sims_min
+        self.day_fraction = day_fraction
+        self.quantiles = quantiles
+        self.z = z
+        self.n_sims = 0 # simulations at the last check
+        self.converged = False
+        self.converged_days = np.nan # fraction of days converged at the last check
+        self.relative_errors = dict() # quantile to standard error over interval width, at day_fraction of days
+
+    def __call__(self, y, n_sims):
+        """
+        returns whether the first n_sims simulations of y have converged
+
+        Parameters
+        ----------
+        y : ndarray or QuantileSketch
+            (n_days, >= n_sims) array of simulations, or a sketch of exactly the first n_sims.
+        n_sims : int
+            number of simulations run so far.
+
+        Returns
+        -------
+        converged : bool
+
+        """
+        self.n_sims = n_sims
+        if n_sims < self.n_sims_min:
+            return False
+        # quantiles at both ends of the confidence interval of every quantile
+        levels = dict(self.quantiles)
+        for name, q in self.quantiles.items():
+            half_width = self.z*np.sqrt(q*(1 - q)/n_sims)
+            levels[name+'_lo'], levels[name+'_hi'] = max(q - half_width, 0), min(q + half_width, 1)
+        if isinstance(y, QuantileSketch):
+            estimates = {name: values.to_numpy() for name, values in y.finalize(quantiles=levels).items()}
+        else:
+            estimates = row_quantiles(y[:, :n_sims], levels)
+        names = sorted(self.quantiles, key=self.quantiles.get)
+        width = estimates[names[-1]] - estimates[names[0]]
+        ratios = dict()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for name in names: # days with no spread have converged once their quantiles have no spread either
+                error = (estimates[name+'_hi'] - estimates[name+'_lo'])/(2*self.z)
+                ratios[name] = np.where(width > 0, error/width, np.where(error > 0, np.inf, 0.))
+        days = ~np.isnan(width) # days with missing simulations are left out
+        converged_days = np.all([ratios[name][days] <= self.tolerance for name in names], axis=0)
+        self.converged_days = float(converged_days.mean()) if days.any() else 1.
+        self.relative_errors = {name: float(np.quantile(ratios[name][days], self.day_fraction)) if days.any() else 0.
+                                for name in names}
+        self.converged = self.converged_days >= self.day_fraction
+        return self.converged
+
+    def report(self):
+        """
+        returns the precision of the last check as a json-safe dict, e.g., for the attrs of the output
+        """
+        return {'n_sims': int(self.n_sims), 'converged': bool(self.converged), 'tolerance': self.tolerance,
+                'day_fraction': self.day_fraction, 'converged_days': self.converged_days,
+                'relative_errors': self.relative_errors}
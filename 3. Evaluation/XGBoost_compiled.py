@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 12:19:49 2026
+
+optional compiled backend for Monte Carlo predictions
+the trees of a fitted XGB model are written out as C code (as Treelite does), built into a shared library with the
+    system C compiler, and called through ctypes. Each tree is compiled in as a complete binary tree that is descended
+    without branching, one block of rows at a time. A compiled model is only used after its predictions match
+    xgboost on the observed features; without a compiler (or if the check fails) xgboost is used as before
+
+@author: emei3
+"""
+
+## imports
+import os
+import stat
+import ctypes
+import hashlib
+import shutil
+import subprocess
+import numpy as np
+import pandas as pd
+from XGBoost_inference import load_model_json, get_base_score, PrunedPredictor
+
+# folder where compiled models are kept between runs, in the user's home; libraries are named by the hash of their
+# source
+build_dir = os.path.join(os.path.expanduser('~'), '.cache', 'xgb_compiled')
+
+def get_build_dir():
+    """
+    returns the folder of compiled models, created readable and writable by this user only; raises RuntimeError if it is
+    a link, belongs to another user, or others can write to it, since any library in it is loaded into this process
+    """
+    os.makedirs(build_dir, mode=0o700, exist_ok=True)
+    info = os.lstat(build_dir)
+    if not stat.S_ISDIR(info.st_mode):
+        raise RuntimeError(build_dir+' is not a folder')
+    if hasattr(os, 'getuid'): # owners and permission bits are only meaningful on posix
+        if info.st_uid != os.getuid():
+            raise RuntimeError(build_dir+' belongs to another user')
+        if info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            raise RuntimeError(build_dir+' can be written by other users; make it private (chmod 700)')
+    return build_dir
+
+def find_compiler():
+    """
+    returns the path of the C compiler ($CC, cc, gcc, or clang), or None if there is none
+    """
+    for compiler in [os.environ.get('CC'), 'cc', 'gcc', 'clang']:
+        if compiler and shutil.which(compiler):
+            return shutil.which(compiler)
+    return None
+
+def complete_tree(tree):
+    """
+    lays a JSON tree out as a complete binary tree of its maximum depth, so it can be descended without branching:
+    node i has children 2i+1 and 2i+2. Leaves above the maximum depth are copied down to every leaf below them
+
+    Returns
+    -------
+    depth : int
+        maximum depth of the tree.
+    features : list
+        split feature of each of the 2^depth-1 internal nodes.
+    thresholds : list
+        split threshold of each internal node.
+    default_left : list
+        whether missing values go left at each internal node.
+    leaves : list
+        value of each of the 2^depth leaves.
+
+    """
+    left_children = tree['left_children']
+    right_children = tree['right_children']
+    if any(split_type != 0 for split_type in tree.get('split_type', [])):
+        raise ValueError('categorical splits are not supported')
+    def node_depth(node):
+        if left_children[node] == -1:
+            return 0
+        return 1 + max(node_depth(left_children[node]), node_depth(right_children[node]))
+    depth = node_depth(0)
+
+    features = [0] * (2**depth - 1)
+    thresholds = [0.0] * (2**depth - 1)
+    default_left = [1] * (2**depth - 1)
+    leaves = [0.0] * 2**depth
+    def place(node, position, level):
+        if level == depth: # leaf at the bottom
+            leaves[position - (2**depth - 1)] = tree['split_conditions'][node]
+        elif left_children[node] == -1: # leaf above the bottom; both branches lead to its value
+            place(node, 2*position+1, level+1)
+            place(node, 2*position+2, level+1)
+        else:
+            features[position] = tree['split_indices'][node]
+            thresholds[position] = tree['split_conditions'][node]
+            default_left[position] = int(tree['default_left'][node])
+            place(left_children[node], 2*position+1, level+1)
+            place(right_children[node], 2*position+2, level+1)
+    place(0, 0, 0)
+    return depth, features, thresholds, default_left, leaves
+
+def float_literals(values):
+    """
+    returns exact C literals of float32 values, comma separated
+    """
+    return ', '.join(float(np.float32(value)).hex()+'f' for value in values)
+
+def int_literals(values):
+    """
+    returns C literals of integers, comma separated
+    """
+    return ', '.join(str(int(value)) for value in values)
+
+def model_source(model, tree_ids, base_score):
+    """
+    returns C source of predict(X, n_rows, n_features, n_threads, out), which sums the margin of tree_ids plus
+    base_score for each row of the float32 array X. The trees are compiled in as constant arrays of complete trees;
+    rows are processed in blocks with trees in the outer loop, and each row still adds its trees in boosting order
+    like xgboost. A split sends x < threshold left and missing values to the default side, the same as xgboost
+
+    Parameters
+    ----------
+    model : dict
+        JSON model (from XGBoost_inference.load_model_json).
+    tree_ids : list
+        trees to compile.
+    base_score : float
+        starting margin of every row.
+
+    Returns
+    -------
+    source : string
+
+    """
+    trees = model['learner']['gradient_booster']['model']['trees']
+    depths, node_starts, leaf_starts = [], [0], [0]
+    features, thresholds, default_left, leaves = [], [], [], []
+    for i in tree_ids:
+        depth, tree_features, tree_thresholds, tree_default_left, tree_leaves = complete_tree(trees[i])
+        depths.append(depth)
+        features += tree_features
+        thresholds += tree_thresholds
+        default_left += tree_default_left
+        leaves += tree_leaves
+        node_starts.append(len(features))
+        leaf_starts.append(len(leaves))
+
+    source = ['#include <math.h>',
+              '',
+              '#define N_TREES '+str(len(tree_ids)),
+              '#define BLOCK 256',
+              'static const int depths[] = {'+int_literals(depths + [0])+'};',
+              'static const long node_starts[] = {'+int_literals(node_starts)+'};',
+              'static const long leaf_starts[] = {'+int_literals(leaf_starts)+'};',
+              'static const int features[] = {'+int_literals(features + [0])+'};',
+              'static const float thresholds[] = {'+float_literals(thresholds + [0])+'};',
+              'static const unsigned char default_left[] = {'+int_literals(default_left + [0])+'};',
+              'static const float leaves[] = {'+float_literals(leaves)+'};',
+              '',
+              '// adds one complete tree of depth DEPTH to the margin of each row; the descent is unrolled for each depth',
+              '// and LANES rows descend together so their memory loads overlap',
+              '// go to the right child unless x < threshold, or x is missing and missing values go left',
+              '#define LANES 8',
+              '#define TREE_KERNEL(DEPTH) \\',
+              'static void add_tree_##DEPTH(const float* X, long n, long n_features, const int* f, const float* t, \\',
+              '                             const unsigned char* d, const float* l, float* margin) { \\',
+              '  long r = 0; \\',
+              '  for (; r + LANES <= n; r += LANES) { \\',
+              '    long i[LANES] = {0}; \\',
+              '    for (int level = 0; level < DEPTH; ++level) { \\',
+              '      for (int k = 0; k < LANES; ++k) { \\',
+              '        const float v = X[(r+k)*n_features + f[i[k]]]; \\',
+              '        i[k] = 2*i[k] + 1 + (!(v < t[i[k]]) & !(isnan(v) & d[i[k]])); \\',
+              '      } \\',
+              '    } \\',
+              '    for (int k = 0; k < LANES; ++k) margin[r+k] += l[i[k] - ((1L << DEPTH) - 1)]; \\',
+              '  } \\',
+              '  for (; r < n; ++r) { \\',
+              '    long i = 0; \\',
+              '    for (int level = 0; level < DEPTH; ++level) { \\',
+              '      const float v = X[r*n_features + f[i]]; \\',
+              '      i = 2*i + 1 + (!(v < t[i]) & !(isnan(v) & d[i])); \\',
+              '    } \\',
+              '    margin[r] += l[i - ((1L << DEPTH) - 1)]; \\',
+              '  } \\',
+              '}']
+    source += ['TREE_KERNEL('+str(depth)+')' for depth in sorted(set(depths))]
+    source += ['',
+              'static void predict_block(const float* X, long n, long n_features, float* margin) {',
+              '  for (long r = 0; r < n; ++r) margin[r] = '+float(np.float32(base_score)).hex()+'f;',
+              '  for (int tree = 0; tree < N_TREES; ++tree) {',
+              '    const long node = node_starts[tree], leaf = leaf_starts[tree];',
+              '    switch (depths[tree]) {']
+    source += ['      case '+str(depth)+': add_tree_'+str(depth)+'(X, n, n_features, features + node, thresholds + node, '
+               'default_left + node, leaves + leaf, margin); break;' for depth in sorted(set(depths))]
+    source += ['    }',
+              '  }',
+              '}',
+              '',
+              'void predict(const float* X, long n_rows, long n_features, int n_threads, float* out) {',
+              '  if (n_threads <= 0) n_threads = 1;',
+              '  #pragma omp parallel for num_threads(n_threads) schedule(static)',
+              '  for (long start = 0; start < n_rows; start += BLOCK) {',
+              '    long n = n_rows - start < BLOCK ? n_rows - start : BLOCK;',
+              '    predict_block(X + start*n_features, n, n_features, out + start);',
+              '  }',
+              '}', '']
+    return '\n'.join(source)
+
+def build_library(source):
+    """
+    compiles C source into a shared library (with OpenMP if the compiler supports it) unless it was already built
+
+    Returns
+    -------
+    path : string
+        path of the shared library.
+
+    """
+    compiler = find_compiler()
+    if compiler is None:
+        raise RuntimeError('no C compiler found')
+    folder = get_build_dir()
+    name = hashlib.sha256((compiler+source).encode()).hexdigest()[:20]
+    path = os.path.join(folder, name+'.so')
+    if os.path.exists(path):
+        return path
+
+    path_source = os.path.join(folder, name+'.c')
+    with open(path_source, 'w') as f:
+        f.write(source)
+    temp_path = path+'.'+str(os.getpid())+'.tmp' # processes may build the same model at once
+    for flags in [['-fopenmp'], []]:
+        result = subprocess.run([compiler, '-O3', '-shared', '-fPIC', *flags, path_source, '-o', temp_path, '-lm'],
+                                capture_output=True, text=True)
+        if result.returncode == 0:
+            os.replace(temp_path, path)
+            return path
+    raise RuntimeError('compiling '+path_source+' failed:\n'+result.stderr[-2000:])
+
+class CompiledTrees(object):
+
+    def __init__(self, model, tree_ids=None, base_score=None, nthread=None):
+        """
+        trees of a JSON model compiled into a shared library. Has the inplace_predict method of an xgboost Booster
+        (margin only), so it can replace one
+
+        Parameters
+        ----------
+        model : dict
+            JSON model (from XGBoost_inference.load_model_json).
+        tree_ids : list, optional
+            trees to compile. The default is None (all trees).
+        base_score : float, optional
+            starting margin. The default is None (base score of the model).
+        nthread : int, optional
+            number of threads for prediction. The default is None (all cores, like xgboost).
+
+        """
+        n_trees = len(model['learner']['gradient_booster']['model']['trees'])
+        self.tree_ids = list(range(n_trees)) if tree_ids is None else list(tree_ids)
+        self.base_score = get_base_score(model) if base_score is None else base_score
+        self.n_features = int(model['learner']['learner_model_param']['num_feature'])
+        self.nthread = nthread or os.cpu_count()
+        self.library_path = build_library(model_source(model, self.tree_ids, self.base_score))
+        try:
+            self.library = ctypes.CDLL(self.library_path)
+        except OSError: # truncated or broken library; rebuilt next time
+            os.remove(self.library_path)
+            raise
+        self.library.predict.argtypes = [ctypes.c_void_p, ctypes.c_long, ctypes.c_long, ctypes.c_int, ctypes.c_void_p]
+        self.library.predict.restype = None
+
+    def inplace_predict(self, X, predict_type='margin'):
+        """
+        returns the float32 margin of each row of X
+
+        Parameters
+        ----------
+        X : array-like
+            (n_rows, n_features) features in the order the model was fit with.
+        predict_type : string, optional
+            only 'margin' is supported. The default is 'margin'.
+
+        Returns
+        -------
+        y : ndarray
+            (n_rows,) margins.
+
+        """
+        if predict_type != 'margin':
+            raise ValueError('compiled trees only predict the margin')
+        X = np.ascontiguousarray(np.asarray(X, dtype=np.float32))
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError('expected '+str(self.n_features)+' features, got shape '+str(X.shape))
+        y = np.empty(X.shape[0], dtype=np.float32)
+        self.library.predict(X.ctypes.data, X.shape[0], X.shape[1], self.nthread, y.ctypes.data)
+        return y
+
+class CompiledRegressor(object):
+
+    def __init__(self, compiled_trees):
+        """
+        wraps compiled trees of a whole model with the predict method of an XGBRegressor (identity objectives only)
+        """
+        self.compiled_trees = compiled_trees
+
+    def predict(self, X):
+        return self.compiled_trees.inplace_predict(X)
+
+def check_parity(y, y_reference, name):
+    """
+    raises ValueError unless compiled predictions match xgboost to float32 precision
+    """
+    tolerance = 1e-5*max(1.0, float(np.nanmax(np.abs(y_reference))))
+    if y.shape != y_reference.shape or not np.allclose(y, y_reference, rtol=0, atol=tolerance, equal_nan=True):
+        raise ValueError('compiled '+name+' does not match xgboost (max difference '+
+                         str(np.nanmax(np.abs(y - y_reference)))+')')
+
+def compile_predictor(predictor, feature_names, X_base, nthread=None):
+    """
+    compiles the trees a predictor evaluates for every simulation and checks them against xgboost on the observed
+    features. Falls back to the predictor unchanged if there is no C compiler or the check fails
+
+    Parameters
+    ----------
+    predictor : XGBoost model or XGBoost_inference.PrunedPredictor
+        fitted model, or a PrunedPredictor (only its varying trees are compiled).
+    feature_names : list
+        feature names in the order the model was fit with.
+    X_base : array-like
+        (n_days, n_features) observed features used for the parity check.
+    nthread : int, optional
+        number of threads for prediction. The default is None (all cores, like xgboost).
+
+    Returns
+    -------
+    predictor : predictor with the same predict method
+        compiled predictor, or the original one if compiling was not possible.
+
+    """
+    X_check = np.asarray(X_base, dtype=np.float32)
+    try:
+        if isinstance(predictor, PrunedPredictor):
+            if predictor.varying_booster is None: # nothing evaluated per simulation
+                return predictor
+            compiled = CompiledTrees(load_model_json(predictor.varying_booster), nthread=nthread)
+            check_parity(compiled.inplace_predict(X_check),
+                         predictor.varying_booster.inplace_predict(X_check, predict_type='margin'), 'varying trees')
+            predictor.varying_booster = compiled
+            return predictor
+        compiled = CompiledRegressor(CompiledTrees(load_model_json(predictor), nthread=nthread))
+        check_parity(compiled.predict(X_check),
+                     predictor.predict(pd.DataFrame(X_check, columns=feature_names, copy=False)), 'model')
+        return compiled
+    except (RuntimeError, ValueError, OSError) as error: # OSError if a library cannot be loaded
+        print('using xgboost instead of a compiled model: '+str(error))
+        return predictor
@@ -11,8 +11,8 @@ needs to have run XGBoost_fit for all targets at the site
 ## imports
 import os
 import matplotlib.pyplot as plt
+import sys
 import numpy as np
-import joblib
 import pandas as pd
 from sklearn.model_selection import KFold
 from sklearn.model_selection import cross_validate
@@ -20,6 +20,8 @@ import xgboost as xgb
 from sklearn.metrics import r2_score
 from sklearn.metrics import mean_squared_error
 from sklearn.metrics import mean_absolute_percentage_error
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../2. Models'))
+from XGBoost_registry import load_model # native models cached across targets and methods
 
 class XGBeval(object):
     
@@ -69,7 +71,7 @@ class XGBeval(object):
             
             ## load model
             os.chdir("./Fitted Models/"+self.site)
-            regressor = joblib.load(fn+"_XGB.json")
+            regressor = load_model(".", fn)
             os.chdir("../..") # change back to data folder
             
             ## grab importances
@@ -259,7 +261,7 @@ class XGBeval(object):
             
             ## load model
             os.chdir("./Fitted Models/" + self.site)
-            regressor = joblib.load(fn+"_XGB.json")
+            regressor = load_model(".", fn)
             os.chdir("../..") # change back to data folder
             
             ## evaluate training data
@@ -332,7 +334,7 @@ class XGBeval(object):
     
             ## load model
             os.chdir("./Fitted Models/" + self.site)
-            regressor = joblib.load(fn+"_XGB.json")
+            regressor = load_model(".", fn)
             os.chdir("../..") # change back to data folder
     
             ## use model to calculate modeled y values
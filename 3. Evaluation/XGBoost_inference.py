@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 11:56:40 2026
+
+faster inference for fitted XGB models when only a few features change between Monte Carlo simulations
+PrunedPredictor splits the trees of a fitted model into trees that never split on a varying feature (summed once per day)
+    and trees that do (the only ones evaluated for every simulation)
+StepFunctionTable tabulates the exact per-day response to the EGU features so simulations become lookups
+
+@author: emei3
+"""
+
+## imports
+import copy
+import json
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+
+# objectives whose margin is the prediction, so tree outputs can be summed in pieces
+identity_objectives = ['reg:squarederror', 'reg:absoluteerror', 'reg:pseudohubererror', 'reg:quantileerror']
+
+def load_model_json(regressor, check_margin=True):
+    """
+    retrieves the JSON description of a fitted model and checks that it can be evaluated tree by tree
+
+    Parameters
+    ----------
+    regressor : XGBoost model
+        fitted XGBRegressor (or Booster).
+    check_margin : bool, optional
+        whether the objective must predict on the margin scale. The default is True.
+
+    Returns
+    -------
+    model : dict
+        JSON model.
+
+    """
+    booster = regressor.get_booster() if hasattr(regressor, 'get_booster') else regressor
+    model = json.loads(booster.save_raw('json'))
+    learner = model['learner']
+    if learner['gradient_booster']['name'] != 'gbtree':
+        raise ValueError('only gbtree models can be split by tree, not '+learner['gradient_booster']['name'])
+    if check_margin and learner['objective']['name'] not in identity_objectives:
+        raise ValueError('objective '+learner['objective']['name']+' does not predict on the margin scale')
+    if learner['gradient_booster']['model']['gbtree_model_param']['num_parallel_tree'] != '1':
+        raise ValueError('models with more than one parallel tree are not supported')
+    return model
+
+def get_base_score(model):
+    """
+    returns the base score (starting margin) of a JSON model as a float
+    """
+    return float(model['learner']['learner_model_param']['base_score'].strip('[]'))
+
+def tree_split_features(tree):
+    """
+    returns the set of feature positions that a JSON tree splits on (leaves are ignored)
+    """
+    left_children = np.array(tree['left_children'])
+    split_indices = np.array(tree['split_indices'])
+    return set(split_indices[left_children != -1].tolist())
+
+def sub_booster(model, tree_ids):
+    """
+    builds a booster from a subset of the trees of a JSON model with a base score of 0, so its margin is the
+    sum of those trees only
+
+    Parameters
+    ----------
+    model : dict
+        JSON model (from load_model_json).
+    tree_ids : list
+        trees to keep, in boosting order.
+
+    Returns
+    -------
+    booster : XGBoost Booster
+
+    """
+    model = copy.deepcopy(model)
+    learner = model['learner']
+    gbtree = learner['gradient_booster']['model']
+    trees = [gbtree['trees'][i] for i in tree_ids]
+    for new_id, tree in enumerate(trees): # trees must be numbered in order
+        tree['id'] = new_id
+    gbtree['trees'] = trees
+    gbtree['tree_info'] = [gbtree['tree_info'][i] for i in tree_ids]
+    gbtree['gbtree_model_param']['num_trees'] = str(len(trees))
+    if 'iteration_indptr' in gbtree:
+        gbtree['iteration_indptr'] = list(range(len(trees)+1))
+    # keep the formatting (scalar or vector) that this xgboost version uses
+    base_score = learner['learner_model_param']['base_score']
+    learner['learner_model_param']['base_score'] = '[0E0]' if base_score.startswith('[') else '0E0'
+
+    booster = xgb.Booster()
+    booster.load_model(bytearray(json.dumps(model).encode()))
+    return booster
+
+def remap_features(regressor, feature_names, layout_names):
+    """
+    rewrites the split features of a fitted model so it reads features in the column order of layout_names instead of
+    the order it was fit with; lets models of several targets predict from one feature block without copying columns
+
+    Parameters
+    ----------
+    regressor : XGBoost model
+        fitted model.
+    feature_names : list
+        feature names in the order the model was fit with.
+    layout_names : list
+        feature names of the block the model will predict from; must contain every name in feature_names.
+
+    Returns
+    -------
+    regressor : XGBoost model
+        XGBRegressor with the same trees whose features are layout_names.
+
+    """
+    model = load_model_json(regressor, check_margin=False)
+    feature_names = list(feature_names)
+    layout_names = list(layout_names)
+    missing = [feature for feature in feature_names if feature not in layout_names]
+    if len(missing) > 0:
+        raise ValueError('features '+str(missing)+' are not in the layout')
+    new_index = np.array([layout_names.index(feature) for feature in feature_names])
+
+    learner = model['learner']
+    for tree in learner['gradient_booster']['model']['trees']:
+        if len(tree['categories']) > 0:
+            raise ValueError('models with categorical splits cannot be remapped')
+        tree['split_indices'] = new_index[tree['split_indices']].tolist()
+        tree['tree_param']['num_feature'] = str(len(layout_names))
+    feature_types = dict(zip(feature_names, learner['feature_types'] or ['float']*len(feature_names)))
+    learner['feature_names'] = layout_names
+    learner['feature_types'] = [feature_types.get(feature, 'float') for feature in layout_names]
+    learner['learner_model_param']['num_feature'] = str(len(layout_names))
+
+    remapped = xgb.XGBRegressor()
+    remapped.load_model(bytearray(json.dumps(model).encode()))
+    return remapped
+
+class PrunedPredictor(object):
+
+    def __init__(self, regressor, feature_names, varying_features, X_base, nthread=None):
+        """
+        splits the trees of regressor by whether they split on any of varying_features and sums the invariant
+        trees for each day of X_base. Can be passed to MC_propagation functions in place of regressor
+
+        Parameters
+        ----------
+        regressor : XGBoost model
+            fitted model.
+        feature_names : list
+            feature names in the order the model was fit with.
+        varying_features : list
+            features that change between simulations (EGU emissions, mobile and other emissions).
+        X_base : array-like
+            (n_days, n_features) observed features; all features not in varying_features must be the same in
+            every simulation.
+        nthread : int, optional
+            number of threads for prediction. The default is None (xgboost default).
+
+        """
+        model = load_model_json(regressor)
+        self.feature_names = list(feature_names)
+        self.base_score = np.float32(get_base_score(model))
+
+        ## split trees
+        varying_cols = {self.feature_names.index(feature) for feature in varying_features}
+        trees = model['learner']['gradient_booster']['model']['trees']
+        self.varying_trees = [i for i, tree in enumerate(trees) if tree_split_features(tree) & varying_cols]
+        self.invariant_trees = sorted(set(range(len(trees))) - set(self.varying_trees))
+
+        ## sum invariant trees once per day
+        X_base = np.asarray(X_base, dtype=np.float32)
+        self.n_days = X_base.shape[0]
+        if len(self.invariant_trees) > 0:
+            invariant_booster = sub_booster(model, self.invariant_trees)
+            if nthread is not None:
+                invariant_booster.set_param({'nthread': nthread})
+            self.invariant_margin = self.base_score + invariant_booster.inplace_predict(X_base, predict_type='margin')
+        else:
+            self.invariant_margin = np.full(self.n_days, self.base_score, dtype=np.float32)
+
+        ## booster of the trees evaluated for every simulation
+        self.varying_booster = None
+        if len(self.varying_trees) > 0:
+            self.varying_booster = sub_booster(model, self.varying_trees)
+            if nthread is not None:
+                self.varying_booster.set_param({'nthread': nthread})
+
+    def predict(self, X_stacked, days=None):
+        """
+        predicts stacked simulations; unless days is given, rows must be whole simulations of n_days each, in the same
+        day order as X_base
+
+        Parameters
+        ----------
+        X_stacked : array-like
+            (n_sims_chunk*n_days, n_features) features.
+        days : ndarray, optional
+            day (row of X_base) of each row of X_stacked, for stacks of partial simulations. The default is None.
+
+        Returns
+        -------
+        y : ndarray
+            (n_sims_chunk*n_days,) predictions.
+
+        """
+        n_rows = X_stacked.shape[0]
+        if days is None:
+            y = np.tile(self.invariant_margin, n_rows // self.n_days)
+        else:
+            y = self.invariant_margin[days]
+        if self.varying_booster is not None:
+            y += self.varying_booster.inplace_predict(X_stacked, predict_type='margin')
+        return y
+
+def tree_node_order(tree):
+    """
+    returns the nodes of a JSON tree in breadth-first order (every parent before its children)
+    """
+    left_children = tree['left_children']
+    right_children = tree['right_children']
+    order = [0]
+    for node in order:
+        if left_children[node] != -1:
+            order.extend([left_children[node], right_children[node]])
+    return order
+
+def reachable_thresholds(model, X_base, step_cols):
+    """
+    finds, for each day, the split thresholds on step_cols that can be reached when every other feature is held at
+    its observed value for that day
+
+    Parameters
+    ----------
+    model : dict
+        JSON model (from load_model_json).
+    X_base : ndarray
+        (n_days, n_features) observed features.
+    step_cols : list
+        positions of the features that change between simulations.
+
+    Returns
+    -------
+    thresholds : list
+        parallel to step_cols; each entry is a list with a sorted array of unique float32 thresholds for each day.
+
+    """
+    X_base = np.asarray(X_base, dtype=np.float32)
+    n_days = X_base.shape[0]
+    found_days = {col: [] for col in step_cols}
+    found_thresholds = {col: [] for col in step_cols}
+
+    for tree in model['learner']['gradient_booster']['model']['trees']:
+        left_children = tree['left_children']
+        right_children = tree['right_children']
+        split_indices = tree['split_indices']
+        split_conditions = np.array(tree['split_conditions'], dtype=np.float32)
+        default_left = tree['default_left']
+        reach = np.zeros((len(left_children), n_days), dtype=bool) # days that can reach each node
+        reach[0] = True
+        for node in tree_node_order(tree):
+            if left_children[node] == -1 or not reach[node].any(): # leaf or never reached
+                continue
+            col = split_indices[node]
+            if col in step_cols: # both branches can be reached depending on the simulation
+                days = np.flatnonzero(reach[node])
+                found_days[col].append(days)
+                found_thresholds[col].append(np.full(len(days), split_conditions[node]))
+                reach[left_children[node]] |= reach[node]
+                reach[right_children[node]] |= reach[node]
+            else: # branch is fixed for each day
+                x = X_base[:, col]
+                go_left = np.where(np.isnan(x), bool(default_left[node]), x < split_conditions[node])
+                reach[left_children[node]] |= reach[node] & go_left
+                reach[right_children[node]] |= reach[node] & ~go_left
+
+    ## sort unique thresholds by day
+    thresholds = []
+    for col in step_cols:
+        if len(found_days[col]) == 0:
+            thresholds.append([np.array([], dtype=np.float32)] * n_days)
+            continue
+        days = np.concatenate(found_days[col])
+        values = np.concatenate(found_thresholds[col])
+        order = np.lexsort((values, days))
+        days, values = days[order], values[order]
+        day_starts = np.searchsorted(days, np.arange(n_days+1))
+        thresholds.append([np.unique(values[day_starts[d]:day_starts[d+1]]) for d in range(n_days)])
+    return thresholds
+
+def step_representatives(day_thresholds, observed):
+    """
+    returns one value inside each interval between thresholds plus nan (missing): below the first threshold,
+    each threshold itself (the start of the next interval), and nan
+    """
+    if len(day_thresholds) == 0:
+        return np.array([observed, np.nan], dtype=np.float32)
+    below = np.nextafter(day_thresholds[0], np.float32(-np.inf))
+    return np.concatenate(([below], day_thresholds, [np.nan])).astype(np.float32)
+
+class StepFunctionTable(object):
+
+    def __init__(self, regressor, feature_names, step_features, X_base):
+        """
+        finds, for each day, the split thresholds of regressor on step_features with every other feature held at its
+        observed value. The model is piecewise constant between these thresholds, so one prediction per interval
+        (or per cell for two features) gives bit-identical predictions for any simulated values.
+        Check n_cells against the number of rows a plain Monte Carlo run would predict, then call fill()
+
+        Parameters
+        ----------
+        regressor : XGBoost model
+            fitted model.
+        feature_names : list
+            feature names in the order the model was fit with.
+        step_features : list
+            features that change between simulations (e.g., SO2EGU and NOxEGU); all others must be fixed.
+        X_base : array-like
+            (n_days, n_features) observed features.
+
+        """
+        model = load_model_json(regressor, check_margin=False) # table is filled with full predictions
+        self.regressor = regressor
+        self.feature_names = list(feature_names)
+        self.step_cols = [self.feature_names.index(feature) for feature in step_features]
+        self.X_base = np.asarray(X_base, dtype=np.float32)
+        self.n_days = self.X_base.shape[0]
+
+        ## thresholds that matter for each day
+        self.thresholds = reachable_thresholds(model, self.X_base, self.step_cols)
+
+        ## one cell per interval (plus missing) of each step feature
+        self.table_sizes = np.ones(self.n_days, dtype=int)
+        for day_thresholds in self.thresholds:
+            self.table_sizes *= np.array([len(t)+2 for t in day_thresholds])
+        self.table_starts = np.concatenate(([0], np.cumsum(self.table_sizes)))
+        self.n_cells = int(self.table_starts[-1])
+        self.table = None
+
+    def fill(self):
+        """
+        evaluates every cell of every day with the full model in a single prediction
+
+        Returns
+        -------
+        None.
+
+        """
+        grid = np.repeat(self.X_base, self.table_sizes, axis=0)
+        for d in range(self.n_days):
+            representatives = [step_representatives(day_thresholds[d], self.X_base[d, col])
+                               for day_thresholds, col in zip(self.thresholds, self.step_cols)]
+            cells = np.meshgrid(*representatives, indexing='ij')
+            for cell, col in zip(cells, self.step_cols):
+                grid[self.table_starts[d]:self.table_starts[d+1], col] = cell.ravel()
+        self.table = self.regressor.predict(pd.DataFrame(grid, columns=self.feature_names, copy=False))
+
+    def lookup(self, step_values):
+        """
+        predicts simulations by finding the cell of each simulated value
+
+        Parameters
+        ----------
+        step_values : list
+            parallel to step_features; (n_days, n_sims) arrays of simulated values (nan for missing).
+
+        Returns
+        -------
+        y_mc : ndarray
+            (n_days, n_sims) predictions.
+
+        """
+        if self.table is None:
+            self.fill()
+        step_values = [np.asarray(values, dtype=np.float32) for values in step_values]
+        y_mc = np.empty(step_values[0].shape, dtype=self.table.dtype)
+        for d in range(self.n_days):
+            flat_cell = 0
+            for day_thresholds, values in zip(self.thresholds, step_values):
+                t = day_thresholds[d]
+                cell = np.searchsorted(t, values[d], side='right') # 0 below first threshold, i from t[i-1] to t[i]
+                cell[np.isnan(values[d])] = len(t)+1 # missing
+                flat_cell = flat_cell*(len(t)+2) + cell
+            y_mc[d] = self.table[self.table_starts[d] + flat_cell]
+        return y_mc
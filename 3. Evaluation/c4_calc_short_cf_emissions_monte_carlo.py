@@ -19,6 +19,12 @@ from datetime import datetime
 abspath = os.path.abspath(__file__)
 base_dname = os.path.dirname(abspath)
 
+# import streaming ensemble writer and virtual ensembles
+os.chdir(base_dname)
+from MC_output import open_writer
+from MC_random import master_seed, record_seed, stream_seed
+from MC_ensemble import VirtualEnsemble, virtual_fn
+
 def least_squares_regression(x, y):
     """
     Performs a linear regression on a set of x, y data and returns the slope, 
@@ -53,35 +59,6 @@ def least_squares_regression(x, y):
 
     return slope, intercept, se_slope, se_intercept, r_squared, rmse
 
-def monte_carlo_regression_prediction(x, slope, intercept, se_slope, n_simulations=5000):
-    """
-    Uses a Monte Carlo method to predict a series of y values for a given set of x values using an regression. 
-    Assumes normal distribution around regression
-
-    Parameters:
-    x (array-like): The x values for which to predict y values.
-    slope (float): The slope of the regression line.
-    intercept (float): The intercept of the regression line.
-    se_slope (float): The standard error of the slope of the regression line.
-    se_intercept (float): The standard error of the intercept of the regression line.
-    n_simulations (int): The number of simulations to run. Default is 5000.
-
-    Returns:
-    y_mc (ndarray): An array of shape (n_simulations, len(x)) containing the predicted y values for each simulation and each x value.
-    """
-    y_mc = np.zeros((n_simulations, len(x)))
-
-    for i in range(n_simulations):
-        noise = np.random.normal(slope, se_slope, size=x.shape)
-        y_mc[i] = slope * x + intercept + noise
-        # ensure emissions can't go below 0
-        y_mc[i][y_mc[i] < 0] = 0
-    
-    output = pd.DataFrame(y_mc.T) # change to dataframe
-    column_names = ['column_' + str(i) for i in range(0, n_simulations)] # rename columns for easier saving
-    output.rename(columns=dict(zip(output.columns, column_names)), inplace=True)
-    return output
-
 def retrieve_emissions_and_stitch(group_of_states, years, rel_path_input):
     """
     retrieves emissions files for file names with "group_of_states_year.csv" from 'rel_path_input' folder
@@ -123,6 +100,75 @@ def retrieve_emissions_and_stitch(group_of_states, years, rel_path_input):
         
     return output_emissions
 
+def short_cf_ensembles(fn_end, years, rel_path_CEMS, rel_path_SD_act, rel_path_SD_cf, n_simulations, seed_seq,
+                       n_days_chunk=365, sampler='random'):
+    """
+    fits the regression of CEMS on simple dispatch actual emissions of one region and builds the virtual monte carlo
+    ensembles of its counterfactual so2 and nox emissions from the simple dispatch counterfactual; nothing is written,
+    so the ensembles can be saved (c4) or streamed straight into the ML models (e11)
+
+    Parameters
+    ----------
+    fn_end : list
+        groups of states of the region (e.g., ['SOCO']).
+    years : range
+        years to run.
+    rel_path_CEMS : string
+        folder with observed emissions.
+    rel_path_SD_act : string
+        folder with simple dispatch actual emissions.
+    rel_path_SD_cf : string
+        folder with simple dispatch counterfactual emissions.
+    n_simulations : int
+        number of simulations.
+    seed_seq : numpy SeedSequence
+        master seed; each species draws from its own c4 stream.
+    n_days_chunk : int, optional
+        days per tile of the virtual ensembles. The default is 365.
+    sampler : string, optional
+        sampler of the regression noise (see MC_sampling). The default is 'random'.
+
+    Returns
+    -------
+    regressions : dict
+        species to its regression stats (slope, intercept, se_slope, se_intercept, r_squared, rmse).
+    ensembles : dict
+        species to its VirtualEnsemble of counterfactual emissions.
+
+    """
+    ## assemble CEMS and SD_actual datasets
+    data_CEMS = retrieve_emissions_and_stitch(fn_end, years, rel_path_CEMS)
+    data_SD_act = retrieve_emissions_and_stitch(fn_end, years, rel_path_SD_act)
+    ## assmble SD_counterfactual dataset
+    data_SD_cf = retrieve_emissions_and_stitch(fn_end, years, rel_path_SD_cf)
+    ## dates of the monte carlo output
+    date_range = pd.date_range(datetime(years[0], 1, 1), datetime(years[-1], 12, 31), name='Date')
+    
+    regressions = dict()
+    ensembles = dict()
+    for species in ['so2', 'nox']:
+        ## perform regression
+        slope, intercept, se_slope, se_intercept, r_squared, rmse = least_squares_regression(
+            data_SD_act[species+'_tot'], data_CEMS[species+'_tot'])
+        regressions[species] = {'slope': slope, 'intercept': intercept, 'se_slope': se_slope,
+                                'se_intercept': se_intercept, 'r_squared': r_squared, 'rmse': rmse}
+        ## monte carlo method on emissions, regenerated n_days_chunk days at a time
+        ensembles[species] = VirtualEnsemble('regression', date_range, n_simulations, {'x': data_SD_cf[species+'_tot']},
+                                             {'slope': slope, 'intercept': intercept, 'se_slope': se_slope},
+                                             stream_seed(seed_seq, 'c4', '_'.join(fn_end), species),
+                                             n_days_block=n_days_chunk, sampler=sampler)
+    return regressions, ensembles
+
+def write_regression_stats(regressions, fn):
+    """
+    saves the regression stats of each species to its own sheet of an excel file
+    """
+    writer = pd.ExcelWriter(fn)
+    for species, stats in regressions.items():
+        df = pd.DataFrame({name: [value] for name, value in stats.items()})
+        df.to_excel(writer, sheet_name=species, index=False)
+    writer.close()
+
 if __name__ == '__main__':
     # relative file paths
     rel_path_CEMS = "../../Data/Simple Dispatch Outputs/2023-06-23 act/Actual CEMS" # folder with observed emissions
@@ -134,65 +180,53 @@ if __name__ == '__main__':
     years = range(2006, 2020)
     # filename endings to run the analysis for
     fn_ends = [['SOCO'], ['NYC']]
+    # number of simulations to run
+    n_simulations = 5000
+    # number of days simulated and written at a time; bounds memory to n_days_chunk*n_simulations values
+    n_days_chunk = 365
+    # how ensembles are saved: 'virtual' saves only the regression, counterfactual emissions, and seed
+    # (MC_ensemble.VirtualEnsemble), 'tensor' every simulation as a float32 .npy memory map with a json sidecar of dates
+    # (MC_output.TensorWriter), and 'parquet' a table with one column per simulation; MC_ensemble.read_ensemble reads
+    # any of them
+    ensemble_format = 'virtual'
+    # compact encoding of 'tensor' ensembles: None (float32), 'float16', or 'int16' (quantized between the minimum and
+    # maximum of each day); every value must be within max_abs_error + max_rel_error*|value| of its simulation, which is
+    # checked as it is written and recorded in the sidecar metadata
+    encoding = None
+    # largest absolute error of the encoding (kg/day); None for no absolute bound
+    max_abs_error = 1.
+    # largest relative error of the encoding; None for no relative bound
+    max_rel_error = 1e-3
+    # sampler of the regression noise of each block of days and simulations: 'random' (independent), 'antithetic', 'lhs' (Latin hypercube), or 'sobol'
+    # (scrambled Sobol, best with a power of 2 simulations per chunk); see MC_sampling
+    sampler = 'random'
+    # master seed of the monte carlo simulations; an int, the file of a recorded seed, or None to draw a new seed
+    # (recorded with the outputs)
+    seed = None
+    
+    seed_seq = master_seed(seed)
+    os.chdir(base_dname)
+    os.chdir(rel_path_output)
+    record_seed(seed_seq, 'seed_c4_'+str(years[0])+'-'+str(years[-1])+'.json') # reproduces this run as seed
     
     for fn_end in fn_ends:
     
-        ## assemble CEMS and SD_actual datasets
-        data_CEMS = retrieve_emissions_and_stitch(fn_end, years, rel_path_CEMS)
-        data_SD_act = retrieve_emissions_and_stitch(fn_end, years, rel_path_SD_act)
-        
-        ## perform regression
-        # so2
-        slope_so2, intercept_so2, se_slope_so2, se_intercept_so2, r_squared_so2, rmse_so2 = least_squares_regression(
-            data_SD_act['so2_tot'], data_CEMS['so2_tot'])
-        # nox
-        slope_nox, intercept_nox, se_slope_nox, se_intercept_nox, r_squared_nox, rmse_nox = least_squares_regression(
-            data_SD_act['nox_tot'], data_CEMS['nox_tot'])
+        ## perform regressions and build monte carlo ensembles
+        regressions, ensembles = short_cf_ensembles(fn_end, years, rel_path_CEMS, rel_path_SD_act, rel_path_SD_cf,
+                                                    n_simulations, seed_seq, n_days_chunk, sampler)
         
         ## save regression stats
         os.chdir(base_dname) # change to code directory
         os.chdir(rel_path_output) # change to output directory
-        writer = pd.ExcelWriter('regression_stats_'+'_'.join(fn_end)+'_'+str(years[0])+'-'+str(years[-1])+'.xlsx')
-        # save so2
-        df = pd.DataFrame({'slope': [slope_so2],
-                           'intercept': [intercept_so2],
-                           'se_slope': [se_slope_so2],
-                           'se_intercept': [se_intercept_so2],
-                           'r_squared': [r_squared_so2],
-                           'rmse': [rmse_so2]})
-        df.to_excel(writer, sheet_name='so2', index=False)
-        # save nox
-        df = pd.DataFrame({'slope': [slope_nox],
-                           'intercept': [intercept_nox],
-                           'se_slope': [se_slope_nox],
-                           'se_intercept': [se_intercept_nox],
-                           'r_squared': [r_squared_nox],
-                           'rmse': [rmse_nox]})
-        df.to_excel(writer, sheet_name='nox', index=False)
-        writer.close()
+        write_regression_stats(regressions, 'regression_stats_'+'_'.join(fn_end)+'_'+str(years[0])+'-'+str(years[-1])+'.xlsx')
         
-        ## assmble SD_counterfactual dataset
-        data_SD_cf = retrieve_emissions_and_stitch(fn_end, years, rel_path_SD_cf)
-        ## perform monte carlo method on emissions
-        # so2
-        data_cf_so2 = monte_carlo_regression_prediction(data_SD_cf['so2_tot'], slope_so2, intercept_so2, se_slope_so2)
-        # nox
-        data_cf_nox = monte_carlo_regression_prediction(data_SD_cf['nox_tot'], slope_nox, intercept_nox, se_slope_nox)
-        ## append date column to end of dataframe
-        # Generate a range of dates from 1/1/2006 to 12/31/2019
-        start_date = datetime(2006, 1, 1)
-        end_date = datetime(2019, 12, 31)
-        date_range = pd.date_range(start_date, end_date)
-        # Create a new dataframe with the date column
-        new_dataframe = pd.DataFrame({'Date': date_range})
-        # Concatenate the new dataframe with the existing dataframe
-        data_cf_so2 = pd.concat([data_cf_so2, new_dataframe], axis=1)
-        data_cf_nox = pd.concat([data_cf_nox, new_dataframe], axis=1)
-        # set index
-        data_cf_so2.set_index('Date', inplace=True)
-        data_cf_nox.set_index('Date', inplace=True)
-        ## saves monte carlo output as parquet file
-        os.chdir(base_dname) # change to code directory
-        os.chdir(rel_path_output) # change to output directory
-        data_cf_so2.to_parquet('so2_'+'_'.join(fn_end)+'_'+str(years[0])+'-'+str(years[-1])+'.parquet')
-        data_cf_nox.to_parquet('nox_'+'_'.join(fn_end)+'_'+str(years[0])+'-'+str(years[-1])+'.parquet')
\ No newline at end of file
+        ## save monte carlo output, n_days_chunk days at a time
+        for species, ensemble in ensembles.items():
+            fn = species+'_'+'_'.join(fn_end)+'_'+str(years[0])+'-'+str(years[-1])+'.parquet'
+            if ensemble_format == 'virtual': # only the regression, counterfactual emissions, and seed
+                ensemble.save(virtual_fn(fn))
+            else: # every simulation, generated block by block
+                with open_writer(fn, ensemble.index, n_simulations, ensemble_format, encoding=encoding,
+                                 max_abs_error=max_abs_error, max_rel_error=max_rel_error) as writer:
+                    for start in range(0, len(ensemble.index), n_days_chunk):
+                        writer.write_days(ensemble[start:start+n_days_chunk])
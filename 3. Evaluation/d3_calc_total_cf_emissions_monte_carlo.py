@@ -15,6 +15,12 @@ import os
 abspath = os.path.abspath(__file__)
 base_dname = os.path.dirname(abspath)
 
+# import streaming ensemble writer and virtual ensembles
+os.chdir(base_dname)
+from MC_output import open_writer
+from MC_random import master_seed, record_seed, stream_seed
+from MC_ensemble import VirtualEnsemble, virtual_fn
+
 def retrieve_emissions_and_stitch(group_of_states, years, rel_path_input):
     """
     retrieves emissions files for file names with "group_of_states_year.csv" from 'rel_path_input' folder
@@ -56,33 +62,6 @@ def retrieve_emissions_and_stitch(group_of_states, years, rel_path_input):
         
     return output_emissions
 
-def monte_carlo_prediction(x, ER_means, cov, n_simulations=5000):
-    """
-    Uses a Monte Carlo method to predict a series of y values for a given set of x values
-    x here is demand and y is the emissions mass
-
-    Parameters:
-    x (array-like): The x values for which to predict y values.
-    ER_means (array-like): Mean ERs matched to day of year parallel to demands in x.
-    cov (float): Mean CoV of all averaged ERs from base years.
-    n_simulations (int): The number of simulations to run. Default is 5000.
-
-    Returns:
-    y_mc (ndarray): An array of shape (n_simulations, len(x)) containing the predicted y values for each simulation and each x value.
-    """
-    y_mc = np.zeros((n_simulations, len(x)))
-
-    for i in range(n_simulations):
-        ER_mc = np.random.normal(loc=ER_means, scale=ER_means*cov)
-        y_mc[i] = np.multiply(x, ER_mc)
-        # ensure emissions can't go below 0
-        y_mc[i][y_mc[i] < 0] = 0
-    
-    output = pd.DataFrame(y_mc.T) # change to dataframe
-    column_names = ['column_' + str(i) for i in range(0, n_simulations)] # rename columns for easier saving
-    output.rename(columns=dict(zip(output.columns, column_names)), inplace=True)
-    return output
-
 if __name__ == '__main__':
     
     ## define relative file paths
@@ -98,7 +77,34 @@ if __name__ == '__main__':
     # filename endings to search for when stitching CEMS data
     fn_ends = [['SOCO'], # ATL regional
                 ['NYC']] # NYC regional
+    # number of simulations to run
+    n_simulations = 5000
+    # number of days simulated and written at a time; bounds memory to n_days_chunk*n_simulations values
+    n_days_chunk = 365
+    # how ensembles are saved: 'virtual' saves only the demand, ERs, CoV, and seed
+    # (MC_ensemble.VirtualEnsemble), 'tensor' every simulation as a float32 .npy memory map with a json sidecar of dates
+    # (MC_output.TensorWriter), and 'parquet' a table with one column per simulation; MC_ensemble.read_ensemble reads
+    # any of them
+    ensemble_format = 'virtual'
+    # compact encoding of 'tensor' ensembles: None (float32), 'float16', or 'int16' (quantized between the minimum and
+    # maximum of each day); every value must be within max_abs_error + max_rel_error*|value| of its simulation, which is
+    # checked as it is written and recorded in the sidecar metadata
+    encoding = None
+    # largest absolute error of the encoding (kg/day); None for no absolute bound
+    max_abs_error = 1.
+    # largest relative error of the encoding; None for no relative bound
+    max_rel_error = 1e-3
+    # sampler of the ERs of each block of days and simulations: 'random' (independent), 'antithetic', 'lhs' (Latin hypercube), or 'sobol'
+    # (scrambled Sobol, best with a power of 2 simulations per chunk); see MC_sampling
+    sampler = 'random'
+    # master seed of the monte carlo simulations; an int, the file of a recorded seed, or None to draw a new seed
+    # (recorded with the outputs)
+    seed = None
     
+    seed_seq = master_seed(seed)
+    os.chdir(base_dname)
+    os.chdir(rel_path_output)
+    record_seed(seed_seq, 'seed_d3_'+species+'_'+str(years_for_cf[0])+'-'+str(years_for_cf[-1])+'.json') # reproduces this run as seed
     
     for fn_end in fn_ends:
         
@@ -127,15 +133,19 @@ if __name__ == '__main__':
         data_CEMS['day'] = data_CEMS['date'].dt.day
         data_CEMS = pd.merge(data_CEMS, ER[['month', 'day', species+'_avg']], on=['month', 'day'], how='left')
         
-        ## assmble monte carlo timeseries 
-        output = monte_carlo_prediction(data_CEMS['demand'], data_CEMS[species+'_avg'], CoV)
-        # concat datetime to left of output
-        output = pd.concat([data_CEMS['date'].reset_index(drop=True), output], axis=1)
-        
-        ## save output
-        output = output.rename(columns={'date':'Date'}) # for ML compatibility
-        output.set_index('Date', inplace=True)
+        ## assmble monte carlo timeseries and save output, n_days_chunk days at a time
         os.chdir(base_dname) # change to code directory
         os.chdir(rel_path_output) # change to input directory
         fn = species+'_'+'_'.join(fn_end)+'_'+str(years_for_cf[0])+'-'+str(years_for_cf[-1])+'.parquet'
-        output.to_parquet(fn)
+        # Date index for ML compatibility
+        ensemble = VirtualEnsemble('emission_rate', data_CEMS['date'], n_simulations,
+                                   {'x': data_CEMS['demand'], 'ER_means': data_CEMS[species+'_avg']}, {'cov': CoV},
+                                   stream_seed(seed_seq, 'd3', '_'.join(fn_end), species), n_days_block=n_days_chunk,
+                                   sampler=sampler)
+        if ensemble_format == 'virtual': # only demand, ERs, CoV, and seed
+            ensemble.save(virtual_fn(fn))
+        else: # every simulation, generated block by block
+            with open_writer(fn, data_CEMS['date'], n_simulations, ensemble_format, encoding=encoding,
+                             max_abs_error=max_abs_error, max_rel_error=max_rel_error) as writer:
+                for start in range(0, len(data_CEMS.index), n_days_chunk):
+                    writer.write_days(ensemble[start:start+n_days_chunk])
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 12:22:38 2026
+
+pushes every emissions scenario through the ML models in one pass: modeled actual (e9), CAIR and other impacts (e8),
+    and the short-run counterfactual (e1)
+each site's features and each model are loaded once, and the monte carlo runs of all scenarios are stacked into the same
+    predictions; sites of a region that share emissions, and all targets of a site, can be run together
+outputs are written to the same folders and file names as e1, e8, and e9
+
+@author: emei3
+"""
+
+## imports
+import pandas as pd
+import numpy as np
+import os
+import sys
+
+# obtain code directory name for future folder changing
+abspath = os.path.abspath(__file__)
+base_dname = os.path.dirname(abspath)
+
+os.chdir(base_dname)
+from MC_scenarios import Scenario, SiteModel, propagate_region
+from MC_output import open_writer
+from MC_summary import summarize
+from MC_random import master_seed, record_seed, stream_seed
+from MC_ensemble import read_ensemble
+from e8_propagate_reductions_to_AQ import pad_impact_dataframe
+# import model registry from the model fitting folder
+sys.path.append(os.path.join(base_dname, '../2. Models'))
+from XGBoost_registry import load_model
+
+if __name__ == '__main__':
+
+    ## define relative file paths
+    # directory with counterfactual emissions
+    rel_path_input_emissions = "../../Data/Counterfactual Emissions/7. ba regions edited"
+    # directory with emissions impacts
+    rel_path_emissions_reductions = "../../Data/Emissions Reductions/2. edited"
+    # directory with machine learning model input features
+    rel_path_input_ML_features = "../../Data/ForModel/ML/" # input features have base EGU emissions
+    # directory with fitted machine learning model
+    rel_path_input_ML = "../../Data/Fitted Models/"
+    # directory with output counterfactual air pollutants (e1 and e8)
+    rel_path_output_pollutants = "../../Data/Counterfactual Air Pollutants/7. ba regions edited"
+    # directory with output modeled actual air pollutants (e9)
+    rel_path_output_actual = "../../Data/Counterfactual Air Pollutants/0. modeled actual"
+    fn_save_end = ''
+
+    # sites to run for
+    groups_of_sites = [["SDK"], # all sites in Atlanta
+        ["Bronx", "Manhattan", "Queens"]] # all sites in NYC
+    # all target names to run for; any target fitted in a_fit_all_ML_models (e.g., "OC", "EC", "NH4", "NO3", "SO4", "CO",
+    # "NO2", "SO2")
+    targetNames = ["pm25", "ozone"] # just PM and ozone for now
+    # groups of states to run for; must be parallel to emissions used for "sites"
+    fn_ends = [['SOCO'], ['NYC']]
+    # years to run; must be iterable
+    years = range(2006, 2020)
+    # scenarios to run; any of 'actual' (e9), 'CAIR' and 'other' (e8), and 'cf' (e1)
+    scenario_names = ['actual', 'CAIR', 'other', 'cf']
+    # number of simulations to run for each scenario; the counterfactual emissions must have at least this many
+    n = 5000
+    # number of simulations of each scenario stacked into each model prediction
+    n_sims_chunk = 100
+    # only evaluate trees that split on emissions for every simulation; other trees are summed once per day
+    use_pruned_trees = True
+    # compile each model into a native library with the system C compiler for the monte carlo predictions; falls back
+    # to xgboost if there is no compiler or the library does not match xgboost on the observed features
+    use_compiled_model = False
+    # share the mobile and other perturbations of each simulation between scenarios so scenario differences only come
+    # from EGU emissions; days with zero CAIR or other impact are then copied from the modeled actual
+    common_random_numbers = True
+    # run all targets of a site together: each chunk of simulations is filled and perturbed once on the union of the
+    # targets' features and every model reads its columns from that block
+    multi_target = True
+    # run the sites of a region together: random draws are shared by the sites (mobile and other perturbations by date
+    # and feature when common_random_numbers is True) and all sites' predictions are dispatched at once
+    fuse_sites = True
+    # how counterfactual ensembles are saved: 'parquet' (a table with one column per simulation) or 'tensor' (a float32
+    # .npy memory map with a json sidecar of dates, read with MC_ensemble.read_ensemble)
+    ensemble_format = 'parquet'
+    # compact encoding of 'tensor' ensembles: None (float32), 'float16', or 'int16' (quantized between the minimum and
+    # maximum of each day); every value must be within max_abs_error + max_rel_error*|value| of its simulation, which is
+    # checked as it is written and recorded in the sidecar metadata
+    encoding = None
+    # largest absolute error of the encoding (ug/m3 or ppb); None for no absolute bound
+    max_abs_error = 0.01
+    # largest relative error of the encoding; None for no relative bound
+    max_rel_error = 1e-3
+    # sampler of the impacts and mobile and other perturbations of each chunk: 'random' (independent), 'antithetic', 'lhs' (Latin hypercube), or 'sobol'
+    # (scrambled Sobol, best with a power of 2 simulations per chunk); see MC_sampling
+    sampler = 'random'
+    # master seed of the monte carlo runs; an int, the file of a recorded seed, or None to draw a new seed (recorded with
+    # the outputs)
+    seed = None
+
+    seed_seq = master_seed(seed)
+    period = str(years[0])+'-'+str(years[-1])
+    os.chdir(base_dname)
+    os.chdir(rel_path_output_pollutants)
+    record_seed(seed_seq, 'seed_e10_'+period+'.json') # reproduces this run as seed
+
+    for i, sites in enumerate(groups_of_sites):
+        fn_end = fn_ends[i]
+
+        ## build scenarios of this region
+        scenarios = []
+        for name in scenario_names:
+            if name == 'actual': # observed EGU emissions
+                scenarios.append(Scenario(name))
+            elif name in ['CAIR', 'other']: # impacts added to observed EGU emissions
+                os.chdir(base_dname) # change to code directory
+                os.chdir(rel_path_emissions_reductions) # change to emissions directory
+                fn = '_'.join(fn_end)+'_'+period
+                # pad impacts with leading 0s to make consistent with machine learning model
+                impacts = {species: pad_impact_dataframe(pd.read_parquet(species+'_'+fn+'_'+name+'_reductions'+fn_save_end+'.parquet'),
+                                                         str(years[0])+'-01-01') for species in ['so2', 'nox']}
+                scenarios.append(Scenario(name, 'impact', impacts))
+            elif name == 'cf': # monte carlo counterfactual emissions replace observed EGU emissions
+                os.chdir(base_dname) # change to code directory
+                os.chdir(rel_path_input_emissions) # change to emissions directory
+                ensembles = {species: read_ensemble(species+'_'+'_'.join(fn_end)+'_'+period+'.parquet') # file or virtual
+                             for species in ['so2', 'nox']}
+                scenarios.append(Scenario(name, 'replacement', ensembles))
+            else:
+                raise ValueError('unknown scenario '+name)
+
+        ## read each site's features and line each scenario up with its dates once per site
+        site_data = dict()
+        for site in sites:
+            os.chdir(base_dname) # change to code directory
+            os.chdir(rel_path_input_ML_features+site) # change to model data folder
+            # read in all feature data
+            X = pd.read_excel(site+'Base.xlsx', sheet_name="X") # read all X data including Date
+            features_all = pd.read_excel(site+'_features.xlsx', sheet_name=None) # X features needed for every target
+            # retrieve so2 and nox feature names used in ML models
+            if site in ['Bronx', 'Manhattan', 'Queens']:
+                species_features = {'so2': 'SO2EGUtot', 'nox': 'NOxEGUtot'}
+            else:
+                species_features = {'so2': 'SO2EGU', 'nox': 'NOxEGU'}
+            site_changes = [scenario.align(X.loc[:, 'Date'], species_features) for scenario in scenarios]
+            site_data[site] = (X, features_all, site_changes)
+
+        ## push every scenario through the models of a batch of targets at a batch of sites
+        for target_batch in ([targetNames] if multi_target else [[target] for target in targetNames]):
+            for site_batch in ([sites] if fuse_sites else [[site] for site in sites]):
+                site_models = []
+                outputs = dict()
+                writers = [] # counterfactual ensembles are spooled to disk while they are predicted
+                for site in site_batch:
+                    X, features_all, site_changes = site_data[site]
+                    # features of every target in the batch; each model reads its own columns from one block
+                    target_features = {target: [value[0] for value in features_all[target].values] for target in target_batch}
+                    union_features = []
+                    for target in target_batch:
+                        union_features.extend(feature for feature in target_features[target] if feature not in union_features)
+                    site_model = SiteModel(site, X.loc[:, union_features].to_numpy(dtype=float), union_features,
+                                           X.loc[:, 'Date'], scenarios, site_changes, use_pruned_trees=use_pruned_trees,
+                                           use_compiled_model=use_compiled_model,
+                                           common_random_numbers=common_random_numbers)
+                    outputs[site] = dict()
+                    for target in target_batch:
+                        fn = site + "_" + target # file names, except for extension
+                        feature_names = target_features[target]
+
+                        # load model
+                        os.chdir(base_dname)
+                        os.chdir(rel_path_input_ML + site)
+                        regressor = load_model(".", fn, feature_names=feature_names)
+
+                        # emissions scenarios only change the model if so2 or nox is in it
+                        run = [s for s, scenario in enumerate(scenarios)
+                               if scenario.kind == 'none' or scenario.changes_model(feature_names, site_changes[s])]
+                        site_model.add_target(target, regressor, feature_names, run)
+                        outputs[site][target] = dict()
+                        for s in run:
+                            if scenarios[s].name == 'cf':
+                                os.chdir(base_dname)
+                                os.chdir(rel_path_output_pollutants)
+                                writers.append(open_writer(fn+'_'+period+'.parquet', X.loc[:, 'Date'], n,
+                                                           ensemble_format, encoding=encoding,
+                                                           max_abs_error=max_abs_error, max_rel_error=max_rel_error))
+                                outputs[site][target]['cf'] = writers[-1].spool()
+                            else: # pre-allocate pollutant concentration
+                                outputs[site][target][scenarios[s].name] = np.zeros((len(X.index), n))
+                    site_models.append(site_model)
+
+                try:
+                    # one stream per batch of sites and targets
+                    batch_seed = stream_seed(seed_seq, 'e10', '_'.join(fn_end), site='_'.join(site_batch),
+                                             target='_'.join(target_batch))
+                    propagate_region(site_models, scenarios, n, n_sims_chunk, seed=batch_seed,
+                                     common_random_numbers=common_random_numbers, outputs=outputs, sampler=sampler)
+                except BaseException:
+                    for writer in writers:
+                        writer.abort()
+                    raise
+                for writer in writers: # write full counterfactual ensembles to table
+                    writer.close()
+
+                # bin the other scenarios to daily resolution and write to tables in the layout of e8 and e9
+                for site in site_batch:
+                    X = site_data[site][0]
+                    for target in target_batch:
+                        fn = site + "_" + target # file names, except for extension
+                        for name, y_mc in outputs[site][target].items():
+                            if name == 'cf':
+                                continue
+                            output = summarize(y_mc, X.loc[:, 'Date'])['daily']
+                            os.chdir(base_dname)
+                            if name == 'actual':
+                                os.chdir(rel_path_output_actual)
+                                output.to_parquet(fn+'_'+period+'_bin_daily.parquet')
+                            else:
+                                os.chdir(rel_path_output_pollutants)
+                                output.to_parquet(fn+'_'+period+'_'+name+'_bin_daily.parquet')
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 12:55:55 2026
+
+runs c4, e1, and e2 for the short-run counterfactual as one streaming pipeline: each region's regressions give virtual
+    counterfactual emissions ensembles that are regenerated chunk by chunk straight into the ML models, and each chunk
+    of predictions is folded into the binned summaries in memory (MC_summary.WindowSketch)
+no 5000-column emissions or pollutant ensembles are written unless save_ensembles is True; only the regression stats and
+    the binned emissions and pollutants, with the same folders and file names as c4 and e2
+emissions are drawn from the c4 streams and predictions from the e1 streams, so with the same master seed the outputs
+    equal running c4, e1, and e2 in turn
+
+@author: emei3
+"""
+
+## imports
+import numpy as np
+import pandas as pd
+import os
+import sys
+
+# obtain code directory name for future folder changing
+abspath = os.path.abspath(__file__)
+base_dname = os.path.dirname(abspath)
+
+os.chdir(base_dname)
+from MC_propagation import propagate_batched, align_dates, take_aligned, insert_aligned, resolve_perturbed_columns, perturb_lognormal
+from XGBoost_inference import PrunedPredictor, StepFunctionTable
+from XGBoost_compiled import compile_predictor
+from MC_output import open_writer
+from MC_summary import summarize, WindowSketch
+from MC_random import master_seed, record_seed, stream_seed
+from MC_ensemble import virtual_fn
+from c4_calc_short_cf_emissions_monte_carlo import short_cf_ensembles, write_regression_stats
+# import model registry from the model fitting folder
+sys.path.append(os.path.join(base_dname, '../2. Models'))
+from XGBoost_registry import load_model
+
+if __name__ == '__main__':
+
+    ## define relative file paths
+    # folder with observed emissions
+    rel_path_CEMS = "../../Data/Simple Dispatch Outputs/2023-06-23 act/Actual CEMS"
+    # directory with simple dispatch actual
+    rel_path_SD_act = "../../Data/Simple Dispatch Outputs/2023-06-23 act"
+    # directory with simple dispatch counterfactual
+    rel_path_SD_cf = "../../Data/Simple Dispatch Outputs/2023-06-23 cf"
+    # directory with output regression stats and binned counterfactual emissions
+    rel_path_output_emissions = "../../Data/Counterfactual Emissions/7. ba regions edited"
+    # directory with machine learning model input features
+    rel_path_input_ML_features = "../../Data/ForModel/ML/"
+    # directory with fitted machine learning model
+    rel_path_input_ML = "../../Data/Fitted Models/"
+    # directory with output binned air pollutants
+    rel_path_output_pollutants = "../../Data/Counterfactual Air Pollutants/7. ba regions edited"
+
+    # sites to run for
+    groups_of_sites = [["SDK"], # all sites in Atlanta
+        ["Bronx", "Manhattan", "Queens"]] # all sites in NYC
+    # all target names to run for
+    targetNames = ["pm25", "ozone"] # just PM and ozone for now
+    # groups of states to run for; must be parallel to emissions used for "sites"
+    fn_ends = [['SOCO'], ['NYC']]
+    # years to run; must be iterable
+    years = range(2006, 2020)
+    # number of simulations to run
+    n_simulations = 5000
+    # number of days per tile of the virtual emissions ensembles (as c4's n_days_chunk)
+    n_days_chunk = 365
+    # number of simulations stacked into each model prediction and folded into the summaries at once
+    n_sims_chunk = 250
+    # windows to bin emissions and pollutants to; any of 'daily', 'weekly', 'monthly', and 'ozone_season'
+    windows = ['daily', 'weekly']
+    # values kept per level of the summary sketches (see MC_summary.QuantileSketch); None keeps every simulation of
+    # one site and target in memory and gives the same summaries as e2, an int bounds memory at a small rank error
+    sketch_size = None
+    # only evaluate trees that split on emissions for every simulation; other trees are summed once per day
+    use_pruned_trees = True
+    # perturb mobile and other emissions; False gives an EGU-only counterfactual
+    perturb_mobile_other = True
+    # for EGU-only counterfactuals, tabulate each day's exact response to EGU emissions and look up every monte carlo run
+    use_step_tables = True
+    # compile each model into a native library with the system C compiler for the monte carlo predictions; falls back
+    # to xgboost if there is no compiler or the library does not match xgboost on the observed features
+    use_compiled_model = False
+    # also save the raw ensembles where c4 and e1 would: emissions as virtual ensembles (regression, counterfactual
+    # emissions, and seed) and pollutants in ensemble_format, written while they are summarized
+    save_ensembles = False
+    # how saved pollutant ensembles are written: 'parquet' (a table with one column per simulation) or 'tensor' (a
+    # float32 .npy memory map with a json sidecar of dates, read with MC_ensemble.read_ensemble)
+    ensemble_format = 'parquet'
+    # compact encoding of 'tensor' ensembles: None (float32), 'float16', or 'int16' (quantized between the minimum and
+    # maximum of each day); every value must be within max_abs_error + max_rel_error*|value| of its simulation, which is
+    # checked as it is written and recorded in the sidecar metadata
+    encoding = None
+    # largest absolute error of the encoding (ug/m3 or ppb); None for no absolute bound
+    max_abs_error = 0.01
+    # largest relative error of the encoding; None for no relative bound
+    max_rel_error = 1e-3
+    # sampler of the regression noise and the mobile and other perturbations of each chunk: 'random' (independent),
+    # 'antithetic', 'lhs' (Latin hypercube), or 'sobol' (scrambled Sobol, best with a power of 2 simulations per chunk);
+    # see MC_sampling
+    sampler = 'random'
+    # master seed of the monte carlo runs; an int, the file of a recorded seed, or None to draw a new seed (recorded with
+    # the outputs)
+    seed = None
+
+    seed_seq = master_seed(seed)
+    period = str(years[0])+'-'+str(years[-1])
+    for rel_path_output in [rel_path_output_emissions, rel_path_output_pollutants]:
+        os.chdir(base_dname)
+        os.chdir(rel_path_output)
+        record_seed(seed_seq, 'seed_e11_'+period+'.json') # reproduces this run as seed
+
+    # repeat for each region
+    for i, sites in enumerate(groups_of_sites):
+        fn_end = fn_ends[i]
+
+        ## counterfactual monte carlo emissions (c4), regenerated on demand from the regressions
+        regressions, ensembles = short_cf_ensembles(fn_end, years, rel_path_CEMS, rel_path_SD_act, rel_path_SD_cf,
+                                                    n_simulations, seed_seq, n_days_chunk, sampler)
+        os.chdir(base_dname) # change to code directory
+        os.chdir(rel_path_output_emissions) # change to output directory
+        write_regression_stats(regressions, 'regression_stats_'+'_'.join(fn_end)+'_'+period+'.xlsx')
+        for species, ensemble in ensembles.items():
+            fn = species+'_'+'_'.join(fn_end)+'_'+period
+            if save_ensembles: # only the regression, counterfactual emissions, and seed
+                ensemble.save(virtual_fn(fn+'.parquet'))
+            # bin to every window (e2), regenerating blocks of days
+            binned = summarize(ensemble, ensemble.index, windows)
+            for window in windows:
+                binned[window].to_parquet(fn+'_bin_'+window+'.parquet')
+
+        ## loop through each site and create binned counterfactual pollutants
+        for site in sites:
+            os.chdir(base_dname) # change to code directory
+            os.chdir(rel_path_input_ML_features+site) # change to model data folder
+            # read in all feature data
+            X = pd.read_excel(site+'Base.xlsx', sheet_name="X") # read all X data including Date
+            # retrieve so2 and nox feature names used in ML models
+            if site in ['Bronx', 'Manhattan', 'Queens']:
+                species_features_all = ['SO2EGUtot', 'NOxEGUtot']
+            else:
+                species_features_all = ['SO2EGU', 'NOxEGU']
+            # rows of the counterfactual emissions that line up with each day of feature data
+            so2_rows = align_dates(X.loc[:, 'Date'], ensembles['so2'].index)
+            nox_rows = align_dates(X.loc[:, 'Date'], ensembles['nox'].index)
+
+            # loop through each target to create counterfactual pollutants
+            for target in targetNames:
+                fn = site + "_" + target # file names, except for extension
+
+                # select particular X features needed
+                os.chdir(base_dname) # change to code directory
+                os.chdir(rel_path_input_ML_features+site) # change to model data folder
+                featuresNeeded = pd.read_excel(site+'_features.xlsx', sheet_name=target) # X features needed
+
+                # only run if so2 or nox in model
+                if not any(featuresNeeded.isin(species_features_all).values):
+                    continue
+
+                # load model
+                os.chdir(base_dname)
+                os.chdir(rel_path_input_ML + site)
+                regressor = load_model(".", fn, feature_names=featuresNeeded.transpose().values[0])
+
+                feature_names = [value[0] for value in featuresNeeded.values]
+                X_base = X.loc[:, feature_names].to_numpy(dtype=float)
+                X_base_values = X_base.astype(np.float32)
+                # mobile and other emissions columns to perturb
+                perturbed_cols, perturbed_sigmas = resolve_perturbed_columns(feature_names)
+                if not perturb_mobile_other: # EGU-only counterfactual
+                    perturbed_cols, perturbed_sigmas = perturbed_cols[:0], perturbed_sigmas[:0]
+                # so2 and nox EGU features in model and their monte carlo runs
+                step_features = [feature for feature in species_features_all if feature in feature_names]
+                cf_values = {species_features_all[0]: (ensembles['so2'], so2_rows),
+                             species_features_all[1]: (ensembles['nox'], nox_rows)}
+
+                # summaries of every window, fed chunk by chunk (and the raw ensemble if it is saved)
+                os.chdir(base_dname)
+                os.chdir(rel_path_output_pollutants)
+                writer = None
+                if save_ensembles:
+                    writer = open_writer(fn+'_'+period+'.parquet', X.loc[:, 'Date'], n_simulations, ensemble_format,
+                                         encoding=encoding, max_abs_error=max_abs_error, max_rel_error=max_rel_error)
+                summary = WindowSketch(X.loc[:, 'Date'], windows, sketch_size, writer=writer)
+
+                try:
+                    table = None
+                    if use_step_tables and len(perturbed_cols) == 0: # only EGU emissions change between monte carlo runs
+                        table = StepFunctionTable(regressor, feature_names, step_features, X_base)
+                        # only worth it if the table is smaller than predicting every monte carlo run
+                        if table.n_cells >= len(X.index)*n_simulations:
+                            print('step function table for '+fn+' is larger than the monte carlo runs; predicting each run')
+                            table = None
+
+                    if table is not None: # look up the monte carlo runs n_sims_chunk at a time
+                        for start in range(0, n_simulations, n_sims_chunk):
+                            stop = min(start + n_sims_chunk, n_simulations)
+                            summary.write_sims(start, stop, table.lookup([take_aligned(*cf_values[feature], start, stop)
+                                                                          for feature in step_features]))
+                    else:
+                        def fill_chunk(start, stop, X_chunk, rng):
+                            X_chunk[:] = X_base_values # start every monte carlo run from observed features
+
+                            # replace the observed so2 and nox EGU with the monte carlo simulated
+                            for feature in step_features:
+                                insert_aligned(X_chunk, feature_names.index(feature), *cf_values[feature], start, stop)
+
+                            # perturb mobile and other emissions
+                            # use log normal distributions with sigmas from Hanna et al. 2001
+                            perturb_lognormal(X_chunk, X_base, perturbed_cols, perturbed_sigmas, rng, sampler=sampler)
+
+                        # split trees on whether they use features that change between monte carlo runs
+                        predictor = regressor
+                        if use_pruned_trees:
+                            varying_features = step_features + [feature_names[col] for col in perturbed_cols]
+                            predictor = PrunedPredictor(regressor, feature_names, varying_features, X_base)
+                        if use_compiled_model: # native library of the trees evaluated for every simulation
+                            predictor = compile_predictor(predictor, feature_names, X_base)
+
+                        # predict output for all monte carlo runs, n_sims_chunk runs per prediction, into the summaries
+                        propagate_batched(predictor, fill_chunk, len(X.index), feature_names, n_simulations,
+                                          n_sims_chunk, seed=stream_seed(seed_seq, 'e1', '_'.join(fn_end), site=site,
+                                                                         target=target),
+                                          out=summary)
+                except BaseException:
+                    if writer is not None:
+                        writer.abort()
+                    raise
+                if writer is not None: # write full counterfactual ensemble to table
+                    writer.close()
+
+                ## write binned pollutants (e2)
+                binned = summary.finalize()
+                for window in windows:
+                    output = binned[window]
+                    if not summary.is_exact(): # precision of the sketch
+                        output.attrs['sketch'] = {'k': sketch_size, 'n_sims': n_simulations}
+                    output.to_parquet(fn+'_'+period+'_bin_'+window+'.parquet')
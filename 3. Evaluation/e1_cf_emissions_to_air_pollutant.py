@@ -10,59 +10,27 @@ plugs in each Monte Carlo emissions output into ML XGB model; saves all outputs
 import numpy as np
 import pandas as pd
 import os
-import joblib
+import sys
 
 # obtain code directory name for future folder changing
 abspath = os.path.abspath(__file__)
 base_dname = os.path.dirname(abspath)
 
-def insert_emissions_into_features(X_forTarget_temp, cf_df, species_target_name, monte_carlo_column, featuresNeeded):
-    """
-    inserts monte carlo emissions column into the correct species name within the feature dataset for ML while preserving
-    the order of features. Also makes sures datetime values align
-
-    Parameters
-    ----------
-    X_forTarget_temp : dataframe
-        feature dataframe.
-    cf_df : dateframe
-        counterfactual emissions dataframe.
-    species_target_name : string
-        name of feature to replace.
-    monte_carlo_column : string
-        name of counterfactual emissions column to insert.
-    featuresNeeded : dataframe
-        dataframe of features needed.
-
-    Returns
-    -------
-    X_forTarget_temp : dataframe
-        feature dataframe with new emissions.
-
-    """
-    cf_df_temp = cf_df.reset_index()
-    X_forTarget_temp = pd.merge(X_forTarget_temp, cf_df_temp[['Date', monte_carlo_column]], on='Date', how='left') # make dataframes consistent
-    X_forTarget_temp.drop(columns=[species_target_name], inplace=True) # drop old column
-    X_forTarget_temp.rename(columns={monte_carlo_column: species_target_name}, inplace=True) # rename new column as old column
-    X_forTarget_temp = X_forTarget_temp[np.append(['Date'], [value[0] for value in featuresNeeded.values])] # rearrange columns to original order
-    return X_forTarget_temp
-
-def perturb_lognormal(df, columns_to_perturb, sigma):
-    """
-    randomly redistributes columns_to_perturb of dataframe df with a lognormal distribution of standard deviation sigma    
-    """
-        
-    output = df.copy()
-    
-    for col in columns_to_perturb:
-        X_to_perturb = output.loc[:, col].copy()
-        # perturb the emissions with a lognormal distribution with sigma
-        X_to_perturb = np.random.lognormal(mean=np.log(X_to_perturb),
-                                           sigma=sigma)
-        # file back into prediction dataframe
-        output.loc[:, col] = X_to_perturb.copy()
-    
-    return output
+# import shared monte carlo propagation functions
+os.chdir(base_dname)
+from MC_propagation import (propagate_batched, align_dates, take_aligned, insert_aligned,
+                            resolve_perturbed_columns, perturb_lognormal)
+from XGBoost_inference import PrunedPredictor, StepFunctionTable
+from XGBoost_compiled import compile_predictor
+from MC_parallel import SharedArray, PropagationJob, run_parallel
+from MC_checkpoint import get_checkpoint, hash_inputs, resume_seed
+from MC_output import open_writer, write_ensemble
+from MC_random import record_seed, stream_seed
+from MC_sampling import sampling_report
+from MC_ensemble import read_ensemble, ensemble_values
+# import model registry from the model fitting folder
+sys.path.append(os.path.join(base_dname, '../2. Models'))
+from XGBoost_registry import load_model
 
 if __name__ == '__main__':
     # directory with counterfactual emissions
@@ -73,6 +41,8 @@ if __name__ == '__main__':
     rel_path_input_ML = "../../Data/Fitted Models/" 
     # directory with output air pollutants
     rel_path_output_pollutants = "../../Data/Counterfactual Air Pollutants/7. ba regions edited"
+    # directory with checkpoints of unfinished monte carlo runs; a rerun resumes from them. None turns off checkpoints
+    rel_path_checkpoints = "../../Data/Checkpoints/Counterfactual Air Pollutants/7. ba regions edited"
     
     # sites to run for
     groups_of_sites = [["SDK"], # all sites in Atlanta
@@ -83,6 +53,51 @@ if __name__ == '__main__':
     fn_ends = [['SOCO'], ['NYC']]
     # years to run; must be iterable
     years = range(2006, 2020)
+    # number of simulations stacked into each model prediction; 1 reproduces one prediction per simulation
+    n_sims_chunk = 250
+    # only evaluate trees that split on emissions for every simulation; other trees are summed once per day
+    use_pruned_trees = True
+    # perturb mobile and other emissions; False gives an EGU-only counterfactual
+    perturb_mobile_other = True
+    # for EGU-only counterfactuals, tabulate each day's exact response to EGU emissions and look up every monte carlo run
+    use_step_tables = True
+    # compile each model into a native library with the system C compiler for the monte carlo predictions; falls back
+    # to xgboost if there is no compiler or the library does not match xgboost on the observed features
+    use_compiled_model = False
+    # number of worker processes; >1 shards sites, targets, and chunks of n_sims_chunk runs across a process pool
+    n_workers = 1
+    # xgboost threads per worker process; n_workers*nthread should not exceed the number of cores
+    nthread = 1
+    # number of parallel site and target jobs run at once; each holds its full output in shared memory until it is
+    # written
+    n_jobs_open = 2
+    # how output ensembles are saved: 'parquet' (a table with one column per simulation) or 'tensor' (a float32 .npy
+    # memory map with a json sidecar of dates, read with MC_ensemble.read_ensemble)
+    ensemble_format = 'parquet'
+    # compact encoding of 'tensor' ensembles: None (float32), 'float16', or 'int16' (quantized between the minimum and
+    # maximum of each day); every value must be within max_abs_error + max_rel_error*|value| of its simulation, which is
+    # checked as it is written and recorded in the sidecar metadata
+    encoding = None
+    # largest absolute error of the encoding (ug/m3 or ppb); None for no absolute bound
+    max_abs_error = 0.01
+    # largest relative error of the encoding; None for no relative bound
+    max_rel_error = 1e-3
+    # sampler of the mobile and other perturbations of each chunk: 'random' (independent), 'antithetic', 'lhs' (Latin hypercube), or 'sobol'
+    # (scrambled Sobol, best with a power of 2 simulations per chunk); see MC_sampling; other samplers print
+    # the effective sample size of each output
+    sampler = 'random'
+    # master seed of the monte carlo runs; an int, the file of a recorded seed, or None to draw a new seed (recorded with
+    # the outputs); while checkpoints of an earlier run are left, None resumes with its seed and any other seed raises
+    seed = None
+    
+    # kept with the checkpoints so an interrupted run resumes with the same seed
+    seed_seq = resume_seed(seed, rel_path_checkpoints, 'seed_e1_'+str(years[0])+'-'+str(years[-1])+'.json')
+    os.chdir(base_dname)
+    os.chdir(rel_path_output_pollutants)
+    record_seed(seed_seq, 'seed_e1_'+str(years[0])+'-'+str(years[-1])+'.json') # reproduces this run as seed
+    jobs = [] # site and target jobs to run in parallel
+    job_dates = dict() # dates of each job's output
+    shared_ensembles = [] # ensembles in shared memory for parallel jobs
     
     # repeat for each site
     for i, sites in enumerate(groups_of_sites):
@@ -91,8 +106,21 @@ if __name__ == '__main__':
         ## retrieve counterfactual monte carlo emissions
         os.chdir(base_dname) # change to code directory
         os.chdir(rel_path_input_emissions) # change to emissions directory
-        so2_cf = pd.read_parquet('so2_'+'_'.join(fn_end)+'_'+str(years[0])+'-'+str(years[-1])+'.parquet')
-        nox_cf = pd.read_parquet('nox_'+'_'.join(fn_end)+'_'+str(years[0])+'-'+str(years[-1])+'.parquet')
+        # files or virtual ensembles regenerated from their parameters
+        so2_cf = read_ensemble('so2_'+'_'.join(fn_end)+'_'+str(years[0])+'-'+str(years[-1])+'.parquet')
+        nox_cf = read_ensemble('nox_'+'_'.join(fn_end)+'_'+str(years[0])+'-'+str(years[-1])+'.parquet')
+        # monte carlo runs as arrays with columns in simulation order
+        column_names = ['column_' + str(i) for i in range(0, len(so2_cf.columns))]
+        so2_cf_values = ensemble_values(so2_cf)
+        nox_cf_values = ensemble_values(nox_cf)
+        if n_workers > 1: # workers attach to one copy of the ensembles; virtual ensembles and stores are pickled
+            so2_cf_shared, nox_cf_shared = so2_cf_values, nox_cf_values
+            if isinstance(so2_cf_values, np.ndarray):
+                so2_cf_shared = SharedArray(so2_cf_values)
+                shared_ensembles.append(so2_cf_shared)
+            if isinstance(nox_cf_values, np.ndarray):
+                nox_cf_shared = SharedArray(nox_cf_values)
+                shared_ensembles.append(nox_cf_shared)
         
         ## loop through each site and create counterfactual pollutants
         for site in sites:
@@ -106,6 +134,9 @@ if __name__ == '__main__':
                 species_features_all = ['SO2EGUtot', 'NOxEGUtot']
             else:
                 species_features_all = ['SO2EGU', 'NOxEGU']
+            # rows of the counterfactual emissions that line up with each day of feature data
+            so2_rows = align_dates(X.loc[:, 'Date'], so2_cf.index)
+            nox_rows = align_dates(X.loc[:, 'Date'], nox_cf.index)
             
             # loop through each target to create counterfactual pollutants
             for target in targetNames:
@@ -120,37 +151,108 @@ if __name__ == '__main__':
                 # load model
                 os.chdir(base_dname)
                 os.chdir(rel_path_input_ML + site)
-                regressor = joblib.load(fn+"_XGB.json")
+                regressor = load_model(".", fn, feature_names=featuresNeeded.transpose().values[0])
                 
                 # push emissions through model predictions
                 if any(featuresNeeded.isin(species_features_all).values): # only run if so2 or nox in model
-                    y_mc = np.zeros((len(X_forTarget.index), len(so2_cf.columns))) # pre-allocate pollutant concentration
-                    for i in range(0, len(so2_cf.columns)): # loop through number of monte carlo runs (n_col - 1 times to avoid running 'Date' column)
-                        X_forTarget_temp = X_forTarget.copy()
-                        
-                        # if so2 EGU is in features needed, replace the observed with the monte carlo simulated
-                        if species_features_all[0] in featuresNeeded.values:
-                            X_forTarget_temp = insert_emissions_into_features(X_forTarget_temp, so2_cf, species_features_all[0], 'column_'+str(i), featuresNeeded)
+                    feature_names = [value[0] for value in featuresNeeded.values]
+                    X_base = X_forTarget[feature_names].to_numpy(dtype=float)
+                    X_base_values = X_base.astype(np.float32)
+                    # mobile and other emissions columns to perturb
+                    perturbed_cols, perturbed_sigmas = resolve_perturbed_columns(feature_names)
+                    if not perturb_mobile_other: # EGU-only counterfactual
+                        perturbed_cols, perturbed_sigmas = perturbed_cols[:0], perturbed_sigmas[:0]
+                    # so2 and nox EGU features in model and their monte carlo runs
+                    step_features = [feature for feature in species_features_all if feature in feature_names]
+                    cf_values = {species_features_all[0]: (so2_cf_values, so2_rows),
+                                 species_features_all[1]: (nox_cf_values, nox_rows)}
+                    
+                    y_mc = None
+                    if use_step_tables and len(perturbed_cols) == 0: # only EGU emissions change between monte carlo runs
+                        table = StepFunctionTable(regressor, feature_names, step_features, X_base)
+                        # only worth it if the table is smaller than predicting every monte carlo run
+                        if table.n_cells < len(X_forTarget.index)*len(column_names):
+                            y_mc = table.lookup([take_aligned(*cf_values[feature]) for feature in step_features])
+                        else:
+                            print('step function table for '+fn+' is larger than the monte carlo runs; predicting each run')
+                    
+                    checkpoint = get_checkpoint(rel_path_checkpoints, fn) if y_mc is None else None
+                    
+                    if y_mc is None and n_workers > 1: # set up job to run after all sites and targets
+                        cf_shared = {species_features_all[0]: (so2_cf_shared, so2_rows),
+                                     species_features_all[1]: (nox_cf_shared, nox_rows)}
+                        jobs.append(PropagationJob(fn, os.path.abspath("."), fn, feature_names, X_base,
+                                                   len(column_names), perturbed_cols, perturbed_sigmas,
+                                                   replacements=[(feature, *cf_shared[feature]) for feature in step_features],
+                                                   use_pruned_trees=use_pruned_trees, use_compiled_model=use_compiled_model,
+                                                   checkpoint=checkpoint,
+                                                   seed=stream_seed(seed_seq, 'e1', '_'.join(fn_end), site=site, target=target),
+                                                   sampler=sampler))
+                        job_dates[fn] = X.loc[:, 'Date']
+                        continue
+                    
+                    if y_mc is None:
+                        def fill_chunk(start, stop, X_chunk, rng):
+                            X_chunk[:] = X_base_values # start every monte carlo run from observed features
+                            
+                            # replace the observed so2 and nox EGU with the monte carlo simulated
+                            for feature in step_features:
+                                insert_aligned(X_chunk, feature_names.index(feature), *cf_values[feature], start, stop)
                             
-                        # if nox EGU is in features needed, replace the observed with the monte carlo simulated
-                        if species_features_all[1] in featuresNeeded.values:
-                            X_forTarget_temp = insert_emissions_into_features(X_forTarget_temp, nox_cf, species_features_all[1], 'column_'+str(i), featuresNeeded)
+                            # perturb mobile and other emissions
+                            # use log normal distributions with sigmas from Hanna et al. 2001
+                            perturb_lognormal(X_chunk, X_base, perturbed_cols, perturbed_sigmas, rng, sampler=sampler)
                         
-                        # perturb mobile and other emissions using +-50% uniform distribution
-                        # use log normal distributions with sigmas from Hanna et al. 2001
-                        mobile_columns = [col for col in X_forTarget_temp.columns if 'mobile' in col]
-                        X_forTarget_temp = perturb_lognormal(X_forTarget_temp, mobile_columns, 0.347)
-                        other_columns = [col for col in X_forTarget_temp.columns if 'other' in col]
-                        X_forTarget_temp = perturb_lognormal(X_forTarget_temp, other_columns, 0.203)
+                        # split trees on whether they use features that change between monte carlo runs
+                        predictor = regressor
+                        if use_pruned_trees:
+                            varying_features = step_features + [feature_names[col] for col in perturbed_cols]
+                            predictor = PrunedPredictor(regressor, feature_names, varying_features, X_base)
+                        if use_compiled_model: # native library of the trees evaluated for every simulation
+                            predictor = compile_predictor(predictor, feature_names, X_base)
                         
-                        # predict output
-                        y_mc[:, i] = regressor.predict(X_forTarget_temp[[value[0] for value in featuresNeeded.values]])
-                
-                    output = pd.DataFrame(y_mc, index=X.loc[:, 'Date']) # change to dataframe
-                    column_names = ['column_' + str(i) for i in range(0, len(so2_cf.columns))] # rename columns for easier saving
-                    output.rename(columns=dict(zip(output.columns, column_names)), inplace=True)
+                        # predict output for all monte carlo runs, n_sims_chunk runs per prediction, and stream them to table
+                        os.chdir(base_dname)
+                        os.chdir(rel_path_output_pollutants)
+                        with open_writer(fn+'_'+str(years[0])+'-'+str(years[-1])+'.parquet', X.loc[:, 'Date'],
+                                         len(column_names), ensemble_format, encoding=encoding,
+                                         max_abs_error=max_abs_error, max_rel_error=max_rel_error) as writer:
+                            y_mc = propagate_batched(predictor, fill_chunk, len(X_forTarget.index), feature_names,
+                                                     len(column_names), n_sims_chunk,
+                                                     seed=stream_seed(seed_seq, 'e1', '_'.join(fn_end), site=site,
+                                                                      target=target),
+                                                     checkpoint=checkpoint, out=writer.spool(),
+                                                     fingerprint=hash_inputs(sampler, feature_names, perturbed_cols,
+                                                                             perturbed_sigmas, X_base,
+                                                                             [(feature_names.index(feature), *cf_values[feature])
+                                                                              for feature in step_features], []))
+                            if sampler != 'random':
+                                print(fn+' sampling: '+str(sampling_report(y_mc, n_sims_chunk, sampler)))
                     
-                    # write to table
-                    os.chdir(base_dname)
-                    os.chdir(rel_path_output_pollutants)
-                    output.to_parquet(site+'_'+target+'_'+str(years[0])+'-'+str(years[-1])+'.parquet')
\ No newline at end of file
+                    else: # write step function table lookups to table
+                        os.chdir(base_dname)
+                        os.chdir(rel_path_output_pollutants)
+                        write_ensemble(y_mc, X.loc[:, 'Date'], fn+'_'+str(years[0])+'-'+str(years[-1])+'.parquet',
+                                       ensemble_format=ensemble_format, encoding=encoding,
+                                       max_abs_error=max_abs_error, max_rel_error=max_rel_error)
+                    if checkpoint is not None: # output is safely written
+                        checkpoint.clear()
+    
+    ## run parallel jobs and write each to table as soon as it is done
+    if len(jobs) > 0:
+        os.chdir(base_dname)
+        os.chdir(rel_path_output_pollutants)
+        def write_job(job):
+            if sampler != 'random':
+                print(job.name+' sampling: '+str(sampling_report(job.output.array, n_sims_chunk, sampler)))
+            write_ensemble(job.output.array, job_dates[job.name], job.name+'_'+str(years[0])+'-'+str(years[-1])+'.parquet',
+                           ensemble_format=ensemble_format, encoding=encoding, max_abs_error=max_abs_error,
+                           max_rel_error=max_rel_error)
+            if job.checkpoint is not None:
+                job.checkpoint.clear()
+        run_parallel(jobs, n_workers=n_workers, n_sims_chunk=n_sims_chunk, nthread=nthread, seed=seed_seq,
+                     n_jobs_open=n_jobs_open, on_finish=write_job)
+        for job in jobs:
+            job.unlink()
+    for ensemble in shared_ensembles:
+        ensemble.unlink()
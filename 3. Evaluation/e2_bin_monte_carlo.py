@@ -2,40 +2,37 @@
 """
 Created on Sun May  7 19:59:27 2023
 
-bin the results of the monte carlo method on emissions and pollutants to daily resolution in which only the median and lower
+bin the results of the monte carlo method on emissions and pollutants to daily, weekly, monthly, or ozone season
+resolution in which only the median and lower
 and upper bounds of the 95 CI remain
-I'm working on binning to a weekly resolution as well, but I can't figure that out yet
 
 @author: emei3
 """
 
 import pandas as pd
 import os
-import numpy as np
 
 # obtain code directory name for future folder changing
 abspath = os.path.abspath(__file__)
 base_dname = os.path.dirname(abspath)
 
-def bin_daily(df):
-    # Calculate the median for each date
-    median = df.median(axis=1)
-    # Calculate the lower and upper bounds of the 95% interval for each date
-    lower_bound = df.quantile(0.025, axis=1)
-    upper_bound = df.quantile(0.975, axis=1)
-    # Create a new dataframe with the median, lower bound, and upper bound
-    new_df = pd.DataFrame({'median': median, 'lower_bound': lower_bound, 'upper_bound': upper_bound})
-    return new_df
+# import shared ensemble summaries
+os.chdir(base_dname)
+from MC_summary import summarize, summarize_parquet
+from MC_ensemble import read_ensemble, ensemble_values, virtual_fn
+from MC_output import store_fn
 
-def func(x): # finds median and lower and upper bounds of 95 CI
-    median = np.nanmedian(x.to_numpy().flatten())
-    lower_bound = np.nanpercentile(x.to_numpy().flatten(), 2.5)
-    upper_bound = np.nanpercentile(x.to_numpy().flatten(), 97.5)
-    return pd.Series((median, lower_bound, upper_bound), index=['median', 'lower_bound', 'upper_bound'])
-
-def bin_weekly(df):
-    weekly_df = df.resample('W').apply(func)
-    return weekly_df
+def bin_ensemble(fn, windows, out_of_core=True, n_days_block=None):
+    """
+    bins an ensemble file, or the virtual ensemble or tensor store saved in its place, to every window
+    """
+    if os.path.exists(virtual_fn(fn)) or os.path.exists(store_fn(fn)): # read block by block as summarized
+        ensemble = read_ensemble(fn)
+        return summarize(ensemble_values(ensemble), ensemble.index, windows)
+    if out_of_core: # read in blocks of days
+        return summarize_parquet(fn, windows, n_days_block=n_days_block)
+    ensemble = pd.read_parquet(fn)
+    return summarize(ensemble.to_numpy(), ensemble.index, windows)
 
 if __name__ == '__main__':
     # directory with counterfactual emissions
@@ -53,28 +50,29 @@ if __name__ == '__main__':
                 ['NYC']] # NYC regional
     # years to run; must be iterable
     years = range(2006, 2020)
+    # windows to bin emissions to; any of 'daily', 'weekly', 'monthly', and 'ozone_season'
+    windows = ['daily', 'weekly']
+    # read each ensemble in blocks of days with pyarrow instead of all at once, so ensembles larger than memory can be
+    # binned; results are the same
+    out_of_core = True
+    # number of days read at once when out_of_core is True; None bounds each block to about 2**24 values
+    n_days_block = None
     
     ### emissions
     os.chdir(base_dname) # change to code directory
     os.chdir(rel_path_input_emissions) # change to emissions directory
     for fn_end in fn_ends:
-        ## retrieve counterfactual monte carlo emissions
-        so2_cf = pd.read_parquet('so2_'+'_'.join(fn_end)+'_'+str(years[0])+'-'+str(years[-1])+'.parquet')
-        nox_cf = pd.read_parquet('nox_'+'_'.join(fn_end)+'_'+str(years[0])+'-'+str(years[-1])+'.parquet')
-        
-        ## bin daily
-        so2_cf_daily = bin_daily(so2_cf) # so2
-        nox_cf_daily = bin_daily(nox_cf) # nox
+        so2_fn = 'so2_'+'_'.join(fn_end)+'_'+str(years[0])+'-'+str(years[-1])+'.parquet'
+        nox_fn = 'nox_'+'_'.join(fn_end)+'_'+str(years[0])+'-'+str(years[-1])+'.parquet'
         
-        ## bin weekly
-        so2_cf_weekly = bin_weekly(so2_cf) # so2
-        nox_cf_weekly = bin_weekly(nox_cf) # nox
+        ## bin to every window in one pass over each ensemble
+        so2_cf_binned = bin_ensemble(so2_fn, windows, out_of_core, n_days_block) # so2
+        nox_cf_binned = bin_ensemble(nox_fn, windows, out_of_core, n_days_block) # nox
         
         ## write to table
-        so2_cf_daily.to_parquet('so2_'+'_'.join(fn_end)+'_'+str(years[0])+'-'+str(years[-1])+'_bin_daily.parquet')
-        nox_cf_daily.to_parquet('nox_'+'_'.join(fn_end)+'_'+str(years[0])+'-'+str(years[-1])+'_bin_daily.parquet')
-        so2_cf_weekly.to_parquet('so2_'+'_'.join(fn_end)+'_'+str(years[0])+'-'+str(years[-1])+'_bin_weekly.parquet')
-        nox_cf_weekly.to_parquet('nox_'+'_'.join(fn_end)+'_'+str(years[0])+'-'+str(years[-1])+'_bin_weekly.parquet')
+        for window in windows:
+            so2_cf_binned[window].to_parquet('so2_'+'_'.join(fn_end)+'_'+str(years[0])+'-'+str(years[-1])+'_bin_'+window+'.parquet')
+            nox_cf_binned[window].to_parquet('nox_'+'_'.join(fn_end)+'_'+str(years[0])+'-'+str(years[-1])+'_bin_'+window+'.parquet')
     
     # ### pollutant concentrations
     # os.chdir(base_dname) # change to code directory
@@ -82,12 +80,9 @@ if __name__ == '__main__':
     # # loop through each pollutant at each site
     # for site in sites:
     #     for target in targetNames:
-    #         # read data
-    #         pollutant = pd.read_parquet(site+'_'+target+'_'+str(years[0])+'-'+str(years[-1])+'.parquet')
-    #         # bin daily
-    #         pollutant_daily = bin_daily(pollutant)
-    #         # bin weekly
-    #         pollutant_weekly = bin_weekly(pollutant)
+    #         # bin daily and weekly, reading blocks of days
+    #         pollutant_binned = summarize_parquet(site+'_'+target+'_'+str(years[0])+'-'+str(years[-1])+'.parquet',
+    #                                              ['daily', 'weekly'], n_days_block=n_days_block)
     #         # write to table
-    #         pollutant_daily.to_parquet(site+'_'+target+'_'+str(years[0])+'-'+str(years[-1])+'_bin_daily.parquet')
-    #         pollutant_weekly.to_parquet(site+'_'+target+'_'+str(years[0])+'-'+str(years[-1])+'_bin_weekly.parquet')
+    #         pollutant_binned['daily'].to_parquet(site+'_'+target+'_'+str(years[0])+'-'+str(years[-1])+'_bin_daily.parquet')
+    #         pollutant_binned['weekly'].to_parquet(site+'_'+target+'_'+str(years[0])+'-'+str(years[-1])+'_bin_weekly.parquet')
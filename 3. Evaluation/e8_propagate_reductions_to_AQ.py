@@ -12,7 +12,7 @@ yes, I know this is a gross combination of three prior scripts. If I have time,
 import pandas as pd
 import numpy as np
 import os
-import joblib
+import sys
 from datetime import timedelta
 
 # obtain code directory name for future folder changing
@@ -21,36 +21,48 @@ base_dname = os.path.dirname(abspath)
 
 # import functions of cf emissions to air pollutant and also bin monte carlo
 os.chdir(base_dname)
-def add_impact_to_base_emissions(X_forTarget_temp, impact_df, species_target_name, featuresNeeded):
+from MC_propagation import propagate_batched, align_dates, resolve_perturbed_columns, perturb_lognormal
+from XGBoost_inference import PrunedPredictor
+from XGBoost_compiled import compile_predictor
+from MC_parallel import PropagationJob, run_parallel
+from MC_summary import bin_daily, QuantileSketch, ConvergenceCheck
+from MC_random import record_seed, stream_seed
+from MC_sampling import draw_normal, sampling_report
+from MC_checkpoint import get_checkpoint, hash_inputs, resume_seed
+# import model registry from the model fitting folder
+sys.path.append(os.path.join(base_dname, '../2. Models'))
+from XGBoost_registry import load_model
+
+def add_impact_to_base_emissions(base_emissions, impact_df, row_index, n_sims, rng, sampler='random'):
     """
-    adds emissions reductions magnitudes with noise into the correct species name within the feature dataset for ML while preserving
-    the order of features. Also makes sures datetime values align
+    adds emissions reductions magnitudes with noise to the base emissions of one species feature for n_sims simulations.
+    The impact is lined up with the feature dates through row_index instead of by masking each simulation
 
     Parameters
     ----------
-    X_forTarget_temp : dataframe
-        feature dataframe.
-    cf_df : dateframe
-        counterfactual emissions dataframe.
-    species_target_name : string
-        name of feature to replace.
-    featuresNeeded : dataframe
-        dataframe of features needed.
+    base_emissions : ndarray
+        observed emissions feature, one value per day of feature data.
+    impact_df : dataframe
+        factor impact dataframe with median and std.
+    row_index : ndarray
+        row of impact_df for each day of feature data (from align_dates).
+    n_sims : int
+        number of simulations to draw.
+    rng : numpy Generator
+        source of random numbers.
+    sampler : string, optional
+        sampler of the impact draws (see MC_sampling). The default is 'random'.
 
     Returns
     -------
-    X_forTarget_temp : dataframe
-        feature dataframe with new emissions.
+    emissions_mc : ndarray
+        (n_sims, n_days) base emissions with one random draw of the impact added in each simulation.
 
     """
     # create gaussian uncertainty about the impact median using the standard deviation
-    impact_mc = np.random.normal(loc=impact_df['median'], scale=impact_df['std'])
-    # mask for days that are in the dataframe
-    mask = impact_df['Date'].isin(X_forTarget_temp['Date'])
-    impact_mc = impact_mc[mask]
+    impact_mc = draw_normal(rng, impact_df['median'].to_numpy(), impact_df['std'].to_numpy(), n_sims, sampler)
     # add impact to target
-    X_forTarget_temp.loc[:, species_target_name] = X_forTarget_temp.loc[:, species_target_name] + impact_mc
-    return X_forTarget_temp
+    return base_emissions + impact_mc[:, row_index]
 
 # pads dataframe with leading 0s and dates from first_date to the first date of the original dataframe
 def pad_impact_dataframe(df_original, first_date):
@@ -65,34 +77,8 @@ def pad_impact_dataframe(df_original, first_date):
     new_df = new_df.sort_values(by='Date').reset_index(drop=True)  # Sort by the datetime column and reset index
     return new_df
 
-def bin_daily(df):
-    # Calculate the median for each date
-    median = df.median(axis=1)
-    # Calculate the lower and upper bounds of the 95% interval for each date
-    lower_bound = df.quantile(0.025, axis=1)
-    upper_bound = df.quantile(0.975, axis=1)
-    # Create a new dataframe with the median, lower bound, and upper bound
-    new_df = pd.DataFrame({'median': median, 'lower_bound': lower_bound, 'upper_bound': upper_bound})
-    return new_df
-
-def perturb_lognormal(df, columns_to_perturb, sigma):
-    """
-    randomly redistributes columns_to_perturb of dataframe df with a lognormal distribution of standard deviation sigma    
-    """
-        
-    output = df.copy()
-    
-    for col in columns_to_perturb:
-        X_to_perturb = output.loc[:, col].copy()
-        # perturb the emissions with a lognormal distribution with sigma
-        X_to_perturb = np.random.lognormal(mean=np.log(X_to_perturb),
-                                           sigma=sigma)
-        # file back into prediction dataframe
-        output.loc[:, col] = X_to_perturb.copy()
-        
-    return output
-        
-def create_mc_AQ(X, X_forTarget, so2_impact, nox_impact, species_features_all, regressor):
+def create_mc_AQ(X, X_forTarget, so2_impact, nox_impact, so2_rows, nox_rows, species_features_all, regressor,
+                 seed=None, checkpoint=None, convergence=None):
     """
     poorly written function that pushes CAIR or other impact through ML model
 
@@ -106,9 +92,20 @@ def create_mc_AQ(X, X_forTarget, so2_impact, nox_impact, species_features_all, r
         factor impact dataframe with median, upper bound, and lower bound.
     nox_impact : dataframe
         factor impact dataframe with median, upper bound, and lower bound.
+    so2_rows : ndarray
+        row of so2_impact for each day of X (from align_dates).
+    nox_rows : ndarray
+        row of nox_impact for each day of X (from align_dates).
     species_features_all : list
         poorly designed list with name of so2 [0] and nox [1] column in X_forTarget.
     regressor : XGBoost model
+    seed : numpy SeedSequence, optional
+        seed of the monte carlo runs. The default is None (random).
+    checkpoint : MC_checkpoint.Checkpoint, optional
+        saves each finished chunk of monte carlo runs and skips chunks finished by an earlier run. The default is None.
+    convergence : MC_summary.ConvergenceCheck, optional
+        stops the monte carlo runs once the daily quantiles have converged and records the precision reached in the
+        attrs of the output. The default is None (n runs).
 
     Returns
     -------
@@ -116,31 +113,62 @@ def create_mc_AQ(X, X_forTarget, so2_impact, nox_impact, species_features_all, r
 
     """
     
-    y_mc = np.zeros((len(X_forTarget.index), n)) # pre-allocate pollutant concentration
-    for i in range(0, n): # loop through number of monte carlo runs (n_col - 1 times to avoid running 'Date' column)
-        X_forTarget_temp = X_forTarget.copy()
-        
-        # if so2 EGU is in features needed, replace the observed with the monte carlo simulated
-        if species_features_all[0] in featuresNeeded.values:
-            X_forTarget_temp = add_impact_to_base_emissions(X_forTarget_temp, so2_impact, species_features_all[0], featuresNeeded)
+    feature_names = [value[0] for value in featuresNeeded.values]
+    X_base = X_forTarget[feature_names].to_numpy(dtype=float)
+    X_base_values = X_base.astype(np.float32)
+    # mobile and other emissions columns to perturb
+    perturbed_cols, perturbed_sigmas = resolve_perturbed_columns(feature_names)
+    
+    def fill_chunk(start, stop, X_chunk, rng):
+        X_chunk[:] = X_base_values # start every monte carlo run from observed features
+        # if so2 EGU is in features needed, add the monte carlo simulated impact to the observed
+        if species_features_all[0] in feature_names:
+            so2_col = feature_names.index(species_features_all[0])
+            X_chunk[:, :, so2_col] = add_impact_to_base_emissions(X_base[:, so2_col], so2_impact, so2_rows, stop-start, rng,
+                                                                   sampler)
             
-        # if nox EGU is in features needed, replace the observed with the monte carlo simulated
-        if species_features_all[1] in featuresNeeded.values:
-            X_forTarget_temp = add_impact_to_base_emissions(X_forTarget_temp, nox_impact, species_features_all[1], featuresNeeded)
+        # if nox EGU is in features needed, add the monte carlo simulated impact to the observed
+        if species_features_all[1] in feature_names:
+            nox_col = feature_names.index(species_features_all[1])
+            X_chunk[:, :, nox_col] = add_impact_to_base_emissions(X_base[:, nox_col], nox_impact, nox_rows, stop-start, rng,
+                                                                   sampler)
         
-        # perturb mobile and other emissions using +-50% uniform distribution
+        # perturb mobile and other emissions
         # use log normal distributions with sigmas from Hanna et al. 2001
-        mobile_columns = [col for col in X_forTarget_temp.columns if 'mobile' in col]
-        X_forTarget_temp = perturb_lognormal(X_forTarget_temp, mobile_columns, 0.347)
-        other_columns = [col for col in X_forTarget_temp.columns if 'other' in col]
-        X_forTarget_temp = perturb_lognormal(X_forTarget_temp, other_columns, 0.203)
-        
-        # predict output
-        y_mc[:, i] = regressor.predict(X_forTarget_temp[[value[0] for value in featuresNeeded.values]])
+        perturb_lognormal(X_chunk, X_base, perturbed_cols, perturbed_sigmas, rng, sampler=sampler)
+    
+    # split trees on whether they use features that change between monte carlo runs
+    predictor = regressor
+    if use_pruned_trees:
+        varying_features = ([feature for feature in species_features_all if feature in feature_names] +
+                            [feature_names[col] for col in perturbed_cols])
+        predictor = PrunedPredictor(regressor, feature_names, varying_features, X_base)
+    if use_compiled_model: # native library of the trees evaluated for every simulation
+        predictor = compile_predictor(predictor, feature_names, X_base)
+    
+    # everything the monte carlo runs draw from, which a checkpoint must match to be resumed
+    impacts = [(feature_names.index(feature), impact['median'], impact['std'], rows)
+               for feature, impact, rows in zip(species_features_all, [so2_impact, nox_impact], [so2_rows, nox_rows])
+               if feature in feature_names]
+    fingerprint = hash_inputs(sampler, feature_names, perturbed_cols, perturbed_sigmas, X_base, [], impacts)
+    
+    # predict output for all monte carlo runs, n_sims_chunk runs per prediction
+    if summary_only: # fold chunks into a per-day quantile sketch as they are predicted
+        sketch = propagate_batched(predictor, fill_chunk, len(X_forTarget.index), feature_names, n, n_sims_chunk,
+                                   seed=seed, checkpoint=checkpoint, out=QuantileSketch(len(X_forTarget.index), sketch_size),
+                                   converged=convergence, fingerprint=fingerprint)
+        output = sketch.finalize(X.loc[:, 'Date'])
+    else:
+        y_mc = propagate_batched(predictor, fill_chunk, len(X_forTarget.index), feature_names, n, n_sims_chunk,
+                                 seed=seed, checkpoint=checkpoint, converged=convergence, fingerprint=fingerprint)
 
-    output = pd.DataFrame(y_mc, index=X.loc[:, 'Date']) # change to dataframe
-    # bin output to daily resolution
-    output = bin_daily(output)
+        output = pd.DataFrame(y_mc, index=X.loc[:, 'Date']) # change to dataframe
+        # bin output to daily resolution
+        output = bin_daily(output)
+        if sampler != 'random': # effective sample size of the draws
+            output.attrs['sampling'] = sampling_report(y_mc, n_sims_chunk, sampler)
+    if convergence is not None: # simulations run and precision reached
+        output.attrs['convergence'] = convergence.report()
     
     return output
 
@@ -156,6 +184,8 @@ if __name__ == '__main__':
     rel_path_input_ML = "../../Data/Fitted Models/"
     # directory with output air pollutants
     rel_path_output_pollutants = "../../Data/Counterfactual Air Pollutants/7. ba regions edited"
+    # directory with checkpoints of unfinished monte carlo runs; a rerun resumes from them. None turns off checkpoints
+    rel_path_checkpoints = "../../Data/Checkpoints/Counterfactual Air Pollutants/7. ba regions edited"
     fn_save_end = ''
     
     # sites to run for
@@ -169,6 +199,50 @@ if __name__ == '__main__':
     years = range(2006, 2020)
     # number of simulations to run
     n = 5000
+    # number of simulations stacked into each model prediction
+    n_sims_chunk = 250
+    # only evaluate trees that split on emissions for every simulation; other trees are summed once per day
+    use_pruned_trees = True
+    # compile each model into a native library with the system C compiler for the monte carlo predictions; falls back
+    # to xgboost if there is no compiler or the library does not match xgboost on the observed features
+    use_compiled_model = False
+    # number of worker processes; >1 shards sites, targets, and chunks of n_sims_chunk runs across a process pool
+    n_workers = 1
+    # xgboost threads per worker process; n_workers*nthread should not exceed the number of cores
+    nthread = 1
+    # number of parallel site and target jobs run at once; each holds its full output in shared memory until it is
+    # written
+    n_jobs_open = 2
+    # only keep a mergeable per-day quantile sketch of each ensemble instead of the full (days, n) matrix; exact while
+    # n <= sketch_size, otherwise the quantiles are approximate (rank error of a few tenths of a percent)
+    summary_only = False
+    # values kept per level of each sketch when summary_only is True
+    sketch_size = 512
+    # stop the monte carlo runs of each site and target once their daily quantiles have converged (see
+    # MC_summary.ConvergenceCheck), with n the largest number of simulations; the precision reached is saved in the attrs
+    # (parquet metadata) of each output
+    adaptive = False
+    # largest standard error of each daily quantile, relative to the width of the day's 95 CI, for adaptive runs
+    tolerance = 0.02
+    # number of simulations before adaptive runs first check convergence
+    n_min = 500
+    # fraction of days whose quantiles must have converged for adaptive runs to stop
+    converged_day_fraction = 0.99
+    # sampler of the impacts and mobile and other perturbations of each chunk: 'random' (independent), 'antithetic', 'lhs' (Latin hypercube), or 'sobol'
+    # (scrambled Sobol, best with a power of 2 simulations per chunk); see MC_sampling; other samplers
+    # save the effective sample size in the attrs of each output
+    sampler = 'random'
+    # master seed of the monte carlo runs; an int, the file of a recorded seed, or None to draw a new seed (recorded with
+    # the outputs); while checkpoints of an earlier run are left, None resumes with its seed and any other seed raises
+    seed = None
+    
+    # kept with the checkpoints so an interrupted run resumes with the same seed
+    seed_seq = resume_seed(seed, rel_path_checkpoints, 'seed_e8_'+str(years[0])+'-'+str(years[-1])+'.json')
+    os.chdir(base_dname)
+    os.chdir(rel_path_output_pollutants)
+    record_seed(seed_seq, 'seed_e8_'+str(years[0])+'-'+str(years[-1])+'.json') # reproduces this run as seed
+    jobs = [] # site, target, and impact jobs to run in parallel
+    job_dates = dict() # dates of each job's output
     
     ## push emissions reductions into counterfactul air pollutants
     for i, sites in enumerate(groups_of_sites):
@@ -203,6 +277,13 @@ if __name__ == '__main__':
                 species_features_all = ['SO2EGUtot', 'NOxEGUtot']
             else:
                 species_features_all = ['SO2EGU', 'NOxEGU']
+            # rows of each impact that line up with each day of feature data
+            impact_rows = dict()
+            for name, impact in [('so2_CAIR', so2_CAIR_impact), ('nox_CAIR', nox_CAIR_impact),
+                                 ('so2_other', so2_other_impact), ('nox_other', nox_other_impact)]:
+                impact_rows[name] = align_dates(X.loc[:, 'Date'], impact['Date'])
+                if (impact_rows[name] < 0).any():
+                    raise ValueError(name+' impact does not cover every date in the features of '+site)
             
             # loop through each target to create counterfactual pollutants
             for target in targetNames:
@@ -217,17 +298,73 @@ if __name__ == '__main__':
                 # load model
                 os.chdir(base_dname)
                 os.chdir(rel_path_input_ML + site)
-                regressor = joblib.load(fn+"_XGB.json")
+                regressor = load_model(".", fn, feature_names=featuresNeeded.transpose().values[0])
                 
                 # push emissions through model predictions
-                if any(featuresNeeded.isin(species_features_all).values): # only run if so2 or nox in model
+                if any(featuresNeeded.isin(species_features_all).values) and n_workers > 1: # set up jobs to run after all sites and targets
+                    feature_names = [value[0] for value in featuresNeeded.values]
+                    perturbed_cols, perturbed_sigmas = resolve_perturbed_columns(feature_names)
+                    for impact_name, so2_impact, nox_impact in [('CAIR', so2_CAIR_impact, nox_CAIR_impact),
+                                                                 ('other', so2_other_impact, nox_other_impact)]:
+                        impacts = [(species_features_all[0], so2_impact['median'], so2_impact['std'], impact_rows['so2_'+impact_name]),
+                                   (species_features_all[1], nox_impact['median'], nox_impact['std'], impact_rows['nox_'+impact_name])]
+                        jobs.append(PropagationJob(fn+'_'+str(years[0])+'-'+str(years[-1])+'_'+impact_name,
+                                                   os.path.abspath("."), fn, feature_names,
+                                                   X_forTarget[feature_names].to_numpy(dtype=float), n,
+                                                   perturbed_cols, perturbed_sigmas,
+                                                   impacts=[impact for impact in impacts if impact[0] in feature_names],
+                                                   use_pruned_trees=use_pruned_trees, use_compiled_model=use_compiled_model,
+                                                   sketch_size=sketch_size if summary_only else None,
+                                                   seed=stream_seed(seed_seq, 'e8 '+impact_name, '_'.join(fn_end), site=site, target=target),
+                                                   checkpoint=get_checkpoint(rel_path_checkpoints, fn+'_'+str(years[0])+'-'+str(years[-1])+'_'+impact_name),
+                                                   convergence=ConvergenceCheck(tolerance, n_min, converged_day_fraction)
+                                                   if adaptive else None, sampler=sampler))
+                        job_dates[jobs[-1].name] = X.loc[:, 'Date']
+                
+                elif any(featuresNeeded.isin(species_features_all).values): # only run if so2 or nox in model
                     # CAIR
-                    AQ_CAIR = create_mc_AQ(X, X_forTarget, so2_CAIR_impact, nox_CAIR_impact, species_features_all, regressor)
+                    checkpoint_CAIR = get_checkpoint(rel_path_checkpoints, fn+'_'+str(years[0])+'-'+str(years[-1])+'_CAIR')
+                    AQ_CAIR = create_mc_AQ(X, X_forTarget, so2_CAIR_impact, nox_CAIR_impact,
+                                           impact_rows['so2_CAIR'], impact_rows['nox_CAIR'], species_features_all, regressor,
+                                           seed=stream_seed(seed_seq, 'e8 CAIR', '_'.join(fn_end), site=site, target=target),
+                                           checkpoint=checkpoint_CAIR,
+                                           convergence=ConvergenceCheck(tolerance, n_min, converged_day_fraction)
+                                           if adaptive else None)
                     # other
-                    AQ_other = create_mc_AQ(X, X_forTarget, so2_other_impact, nox_other_impact, species_features_all, regressor)
+                    checkpoint_other = get_checkpoint(rel_path_checkpoints, fn+'_'+str(years[0])+'-'+str(years[-1])+'_other')
+                    AQ_other = create_mc_AQ(X, X_forTarget, so2_other_impact, nox_other_impact,
+                                            impact_rows['so2_other'], impact_rows['nox_other'], species_features_all, regressor,
+                                            seed=stream_seed(seed_seq, 'e8 other', '_'.join(fn_end), site=site, target=target),
+                                            checkpoint=checkpoint_other,
+                                            convergence=ConvergenceCheck(tolerance, n_min, converged_day_fraction)
+                                            if adaptive else None)
                     
                     # write to table
                     os.chdir(base_dname)
                     os.chdir(rel_path_output_pollutants)
                     AQ_CAIR.to_parquet(site+'_'+target+'_'+str(years[0])+'-'+str(years[-1])+'_CAIR_bin_daily.parquet')
-                    AQ_other.to_parquet(site+'_'+target+'_'+str(years[0])+'-'+str(years[-1])+'_other_bin_daily.parquet')
\ No newline at end of file
+                    AQ_other.to_parquet(site+'_'+target+'_'+str(years[0])+'-'+str(years[-1])+'_other_bin_daily.parquet')
+                    for checkpoint in [checkpoint_CAIR, checkpoint_other]:
+                        if checkpoint is not None: # output is safely written
+                            checkpoint.clear()
+    
+    ## run parallel jobs, bin each to daily resolution, and write to table as soon as it is done
+    if len(jobs) > 0:
+        os.chdir(base_dname)
+        os.chdir(rel_path_output_pollutants)
+        def write_job(job):
+            if job.sketch is not None:
+                output = job.sketch.finalize(job_dates[job.name])
+            else:
+                output = bin_daily(pd.DataFrame(job.output.array[:, :job.n_sims_done], index=job_dates[job.name]))
+            if job.convergence is not None: # simulations run and precision reached
+                output.attrs['convergence'] = job.convergence.report()
+            if sampler != 'random' and not summary_only: # effective sample size of the draws
+                output.attrs['sampling'] = sampling_report(job.output.array[:, :job.n_sims_done], n_sims_chunk, sampler)
+            output.to_parquet(job.name+'_bin_daily.parquet')
+            if job.checkpoint is not None:
+                job.checkpoint.clear()
+        run_parallel(jobs, n_workers=n_workers, n_sims_chunk=n_sims_chunk, nthread=nthread, seed=seed_seq,
+                     n_jobs_open=n_jobs_open, on_finish=write_job)
+        for job in jobs:
+            job.unlink()
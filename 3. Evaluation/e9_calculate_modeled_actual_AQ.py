@@ -11,7 +11,7 @@ calculates modeled actual air quality with "constant" uncertainties in the same
 import pandas as pd
 import numpy as np
 import os
-import joblib
+import sys
 
 # obtain code directory name for future folder changing
 abspath = os.path.abspath(__file__)
@@ -19,34 +19,18 @@ base_dname = os.path.dirname(abspath)
 
 # import functions of cf emissions to air pollutant and also bin monte carlo
 os.chdir(base_dname)
+from MC_propagation import propagate_batched, resolve_perturbed_columns, perturb_lognormal
+from XGBoost_inference import PrunedPredictor
+from XGBoost_compiled import compile_predictor
+from MC_parallel import PropagationJob, run_parallel
+from MC_summary import bin_daily, QuantileSketch, ConvergenceCheck
+from MC_random import record_seed, stream_seed
+from MC_checkpoint import get_checkpoint, hash_inputs, resume_seed
+from MC_sampling import sampling_report
+# import model registry from the model fitting folder
+sys.path.append(os.path.join(base_dname, '../2. Models'))
+from XGBoost_registry import load_model
 
-def bin_daily(df):
-    # Calculate the median for each date
-    median = df.median(axis=1)
-    # Calculate the lower and upper bounds of the 95% interval for each date
-    lower_bound = df.quantile(0.025, axis=1)
-    upper_bound = df.quantile(0.975, axis=1)
-    # Create a new dataframe with the median, lower bound, and upper bound
-    new_df = pd.DataFrame({'median': median, 'lower_bound': lower_bound, 'upper_bound': upper_bound})
-    return new_df
-
-def perturb_lognormal(df, columns_to_perturb, sigma):
-    """
-    randomly redistributes columns_to_perturb of dataframe df with a lognormal distribution of standard deviation sigma    
-    """
-        
-    output = df.copy()
-    
-    for col in columns_to_perturb:
-        X_to_perturb = output.loc[:, col].copy()
-        # perturb the emissions with a lognormal distribution with sigma
-        X_to_perturb = np.random.lognormal(mean=np.log(X_to_perturb),
-                                           sigma=sigma)
-        # file back into prediction dataframe
-        output.loc[:, col] = X_to_perturb.copy()
-        
-    return output
-    
 if __name__ == '__main__':
     
     ## define relative file paths
@@ -56,6 +40,8 @@ if __name__ == '__main__':
     rel_path_input_ML = "../../Data/Fitted Models/"
     # directory with output air pollutants
     rel_path_output_pollutants = "../../Data/Counterfactual Air Pollutants/0. modeled actual"
+    # directory with checkpoints of unfinished monte carlo runs; a rerun resumes from them. None turns off checkpoints
+    rel_path_checkpoints = "../../Data/Checkpoints/Counterfactual Air Pollutants/0. modeled actual"
     
     # sites to run for
     sites = ["SDK", "Bronx", "Manhattan", "Queens"] 
@@ -65,7 +51,50 @@ if __name__ == '__main__':
     years = range(2006, 2020)
     # number of simulations to run
     n = 5000
+    # number of simulations stacked into each model prediction
+    n_sims_chunk = 250
+    # only evaluate trees that split on mobile and other emissions for every simulation; other trees are summed once per day
+    use_pruned_trees = True
+    # compile each model into a native library with the system C compiler for the monte carlo predictions; falls back
+    # to xgboost if there is no compiler or the library does not match xgboost on the observed features
+    use_compiled_model = False
+    # number of worker processes; >1 shards sites, targets, and chunks of n_sims_chunk runs across a process pool
+    n_workers = 1
+    # xgboost threads per worker process; n_workers*nthread should not exceed the number of cores
+    nthread = 1
+    # number of parallel site and target jobs run at once; each holds its full output in shared memory until it is
+    # written
+    n_jobs_open = 2
+    # only keep a mergeable per-day quantile sketch of each ensemble instead of the full (days, n) matrix; exact while
+    # n <= sketch_size, otherwise the quantiles are approximate (rank error of a few tenths of a percent)
+    summary_only = False
+    # values kept per level of each sketch when summary_only is True
+    sketch_size = 512
+    # stop the monte carlo runs of each site and target once their daily quantiles have converged (see
+    # MC_summary.ConvergenceCheck), with n the largest number of simulations; the precision reached is saved in the attrs
+    # (parquet metadata) of each output
+    adaptive = False
+    # largest standard error of each daily quantile, relative to the width of the day's 95 CI, for adaptive runs
+    tolerance = 0.02
+    # number of simulations before adaptive runs first check convergence
+    n_min = 500
+    # fraction of days whose quantiles must have converged for adaptive runs to stop
+    converged_day_fraction = 0.99
+    # sampler of the mobile and other perturbations of each chunk: 'random' (independent), 'antithetic', 'lhs' (Latin hypercube), or 'sobol'
+    # (scrambled Sobol, best with a power of 2 simulations per chunk); see MC_sampling; other samplers save
+    # the effective sample size in the attrs of each output
+    sampler = 'random'
+    # master seed of the monte carlo runs; an int, the file of a recorded seed, or None to draw a new seed (recorded with
+    # the outputs); while checkpoints of an earlier run are left, None resumes with its seed and any other seed raises
+    seed = None
     
+    # kept with the checkpoints so an interrupted run resumes with the same seed
+    seed_seq = resume_seed(seed, rel_path_checkpoints, 'seed_e9_'+str(years[0])+'-'+str(years[-1])+'.json')
+    os.chdir(base_dname)
+    os.chdir(rel_path_output_pollutants)
+    record_seed(seed_seq, 'seed_e9_'+str(years[0])+'-'+str(years[-1])+'.json') # reproduces this run as seed
+    jobs = [] # site and target jobs to run in parallel
+    job_dates = dict() # dates of each job's output
         
     ## loop through each site and create counterfactual pollutants
     for site in sites:
@@ -87,28 +116,88 @@ if __name__ == '__main__':
             # load model
             os.chdir(base_dname)
             os.chdir(rel_path_input_ML + site)
-            regressor = joblib.load(fn+"_XGB.json")
+            regressor = load_model(".", fn, feature_names=featuresNeeded.transpose().values[0])
             
             # push emissions through model predictions
-            y_mc = np.zeros((len(X_forTarget.index), n)) # pre-allocate pollutant concentration
-            for i in range(0, n): # loop through number of monte carlo runs (n_col - 1 times to avoid running 'Date' column)
-                X_forTarget_temp = X_forTarget.copy()
-                
-                # perturb mobile and other emissions using +-50% uniform distribution
+            feature_names = [value[0] for value in featuresNeeded.values]
+            X_base = X_forTarget[feature_names].to_numpy(dtype=float)
+            X_base_values = X_base.astype(np.float32)
+            # mobile and other emissions columns to perturb
+            perturbed_cols, perturbed_sigmas = resolve_perturbed_columns(feature_names)
+            checkpoint = get_checkpoint(rel_path_checkpoints, fn+'_'+str(years[0])+'-'+str(years[-1]))
+            
+            if n_workers > 1: # set up job to run after all sites and targets
+                jobs.append(PropagationJob(fn+'_'+str(years[0])+'-'+str(years[-1]), os.path.abspath("."), fn,
+                                           feature_names, X_base, n, perturbed_cols, perturbed_sigmas,
+                                           use_pruned_trees=use_pruned_trees, use_compiled_model=use_compiled_model,
+                                           sketch_size=sketch_size if summary_only else None,
+                                           checkpoint=checkpoint, seed=stream_seed(seed_seq, 'e9', site=site, target=target),
+                                           convergence=ConvergenceCheck(tolerance, n_min, converged_day_fraction)
+                                           if adaptive else None, sampler=sampler))
+                job_dates[jobs[-1].name] = X.loc[:, 'Date']
+                continue
+            
+            def fill_chunk(start, stop, X_chunk, rng):
+                X_chunk[:] = X_base_values # start every monte carlo run from observed features
+                # perturb mobile and other emissions
                 # use log normal distributions with sigmas from Hanna et al. 2001
-                mobile_columns = [col for col in X_forTarget_temp.columns if 'mobile' in col]
-                X_forTarget_temp = perturb_lognormal(X_forTarget_temp, mobile_columns, 0.347)
-                other_columns = [col for col in X_forTarget_temp.columns if 'other' in col]
-                X_forTarget_temp = perturb_lognormal(X_forTarget_temp, other_columns, 0.203)
-                
-                # predict output
-                y_mc[:, i] = regressor.predict(X_forTarget_temp[[value[0] for value in featuresNeeded.values]])
-
-            output = pd.DataFrame(y_mc, index=X.loc[:, 'Date']) # change to dataframe
-            # bin output to daily resolution
-            output = bin_daily(output)
+                perturb_lognormal(X_chunk, X_base, perturbed_cols, perturbed_sigmas, rng, sampler=sampler)
+            
+            # split trees on whether they use features that change between monte carlo runs
+            predictor = regressor
+            if use_pruned_trees:
+                varying_features = [feature_names[col] for col in perturbed_cols]
+                predictor = PrunedPredictor(regressor, feature_names, varying_features, X_base)
+            if use_compiled_model: # native library of the trees evaluated for every simulation
+                predictor = compile_predictor(predictor, feature_names, X_base)
+            
+            # everything the monte carlo runs draw from, which a checkpoint must match to be resumed
+            fingerprint = hash_inputs(sampler, feature_names, perturbed_cols, perturbed_sigmas, X_base, [], [])
+            
+            # predict output for all monte carlo runs, n_sims_chunk runs per prediction
+            convergence = ConvergenceCheck(tolerance, n_min, converged_day_fraction) if adaptive else None
+            if summary_only: # fold chunks into a per-day quantile sketch as they are predicted
+                sketch = propagate_batched(predictor, fill_chunk, len(X_forTarget.index), feature_names, n, n_sims_chunk,
+                                           seed=stream_seed(seed_seq, 'e9', site=site, target=target), checkpoint=checkpoint,
+                                           out=QuantileSketch(len(X_forTarget.index), sketch_size), converged=convergence,
+                                           fingerprint=fingerprint)
+                output = sketch.finalize(X.loc[:, 'Date'])
+            else:
+                y_mc = propagate_batched(predictor, fill_chunk, len(X_forTarget.index), feature_names, n, n_sims_chunk,
+                                         seed=stream_seed(seed_seq, 'e9', site=site, target=target), checkpoint=checkpoint,
+                                         converged=convergence, fingerprint=fingerprint)
+                output = pd.DataFrame(y_mc, index=X.loc[:, 'Date']) # change to dataframe
+                # bin output to daily resolution
+                output = bin_daily(output)
+                if sampler != 'random': # effective sample size of the draws
+                    output.attrs['sampling'] = sampling_report(y_mc, n_sims_chunk, sampler)
+            if convergence is not None: # simulations run and precision reached
+                output.attrs['convergence'] = convergence.report()
             
             # write to table
             os.chdir(base_dname)
             os.chdir(rel_path_output_pollutants)
-            output.to_parquet(site+'_'+target+'_'+str(years[0])+'-'+str(years[-1])+'_bin_daily.parquet')
\ No newline at end of file
+            output.to_parquet(site+'_'+target+'_'+str(years[0])+'-'+str(years[-1])+'_bin_daily.parquet')
+            if checkpoint is not None: # output is safely written
+                checkpoint.clear()
+    
+    ## run parallel jobs, bin each to daily resolution, and write to table as soon as it is done
+    if len(jobs) > 0:
+        os.chdir(base_dname)
+        os.chdir(rel_path_output_pollutants)
+        def write_job(job):
+            if job.sketch is not None:
+                output = job.sketch.finalize(job_dates[job.name])
+            else:
+                output = bin_daily(pd.DataFrame(job.output.array[:, :job.n_sims_done], index=job_dates[job.name]))
+            if job.convergence is not None: # simulations run and precision reached
+                output.attrs['convergence'] = job.convergence.report()
+            if sampler != 'random' and not summary_only: # effective sample size of the draws
+                output.attrs['sampling'] = sampling_report(job.output.array[:, :job.n_sims_done], n_sims_chunk, sampler)
+            output.to_parquet(job.name+'_bin_daily.parquet')
+            if job.checkpoint is not None:
+                job.checkpoint.clear()
+        run_parallel(jobs, n_workers=n_workers, n_sims_chunk=n_sims_chunk, nthread=nthread, seed=seed_seq,
+                     n_jobs_open=n_jobs_open, on_finish=write_job)
+        for job in jobs:
+            job.unlink()